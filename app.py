@@ -3,162 +3,3226 @@ Voice Chat Application - Main Flask Application
 Features: Voice input, text input, AI responses with voice cloning
 """
 
+from __future__ import annotations
+
 import os
+import time
+APP_IMPORT_STARTED = time.perf_counter()
+
 from dotenv import load_dotenv
+import bisect
+import contextvars
+import hashlib
+import hmac
+import io
+import json
+import queue
+import random
+import re
+import sqlite3
 import tempfile
+import importlib
+import sys
+import threading
+import tracemalloc
+import unicodedata
 import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional
+
+# Load environment variables from .env file
+load_dotenv()
+
+from flask import Flask, Response, g, render_template, request, jsonify, send_file, stream_with_context
+
+# Heavy dependencies are imported on first use, so text-only servers and tools
+# that only import this module never pay for torch or the TTS model code
+TEXT_ONLY = os.getenv('LUNA_TEXT_ONLY', '0') == '1'  # Text replies only; torch and Chatterbox are never loaded
+PROFILE_STARTUP = os.getenv('LUNA_PROFILE_STARTUP', '0') == '1'  # Log import time and memory of each heavy module
+startup_imports: Dict[str, Dict] = {}  # module -> import seconds and resident memory added
+
+class LazyModule:
+    """Stand-in for a module that is imported the first time one of its attributes is used"""
+
+    _lock = threading.Lock()
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = self._import()
+        return getattr(self._module, attr)
+
+    def _import(self):
+        rss = process_memory_bytes()
+        start = time.perf_counter()
+        module = importlib.import_module(self._name)
+        seconds = time.perf_counter() - start
+        added = (process_memory_bytes() or 0) - (rss or 0)
+        startup_imports[self._name] = {'seconds': round(seconds, 3), 'rss_added_bytes': added}
+        if PROFILE_STARTUP:
+            log(f"📦 Imported {self._name} in {seconds:.2f}s (+{added / 2**20:.0f} MB resident)")
+        return module
+
+torch = LazyModule('torch')
+torchaudio = LazyModule('torchaudio')
+chatterbox_tts = LazyModule('chatterbox.tts')
+
+# Initialize Flask app
+app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
+
+# Global variables for models and state
+stt_backend = None
+llm_backend = None
+tts_model = None
+
+# Voice conditioning cache: the reference audio is encoded once on upload and
+# reused for every reply instead of being re-derived on each generate() call.
+# Conditionals are persisted to disk and the most recently used voices stay in memory.
+VOICE_CACHE_DIR = os.getenv('LUNA_VOICE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'luna_voice_cache'))
+VOICE_CACHE_ITEMS = int(os.getenv('LUNA_VOICE_CACHE_ITEMS', '32'))  # Evicted voices are reloaded from disk
+tts_lock = threading.Lock()  # ChatterboxTTS keeps the active voice on the model instance
+default_conditionals = None
+voice_conditionals: "OrderedDict[str, chatterbox_tts.Conditionals]" = OrderedDict()
+voice_prepare_seconds: Dict[str, float] = {}
+voice_cache_lock = threading.Lock()
+voice_cache_stats = {'prepared': 0, 'disk_loads': 0, 'hits': 0, 'evictions': 0, 'seconds_saved': 0.0}
+
+# Request IDs: taken from the X-Request-ID header (or generated), echoed on the
+# response and prefixed to every log line written while serving the request
+REQUEST_ID_HEADER = 'X-Request-ID'
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+request_id_var: contextvars.ContextVar = contextvars.ContextVar('request_id', default=None)
+
+def log(message: str):
+    """Print a log line, prefixed with the current request ID"""
+    request_id = request_id_var.get()
+    print(f"[{request_id}] {message}" if request_id else message)
+
+def in_context(function):
+    """Bind a callable to the caller's context so work handed to another thread keeps its request ID"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+# Prometheus-style metrics, rendered in the text exposition format on /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+metrics_registry: List = []
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class Metric:
+    """A named metric family with a fixed set of label names"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values: Dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def _key(self, labels: Dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in items]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self.samples())
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+class Gauge(Counter):
+    """Current value; either set by the app or read from a callback at scrape time.
+
+    Callbacks return a number, a {label values tuple: number} dict, or None to skip.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels=(), callback=None):
+        super().__init__(name, help_text, labels)
+        self.callback = callback
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self) -> List[str]:
+        if self.callback is None:
+            return super().samples()
+        try:
+            values = self.callback()
+        except Exception:
+            return []
+        if values is None:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in values.items()]
+
+class Histogram(Metric):
+    """Bucketed distribution of observed values (cumulative on output)"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # One count per bucket plus the +Inf overflow, then the running sum
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(state)) for key, state in self._values.items()]
+        bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+        names = self.labels + ('le',)
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(bounds, state[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(names, key + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {state[-1]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+def tts_worker_states() -> Optional[Dict]:
+    workers = tts_scheduler.snapshot().get('workers')
+    if workers is None:
+        return None
+    states: Dict[tuple, int] = {}
+    for worker in workers:
+        states[(worker['state'],)] = states.get((worker['state'],), 0) + 1
+    return states
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in metrics_registry) + "\n"
+
+def process_memory_bytes() -> Optional[int]:
+    """Resident set size of this process, from psutil if installed, else /proc"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+stage_seconds = Histogram('luna_stage_duration_seconds', 'Time spent in each pipeline stage', ['stage'])
+http_request_seconds = Histogram('luna_http_request_duration_seconds', 'Time until response headers, per endpoint', ['endpoint'])
+http_requests_total = Counter('luna_http_requests_total', 'HTTP requests served', ['endpoint', 'method', 'status'])
+errors_total = Counter('luna_errors_total', 'Errors caught per pipeline stage', ['stage'])
+fallbacks_total = Counter('luna_fallbacks_total', 'Degraded replies (canned text, text-only, default voice)', ['kind'])
+http_in_flight = Gauge('luna_http_requests_in_flight', 'Requests currently being served, including open streams')
+Gauge('luna_tts_queue_depth', 'Synthesis requests waiting for the TTS worker', callback=lambda: tts_scheduler.queue_depth())
+Gauge('luna_tts_workers', 'TTS worker processes by state', ['state'], callback=lambda: tts_worker_states())
+Gauge('luna_jobs', 'Tracked asynchronous chat jobs by stage', ['stage'],
+      callback=lambda: {(stage,): count for stage, count in job_store.snapshot()['stages'].items()})
+Gauge('luna_audio_cache_bytes', 'Encoded clips held by the audio cache (disk tier lives in the temp dir)', ['tier'],
+      callback=lambda: {('memory',): audio_cache.snapshot()['memory_bytes'], ('disk',): audio_cache.snapshot()['disk_bytes']})
+Gauge('luna_audio_cache_files', 'Encoded clips held by the audio cache', ['tier'],
+      callback=lambda: {('memory',): audio_cache.snapshot()['memory_items'], ('disk',): audio_cache.snapshot()['disk_items']})
+Gauge('luna_sessions_active', 'Conversation sessions held in memory', callback=lambda: session_store.snapshot()['active'])
+Gauge('luna_model_ready', 'Whether each model component has loaded', ['component'],
+      callback=lambda: {(name,): int(status['state'] == 'ready') for name, status in model_status.items()})
+Gauge('luna_process_resident_memory_bytes', 'Resident memory of the server process', callback=process_memory_bytes)
+Gauge('luna_cuda_memory_allocated_bytes', 'GPU memory allocated by torch',
+      callback=lambda: torch.cuda.memory_allocated() if 'torch' in sys.modules and torch.cuda.is_available() else None)
+
+# Per-stage timing samples in seconds (upload, stt, llm, tts, encode, audio_serve)
+STAGE_SAMPLE_LIMIT = int(os.getenv('LUNA_STAGE_SAMPLES', '10000'))
+stage_samples: Dict[str, deque] = {}
+stage_lock = threading.Lock()
+
+def record_stage(stage: str, seconds: float):
+    """Record how long one pipeline stage took"""
+    with stage_lock:
+        samples = stage_samples.get(stage)
+        if samples is None:
+            samples = stage_samples[stage] = deque(maxlen=STAGE_SAMPLE_LIMIT)
+        samples.append(seconds)
+    stage_seconds.observe(seconds, stage=stage)
+
+@contextmanager
+def timed_stage(stage: str):
+    """Time the enclosed block as one pipeline stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def stage_summary() -> Dict[str, Dict]:
+    """p50/p95/p99 latency (ms) and sample count per stage"""
+    with stage_lock:
+        snapshot = {stage: sorted(samples) for stage, samples in stage_samples.items()}
+    return {
+        stage: {
+            'count': len(values),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 2)
+        }
+        for stage, values in snapshot.items()
+    }
+
+def reset_stage_samples():
+    with stage_lock:
+        stage_samples.clear()
+
+# On-demand profiling behind /debug/profile; every profiler is off until an admin
+# arms it, and disarmed profilers cost one integer check per call or request
+ADMIN_TOKEN = os.getenv('LUNA_ADMIN_TOKEN')  # Unset hides the profiling endpoints
+PROFILE_DIR = Path(os.getenv('LUNA_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'luna_profiles')))
+PROFILE_MAX_SECONDS = 60
+PROFILE_MAX_CAPTURES = 20
+PROFILE_TRACE_FRAMES = 10
+PROFILE_TOP_LOCATIONS = 15
+stack_sampler_lock = threading.Lock()
+
+def sample_stacks(seconds: float, interval: float) -> str:
+    """Sample every other thread's Python stack; returns collapsed stacks for flamegraph tools.
+
+    Each line is `thread;outer frame;...;inner frame count`, the format read by
+    flamegraph.pl and speedscope.
+    """
+    counts: Dict[str, int] = {}
+    own = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            key = ";".join([names.get(ident, str(ident))] + stack[::-1])
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items(), key=lambda item: -item[1]))
+
+class TorchTraceCapture:
+    """Runs the next few model calls under torch.profiler and keeps their traces.
+
+    The profiler only records CPU ops on the thread that starts it, so capture()
+    wraps the generate() call on the synthesis thread itself rather than the
+    request waiting for it. Calls made while no capture is armed go straight through.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.traces: List[Dict] = []
+        self._remaining = 0
+        self._lock = threading.Lock()
+        self._profiler_lock = threading.Lock()
+
+    def arm(self, calls: int):
+        """Capture the next `calls` calls, replacing earlier traces"""
+        with self._lock:
+            for trace in self.traces:
+                (self.directory / f"{trace['trace_id']}.json").unlink(missing_ok=True)
+            self.traces = []
+            self._remaining = calls
+
+    def _claim(self) -> bool:
+        with self._lock:
+            if self._remaining <= 0:
+                return False
+            self._remaining -= 1
+            return True
+
+    @contextmanager
+    def capture(self, name: str, request_ids: List[str]):
+        """Profile the enclosed block if a capture is armed; only one profiler can be active at a time"""
+        if self._remaining <= 0 or not self._claim():
+            yield
+            return
+        from torch.profiler import ProfilerActivity, profile
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        with self._profiler_lock:
+            start = time.perf_counter()
+            with profile(activities=activities, record_shapes=True) as profiler:
+                yield
+            seconds = time.perf_counter() - start
+        trace_id = uuid.uuid4().hex[:12]
+        self.directory.mkdir(parents=True, exist_ok=True)
+        profiler.export_chrome_trace(str(self.directory / f"{trace_id}.json"))
+        with self._lock:
+            self.traces.append({
+                'trace_id': trace_id,
+                'request_ids': request_ids,
+                'function': name,
+                'seconds': round(seconds, 3),
+                'top_ops': profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=PROFILE_TOP_LOCATIONS)
+            })
+        log(f"🔬 Torch trace {trace_id} captured ({seconds:.2f}s)")
+
+    def trace_path(self, trace_id: str) -> Optional[Path]:
+        with self._lock:
+            known = any(trace['trace_id'] == trace_id for trace in self.traces)
+        return self.directory / f"{trace_id}.json" if known else None
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {'pending': self._remaining, 'traces': list(self.traces)}
+
+class RequestMemoryProfiler:
+    """tracemalloc snapshots around the next few requests.
+
+    tracemalloc runs only while captures are pending. Its counters are
+    process-wide, so requests served concurrently show up in each other's diffs.
+    """
+
+    def __init__(self):
+        self.results: deque = deque(maxlen=PROFILE_MAX_CAPTURES)
+        self._remaining = 0
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def arm(self, requests: int):
+        with self._lock:
+            self.results.clear()
+            self._remaining = requests
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(PROFILE_TRACE_FRAMES)
+
+    @staticmethod
+    def _take():
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def begin(self):
+        """Snapshot before a request, or None when no capture is pending"""
+        if self._remaining <= 0:
+            return None
+        with self._lock:
+            if self._remaining <= 0:
+                return None
+            self._remaining -= 1
+            self._active += 1
+            tracemalloc.reset_peak()
+        return self._take()
+
+    def end(self, before, endpoint: str):
+        """Compare against the snapshot taken in begin() and keep the largest allocation sites"""
+        try:
+            differences = self._take().compare_to(before, 'lineno')
+            _, peak = tracemalloc.get_traced_memory()
+            result = {
+                'request_id': request_id_var.get(),
+                'endpoint': endpoint,
+                'allocated_bytes': sum(stat.size_diff for stat in differences),
+                'peak_bytes': peak,
+                'top': [
+                    {'location': str(stat.traceback[0]), 'size_diff': stat.size_diff, 'count_diff': stat.count_diff}
+                    for stat in differences[:PROFILE_TOP_LOCATIONS]
+                ]
+            }
+            self.results.append(result)
+        finally:
+            with self._lock:
+                self._active -= 1
+                if self._remaining <= 0 and self._active == 0:
+                    tracemalloc.stop()
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {'pending': self._remaining, 'tracing': tracemalloc.is_tracing(), 'requests': list(self.results)}
+
+torch_trace = TorchTraceCapture(PROFILE_DIR)
+memory_profiler = RequestMemoryProfiler()
+
+# Model loading state, reported by /health and /ready
+TTS_WARMUP = os.getenv('LUNA_TTS_WARMUP', '1') == '1'
+TTS_WARMUP_TEXT = "Hello, I'm Luna."
+model_status: Dict[str, Dict] = {name: {'state': 'pending'} for name in ('stt', 'llm', 'tts')}
+
+# System prompt for the AI assistant
+SYSTEM_PROMPT = """You are Luna, a compassionate wellness coach and empathetic companion. Your role is to provide supportive, understanding, and encouraging responses to users who may be seeking emotional support, guidance, or just someone to talk to.
+
+Key characteristics:
+- Be warm, empathetic, and genuinely caring
+- Show active listening by referencing what the user has shared
+- Offer practical wellness advice when appropriate
+- Remember context from the conversation (simulate memory)
+- Keep responses conversational and natural (2-3 sentences max)
+- Focus on emotional support and positive reinforcement
+- Ask thoughtful follow-up questions to show engagement
+
+Remember: Your responses will be converted to speech, so keep them concise but meaningful. Always maintain a supportive and caring tone."""
+
+FALLBACK_RESPONSE = "I'm sorry, I'm having trouble processing that right now. Could you try again?"
+
+# Streaming TTS settings
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+')
+MIN_SENTENCE_CHARS = 20  # Shorter fragments are merged with the next sentence
+STREAM_QUEUE_SIZE = 4  # Synthesized chunks buffered ahead of the client
+
+# TTS output cache settings
+AUDIO_CACHE_DIR = os.getenv('LUNA_AUDIO_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'luna_audio_cache'))
+AUDIO_CACHE_MEMORY_ITEMS = int(os.getenv('LUNA_AUDIO_CACHE_ITEMS', '128'))
+AUDIO_CACHE_MEMORY_BYTES = int(os.getenv('LUNA_AUDIO_CACHE_MEMORY_MB', '64')) * 1024 * 1024
+AUDIO_SPILL_BYTES = int(os.getenv('LUNA_AUDIO_SPILL_KB', '1024')) * 1024  # Larger clips go straight to disk
+AUDIO_CACHE_DISK_BYTES = int(os.getenv('LUNA_AUDIO_CACHE_DISK_MB', '512')) * 1024 * 1024
+AUDIO_TTL_SECONDS = int(os.getenv('LUNA_AUDIO_TTL_SECONDS', '86400'))  # Unused, unreferenced clips expire after this
+AUDIO_SWEEP_SECONDS = int(os.getenv('LUNA_AUDIO_SWEEP_SECONDS', '300'))  # 0 disables the background sweep
+AUDIO_CACHE_SHARED = os.getenv('LUNA_AUDIO_CACHE_SHARED', '0') == '1'  # Other processes write to the same directory
+
+class AudioCache:
+    """Two-tier cache of encoded TTS clips: a bounded in-memory LRU over a size-capped directory.
+
+    Clips are content-addressed by (normalized text, voice ID, sample rate), so a
+    repeated reply is served without touching the model. New clips live only in
+    memory; they are written to disk when they exceed the spill threshold or are
+    evicted from memory, so the common path never touches the filesystem.
+
+    Clips referenced from a session's history are pinned with retain()/release().
+    A background sweep drops clips that have not been used within the TTL unless
+    they are pinned; the disk cap evicts unpinned clips first and pinned ones only
+    if it still cannot be met, so disk usage stays bounded either way. The sweep
+    works from the in-memory index and never rescans the directory.
+
+    Each clip also gets a digest of its bytes for strong ETags, so a clip that
+    expires and is synthesized again under the same ID never matches a stale copy.
+    """
+
+    def __init__(self, directory: str, max_memory_items: int, max_disk_bytes: int,
+                 max_memory_bytes: int = AUDIO_CACHE_MEMORY_BYTES, spill_bytes: int = AUDIO_SPILL_BYTES,
+                 ttl_seconds: int = AUDIO_TTL_SECONDS, sweep_seconds: int = AUDIO_SWEEP_SECONDS,
+                 shared: bool = AUDIO_CACHE_SHARED):
+        self.directory = Path(directory)
+        self.max_memory_items = max_memory_items
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.spill_bytes = spill_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sweep_seconds = sweep_seconds
+        self.shared = shared
+        self.stats = {
+            'hits': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'spills': 0,
+            'disk_evictions': 0, 'pinned_evictions': 0, 'expired': 0, 'sweeps': 0
+        }
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_bytes = 0
+        self._accessed: Dict[str, float] = {}  # audio ID -> last write or read (wall clock)
+        self._refs: Dict[str, int] = {}  # clip hash -> session messages referencing any of its formats
+        self._digests: Dict[str, str] = {}  # audio ID -> digest of its bytes
+        self._lock = threading.Lock()
+        self._sweeper: Optional[threading.Thread] = None
+        self._load_index()
+
+    @staticmethod
+    def make_key(text: str, voice_id: Optional[str], sample_rate: int) -> str:
+        """Content hash for a clip; whitespace and Unicode form do not change the audio.
+
+        Cache entries are stored under audio IDs: this hash plus a format extension.
+        """
+        normalized = " ".join(unicodedata.normalize("NFC", text).split())
+        payload = f"{normalized}\x00{voice_id or 'default'}\x00{sample_rate}"
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+    def _forget(self, key: str):
+        self._accessed.pop(key, None)
+        self._digests.pop(key, None)
+
+    def _load_index(self):
+        """Index clips left on disk by a previous run, oldest first"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entries = sorted(
+            (entry for entry in self.directory.iterdir() if entry.is_file()),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in entries:
+            stat = entry.stat()
+            self._disk[entry.name] = stat.st_size
+            self._disk_bytes += stat.st_size
+            self._accessed[entry.name] = stat.st_mtime
+        self._evict_disk()
+
+    def _pinned(self, key: str) -> bool:
+        return self._refs.get(key.split('.', 1)[0], 0) > 0
+
+    def _unlink(self, key: str):
+        """Remove a clip from the disk tier"""
+        self._disk_bytes -= self._disk.pop(key)
+        if key not in self._memory:
+            self._forget(key)
+        try:
+            self._path(key).unlink()
+        except OSError:
+            pass
+
+    def _evict_disk(self):
+        """Enforce the disk cap, oldest unpinned clips first"""
+        for pinned in (False, True):
+            excess = self._disk_bytes - self.max_disk_bytes
+            if excess <= 0:
+                return
+            victims = []
+            for key, size in self._disk.items():
+                if excess <= 0:
+                    break
+                if self._pinned(key) == pinned:
+                    victims.append(key)
+                    excess -= size
+            for key in victims:
+                self._unlink(key)
+            self.stats['pinned_evictions' if pinned else 'disk_evictions'] += len(victims)
+
+    def _spill(self, key: str, data: bytes):
+        """Write a clip to the disk tier if it is not already there"""
+        if key in self._disk:
+            return
+        with timed_stage('cache_io'):
+            self._path(key).write_bytes(data)
+        self._disk[key] = len(data)
+        self._disk_bytes += len(data)
+        self._accessed.setdefault(key, time.time())
+        self.stats['spills'] += 1
+        self._evict_disk()
+
+    def _remember(self, key: str, data: bytes):
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory[key])
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        self._memory.move_to_end(key)
+        self._accessed[key] = time.time()
+        while len(self._memory) > self.max_memory_items or self._memory_bytes > self.max_memory_bytes:
+            evicted_key, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self._spill(evicted_key, evicted)
+
+    def _count(self, record: bool, *counters: str):
+        if record:
+            for counter in counters:
+                self.stats[counter] += 1
+
+    def get(self, key: str, record: bool = True) -> Optional[bytes]:
+        """Return the encoded clip, promoting disk hits into memory.
+
+        Only synthesis lookups are recorded in the hit/miss counters; serving a
+        clip that was just generated passes record=False.
+        """
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self._accessed[key] = time.time()
+                self._count(record, 'hits', 'memory_hits')
+                return data
+            if key in self._disk:
+                try:
+                    with timed_stage('cache_io'):
+                        data = self._path(key).read_bytes()
+                except OSError:
+                    self._unlink(key)
+                else:
+                    self._disk.move_to_end(key)
+                    self._remember(key, data)
+                    self._count(record, 'hits', 'disk_hits')
+                    return data
+            elif self.shared:
+                # Another server process may have written the clip
+                try:
+                    data = self._path(key).read_bytes()
+                except OSError:
+                    pass
+                else:
+                    self._disk[key] = len(data)
+                    self._disk_bytes += len(data)
+                    self._remember(key, data)
+                    self._count(record, 'hits', 'disk_hits')
+                    return data
+            self._count(record, 'misses')
+            return None
+
+    def put(self, key: str, data: bytes):
+        """Store an encoded clip in memory, or on disk if it is above the spill threshold"""
+        with self._lock:
+            if self._sweeper is None and self.sweep_seconds > 0:
+                self._sweeper = threading.Thread(target=self._sweep_loop, name="audio-sweeper", daemon=True)
+                self._sweeper.start()
+            self._digests[key] = self.digest(data)
+            if len(data) > self.spill_bytes:
+                self._spill(key, data)
+            else:
+                self._remember(key, data)
+
+    def locate(self, key: str) -> Optional[tuple]:
+        """Find a clip for serving without copying it: (bytes or None, disk path or None, digest).
+
+        Memory hits return the bytes; disk hits return the file path so the server
+        can send it straight from the file, and are not promoted into memory.
+        """
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self._accessed[key] = time.time()
+                if key not in self._digests:
+                    self._digests[key] = self.digest(data)
+                return data, None, self._digests[key]
+            path = self._path(key)
+            try:
+                size = path.stat().st_size
+            except OSError:
+                # Another server process may have evicted or swept the clip
+                if key in self._disk:
+                    self._unlink(key)
+                return None
+            if key not in self._disk:
+                if not self.shared:
+                    return None
+                # Another server process may have written the clip
+                self._disk[key] = size
+                self._disk_bytes += size
+            digest = self._digests.get(key)
+            if digest is None:
+                # Clips indexed from a previous run are hashed the first time they are served
+                try:
+                    with timed_stage('cache_io'):
+                        digest = self.digest(path.read_bytes())
+                except OSError:
+                    self._unlink(key)
+                    return None
+                self._digests[key] = digest
+            self._disk.move_to_end(key)
+            self._accessed[key] = time.time()
+            return None, path, digest
+
+    def retain(self, audio_ids: List[str]):
+        """Pin clips (all formats of each) while a session message refers to them"""
+        with self._lock:
+            for audio_id in audio_ids:
+                clip = audio_id.split('.', 1)[0]
+                self._refs[clip] = self._refs.get(clip, 0) + 1
+
+    def release(self, audio_ids: List[str]):
+        with self._lock:
+            for audio_id in audio_ids:
+                clip = audio_id.split('.', 1)[0]
+                if self._refs.get(clip, 0) > 1:
+                    self._refs[clip] -= 1
+                else:
+                    self._refs.pop(clip, None)
+
+    def sweep(self) -> int:
+        """Drop unpinned clips that have not been used within the TTL; returns how many"""
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            expired = [key for key, accessed in self._accessed.items() if accessed < cutoff and not self._pinned(key)]
+            for key in expired:
+                data = self._memory.pop(key, None)
+                if data is not None:
+                    self._memory_bytes -= len(data)
+                if key in self._disk:
+                    self._unlink(key)
+                self._forget(key)
+            self.stats['expired'] += len(expired)
+            self.stats['sweeps'] += 1
+        return len(expired)
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_seconds)
+            try:
+                expired = self.sweep()
+                if expired:
+                    log(f"🧹 Expired {expired} cached clip(s)")
+            except Exception as e:
+                log(f"⚠️ Audio sweep error: {e}")
+
+    def snapshot(self) -> Dict:
+        """Counters and occupancy for the stats endpoint"""
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'hit_rate': round(self.stats['hits'] / lookups, 3) if lookups else 0.0,
+                'memory_items': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'disk_items': len(self._disk),
+                'disk_bytes': self._disk_bytes,
+                'pinned_clips': len(self._refs),
+                'ttl_seconds': self.ttl_seconds
+            }
+
+audio_cache = AudioCache(
+    AUDIO_CACHE_DIR, AUDIO_CACHE_MEMORY_ITEMS, AUDIO_CACHE_DISK_BYTES,
+    AUDIO_CACHE_MEMORY_BYTES, AUDIO_SPILL_BYTES, AUDIO_TTL_SECONDS, AUDIO_SWEEP_SECONDS, AUDIO_CACHE_SHARED
+)
+
+# Reference uploads only live on disk while their conditioning is computed; files
+# left behind by a crash are removed on the next upload
+UPLOAD_DIR = Path(os.getenv('LUNA_UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'luna_uploads')))
+UPLOAD_MAX_AGE_SECONDS = 3600
+
+def sweep_stale_uploads() -> int:
+    """Delete abandoned reference uploads; returns how many were removed"""
+    removed = 0
+    cutoff = time.time() - UPLOAD_MAX_AGE_SECONDS
+    for entry in UPLOAD_DIR.glob('reference_*'):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                entry.unlink()
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+def message_audio_ids(message: Dict) -> List[str]:
+    """Audio IDs a history message refers to"""
+    audio_ids = list(message.get('audio_chunks') or [])
+    if message.get('audio_file') and message['audio_file'] not in audio_ids:
+        audio_ids.append(message['audio_file'])
+    return audio_ids
+
+# Output audio formats; 'wav' (PCM16 at the model sample rate) is the canonical
+# copy every other format is transcoded from
+AUDIO_FORMATS = {
+    'wav': {'extension': 'wav', 'mimetype': 'audio/wav', 'sample_rate': None},
+    'wav16k': {'extension': '16k.wav', 'mimetype': 'audio/wav', 'sample_rate': 16000},
+    'opus': {'extension': 'ogg', 'mimetype': 'audio/ogg', 'sample_rate': None},
+}
+DEFAULT_AUDIO_FORMAT = os.getenv('LUNA_AUDIO_FORMAT', 'wav')
+ACCEPT_AUDIO_TYPES = {'audio/wav': 'wav', 'audio/x-wav': 'wav', 'audio/ogg': 'opus', 'audio/opus': 'opus'}
+OPUS_BITRATE = os.getenv('LUNA_OPUS_BITRATE', '32000')
+ENCODE_WORKERS = int(os.getenv('LUNA_ENCODE_WORKERS', '2'))
+encode_executor = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="audio-encode")
+AUDIO_MAX_AGE_SECONDS = 31536000  # Audio IDs are content-addressed, so clients may keep clips indefinitely
+audio_responses = Counter('luna_audio_responses_total', 'Audio responses by kind (full, partial, not_modified)', ['kind'])
+audio_sent_bytes = Counter('luna_audio_sent_bytes_total', 'Audio body bytes sent, after range and 304 handling')
+
+# Session settings
+SESSION_COOKIE = 'luna_session'
+SESSION_MAX_MESSAGES = int(os.getenv('LUNA_SESSION_MAX_MESSAGES', '50'))
+SESSION_IDLE_SECONDS = int(os.getenv('LUNA_SESSION_IDLE_SECONDS', '3600'))
+SESSION_MAX_COUNT = int(os.getenv('LUNA_MAX_SESSIONS', '1000'))
+SESSION_DB_PATH = os.getenv('LUNA_SESSION_DB')  # Optional SQLite file for persistent sessions
+
+# Conversation context settings
+CONTEXT_TOKEN_BUDGET = int(os.getenv('LUNA_CONTEXT_TOKEN_BUDGET', '1500'))
+SUMMARY_MAX_WORDS = int(os.getenv('LUNA_SUMMARY_MAX_WORDS', '120'))
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token for English text)"""
+    return len(text) // 4 + 1
+
+@dataclass
+class ConversationSession:
+    """Conversation state for one browser session.
+
+    Alongside the bounded history it tracks a running token count and a rolling
+    summary of the turns that no longer fit the context budget. Messages are
+    addressed by position (the number of messages appended before them), so
+    `summarized` marks how many leading messages the summary already covers.
+    """
+    session_id: str
+    history: deque = field(default_factory=lambda: deque(maxlen=SESSION_MAX_MESSAGES))
+    voice_id: Optional[str] = None
+    last_seen: float = field(default_factory=time.time)
+    token_sizes: deque = field(default_factory=lambda: deque(maxlen=SESSION_MAX_MESSAGES))
+    history_tokens: int = 0
+    appended: int = 0
+    summary: str = ""
+    summarized: int = 0
+    overflow: List = field(default_factory=list)  # (position, message) dropped from history before being summarized
+    summarizing: bool = False
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def append_messages(self, messages: List[Dict]):
+        """Append messages, keeping token counts in step and saving unsummarized evictions"""
+        with self.lock:
+            for message in messages:
+                if len(self.history) == self.history.maxlen:
+                    position = self.appended - len(self.history)
+                    if position >= self.summarized:
+                        self.overflow.append((position, self.history[0]))
+                        del self.overflow[:-SESSION_MAX_MESSAGES]
+                    self.history_tokens -= self.token_sizes[0]
+                    audio_cache.release(message_audio_ids(self.history[0]))
+                audio_cache.retain(message_audio_ids(message))
+                size = estimate_tokens(message['content'])
+                self.history.append(message)
+                self.token_sizes.append(size)
+                self.history_tokens += size
+                self.appended += 1
+
+    def release_audio(self):
+        """Unpin the clips referenced by the history (the session is leaving memory)"""
+        with self.lock:
+            for message in self.history:
+                audio_cache.release(message_audio_ids(message))
+
+    def reset(self):
+        """Forget the conversation, including its summary"""
+        self.release_audio()
+        with self.lock:
+            self.history.clear()
+            self.token_sizes.clear()
+            self.history_tokens = 0
+            self.summary = ""
+            self.summarized = self.appended
+            self.overflow.clear()
+
+class SessionStore:
+    """Per-session conversation state with bounded history and idle eviction.
+
+    The store lock only guards the session map, so concurrent conversations never
+    wait on each other. With a database path, sessions are written through to
+    SQLite and reloaded after eviction or a restart.
+    """
+
+    def __init__(self, idle_seconds: int, max_sessions: int, db_path: Optional[str] = None):
+        self.idle_seconds = idle_seconds
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, ConversationSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY, voice_id TEXT, last_seen REAL
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT, message TEXT
+                );
+                CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id);
+                """
+            )
+            self._db_lock = threading.Lock()
+
+    def get(self, session_id: Optional[str]) -> ConversationSession:
+        """Return the session for an ID, creating a fresh one if it is unknown"""
+        now = time.time()
+        with self._lock:
+            if now - self._last_sweep > 60:
+                self._evict_idle(now)
+            session = self._sessions.get(session_id) if session_id else None
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                session.last_seen = now
+                return session
+        
+        # Read from SQLite without holding the store lock
+        loaded = self._load(session_id) if session_id else None
+        with self._lock:
+            # Another request may have loaded the same session meanwhile
+            session = self._sessions.get(loaded.session_id) if loaded is not None else None
+            if session is None:
+                session = loaded or ConversationSession(session_id=uuid.uuid4().hex)
+                self._sessions[session.session_id] = session
+            elif loaded is not None:
+                loaded.release_audio()
+            self._sessions.move_to_end(session.session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)[1].release_audio()
+        session.last_seen = now
+        return session
+
+    def _evict_idle(self, now: float):
+        self._last_sweep = now
+        expired = [sid for sid, session in self._sessions.items() if now - session.last_seen > self.idle_seconds]
+        for session_id in expired:
+            self._sessions.pop(session_id).release_audio()
+        if expired:
+            log(f"🧹 Evicted {len(expired)} idle session(s)")
+
+    def _load(self, session_id: str) -> Optional[ConversationSession]:
+        if self._db is None:
+            return None
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT voice_id FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            messages = self._db.execute(
+                "SELECT message FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, SESSION_MAX_MESSAGES)
+            ).fetchall()
+        session = ConversationSession(session_id=session_id, voice_id=row[0])
+        session.append_messages([json.loads(message) for (message,) in reversed(messages)])
+        return session
+
+    def _save(self, session: ConversationSession, new_messages: List[Dict] = ()):
+        if self._db is None:
+            return
+        with self._db_lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, voice_id, last_seen) VALUES (?, ?, ?)",
+                (session.session_id, session.voice_id, session.last_seen)
+            )
+            self._db.executemany(
+                "INSERT INTO messages (session_id, message) VALUES (?, ?)",
+                [(session.session_id, json.dumps(message)) for message in new_messages]
+            )
+            if new_messages:
+                # Only the most recent messages are ever reloaded
+                self._db.execute(
+                    "DELETE FROM messages WHERE session_id = ? AND id NOT IN "
+                    "(SELECT id FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?)",
+                    (session.session_id, session.session_id, SESSION_MAX_MESSAGES)
+                )
+
+    def add_turn(self, session: ConversationSession, user_input: str, ai_response: str,
+                 audio_id: Optional[str] = None, audio_chunks: Optional[List[str]] = None):
+        """Append a user/assistant exchange to the session history and return the assistant message"""
+        timestamp = datetime.now().isoformat()
+        messages = [
+            {
+                'type': 'user',
+                'content': user_input,
+                'timestamp': timestamp
+            },
+            {
+                'type': 'assistant',
+                'content': ai_response,
+                'timestamp': timestamp,
+                'audio_file': audio_id if audio_id else None
+            }
+        ]
+        if audio_chunks is not None:
+            messages[1]['audio_chunks'] = audio_chunks
+        session.append_messages(messages)
+        self._save(session, messages)
+        return messages[1]
+
+    def attach_audio(self, session: ConversationSession, message: Dict, audio_id: str) -> bool:
+        """Add a clip that finished after its turn was recorded; False if the message has left the history"""
+        with session.lock:
+            if not any(entry is message for entry in session.history):
+                return False
+            stored = json.dumps(message)
+            message['audio_file'] = audio_id
+            audio_cache.retain([audio_id])
+        if self._db is not None:
+            with self._db_lock, self._db:
+                self._db.execute(
+                    "UPDATE messages SET message = ? WHERE session_id = ? AND message = ?",
+                    (json.dumps(message), session.session_id, stored)
+                )
+        return True
+
+    def set_voice(self, session: ConversationSession, voice_id: Optional[str]):
+        """Use a cloned voice for this session's replies"""
+        session.voice_id = voice_id
+        self._save(session)
+
+    def clear(self, session: ConversationSession):
+        """Forget this session's conversation"""
+        session.reset()
+        if self._db is not None:
+            with self._db_lock, self._db:
+                self._db.execute("DELETE FROM messages WHERE session_id = ?", (session.session_id,))
+
+    def snapshot(self) -> Dict:
+        """Occupancy for the stats endpoint"""
+        with self._lock:
+            return {
+                'active': len(self._sessions),
+                'messages': sum(len(session.history) for session in self._sessions.values()),
+                'history_tokens': sum(session.history_tokens for session in self._sessions.values()),
+                'persistent': self._db is not None
+            }
+
+session_store = SessionStore(SESSION_IDLE_SECONDS, SESSION_MAX_COUNT, SESSION_DB_PATH)
+
+# TTS scheduler settings
+TTS_MAX_BATCH = int(os.getenv('LUNA_TTS_MAX_BATCH', '8'))
+TTS_MAX_WAIT_SECONDS = float(os.getenv('LUNA_TTS_MAX_WAIT_MS', '10')) / 1000
+
+class TTSScheduler:
+    """Single synthesis worker that coalesces concurrent TTS requests into micro-batches.
+
+    Requests arriving within max_wait of each other are grouped by voice, so the
+    model's conditionals are swapped once per group and the lock is taken once
+    per group rather than per request. Identical texts in a batch are synthesized
+    once, and the whole batch runs under torch.inference_mode.
+    """
+
+    def __init__(self, max_batch: int, max_wait: float):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = {'requests': 0, 'batches': 0, 'synthesized': 0, 'coalesced': 0, 'errors': 0, 'busy_seconds': 0.0}
+        self._queue: queue.Queue = queue.Queue()
+        self._completed: deque = deque()
+        self._worker: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, text: str, voice_key: Optional[str], conds) -> Future:
+        """Queue text for synthesis; the future resolves to the waveform tensor"""
+        future: Future = Future()
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="tts-scheduler", daemon=True)
+                self._worker.start()
+            self.stats['requests'] += 1
+        self._queue.put((text, voice_key, conds, future, request_id_var.get()))
+        return future
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def _collect(self) -> List:
+        """Block for one request, then gather more until the batch is full or the window closes"""
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            start = time.perf_counter()
+            
+            # voice -> (conds, text -> futures waiting on that text)
+            groups: Dict[Optional[str], tuple] = {}
+            owners: Dict[Future, Optional[str]] = {}
+            for text, voice_key, conds, future, request_id in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue  # The caller gave up waiting
+                group = groups.setdefault(voice_key, (conds, {}))
+                group[1].setdefault(text, []).append(future)
+                owners[future] = request_id
+            
+            synthesized = 0
+            for conds, texts in groups.values():
+                with tts_lock, torch.inference_mode():
+                    tts_model.conds = conds
+                    for text, futures in texts.items():
+                        try:
+                            with torch_trace.capture('generate', [owners[future] for future in futures if owners[future]]):
+                                wav = tts_model.generate(text)
+                        except Exception as e:
+                            self.stats['errors'] += 1
+                            errors_total.inc(stage='tts')
+                            for future in futures:
+                                future.set_exception(e)
+                            continue
+                        synthesized += 1
+                        for future in futures:
+                            future.set_result(wav)
+            
+            now = time.perf_counter()
+            with self._lock:
+                self.stats['batches'] += 1
+                self.stats['synthesized'] += synthesized
+                self.stats['coalesced'] += len(batch) - sum(len(texts) for _, texts in groups.values())
+                self.stats['busy_seconds'] += now - start
+                self._completed.extend([now] * len(batch))
+            if len(batch) > 1:
+                request_ids = ", ".join(sorted({item[4] for item in batch if item[4]}))
+                log(f"📦 TTS batch: {len(batch)} request(s), {len(groups)} voice(s) in {now - start:.2f}s [{request_ids}]")
+
+    def snapshot(self) -> Dict:
+        """Throughput metrics for the stats endpoint"""
+        now = time.perf_counter()
+        with self._lock:
+            while self._completed and now - self._completed[0] > 60:
+                self._completed.popleft()
+            batches = self.stats['batches']
+            return {
+                **self.stats,
+                'busy_seconds': round(self.stats['busy_seconds'], 3),
+                'queue_depth': self.queue_depth(),
+                'avg_batch_size': round((self.stats['requests'] - self.queue_depth()) / batches, 2) if batches else 0.0,
+                'requests_per_second': round(len(self._completed) / 60, 3),
+                'max_batch': self.max_batch,
+                'max_wait_ms': self.max_wait * 1000
+            }
+
+tts_scheduler = TTSScheduler(TTS_MAX_BATCH, TTS_MAX_WAIT_SECONDS)
+
+# Multi-process TTS on CPU: 0 keeps synthesis on the in-process scheduler
+TTS_WORKERS = int(os.getenv('LUNA_TTS_WORKERS', '0'))
+TTS_WORKER_THREADS = int(os.getenv('LUNA_TTS_WORKER_THREADS', '0'))  # 0 splits the cores evenly
+TTS_QUEUE_SIZE = int(os.getenv('LUNA_TTS_QUEUE_SIZE', '32'))
+TTS_QUEUE_TIMEOUT_SECONDS = float(os.getenv('LUNA_TTS_QUEUE_TIMEOUT_MS', '2000')) / 1000
+TTS_TASK_TIMEOUT_SECONDS = float(os.getenv('LUNA_TTS_TASK_TIMEOUT_SECONDS', '120'))
+TTS_WORKER_START_TIMEOUT_SECONDS = float(os.getenv('LUNA_TTS_WORKER_START_TIMEOUT_SECONDS', '600'))
+TTS_WORKER_START_ATTEMPTS = int(os.getenv('LUNA_TTS_WORKER_START_ATTEMPTS', '3'))  # Startup crashes before a worker is marked failed
+TTS_RESTART_BACKOFF_SECONDS = 1.0  # Doubles after each startup crash
+TTS_RESTART_BACKOFF_MAX_SECONDS = 60.0
+TTS_RESULT_TIMEOUT_SECONDS = float(os.getenv('LUNA_TTS_RESULT_TIMEOUT_SECONDS', '300'))  # Longest a request waits for its audio
+
+class TTSOverloadedError(RuntimeError):
+    """The synthesis queue stayed full for longer than the queue timeout"""
+
+def _tts_worker_main(worker_id: int, shared_weights: Dict, threads: int, warmup: bool, tasks, results):
+    """Entry point of a TTS worker process.
+
+    The model is built from the local checkpoint, then its modules adopt the
+    parent's shared-memory weights and the private copy is freed, so N workers
+    hold one copy of the parameters once they have started.
+    """
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    try:
+        model = create_tts_model(device="cpu")
+        for name, state in shared_weights.items():
+            getattr(model, name).load_state_dict(state, assign=True)
+        # Quantized layers are private to each worker; the shared copy stays fp32
+        optimize_tts_model(model)
+        default = model.conds
+        if warmup:
+            with torch.inference_mode():
+                model.generate(TTS_WARMUP_TEXT)
+    except Exception as e:
+        results.put(('failed', worker_id, None, str(e)))
+        return
+    results.put(('ready', worker_id, None, os.getpid()))
+    
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task_id, text, conds = task
+        try:
+            with torch.inference_mode():
+                model.conds = conds if conds is not None else default
+                wav = model.generate(text)
+            results.put(('done', worker_id, task_id, wav.numpy()))
+        except Exception as e:
+            results.put(('error', worker_id, task_id, str(e)))
+
+class TTSProcessPool:
+    """Process pool that spreads synthesis across CPU cores.
+
+    Offers the same submit()/snapshot() interface as TTSScheduler. Model weights
+    are moved to shared memory in the parent and adopted by every worker.
+    Workers start one at a time, so only one private checkpoint copy exists
+    while loading instead of one per worker. A
+    bounded queue provides backpressure: submit() fails with TTSOverloadedError
+    when it stays full. A supervisor thread collects results, fails the requests
+    of a worker that died or overran the task timeout, and restarts it. A worker
+    that crashes while starting is restarted with exponential backoff and is
+    marked failed after TTS_WORKER_START_ATTEMPTS crashes.
+    """
+
+    def __init__(self, workers: int, threads_per_worker: int, queue_size: int):
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        self.stats = {'requests': 0, 'completed': 0, 'errors': 0, 'rejected': 0, 'restarts': 0, 'timeouts': 0}
+        self._pending: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._idle: queue.Queue = queue.Queue()
+        self._processes: Dict[int, object] = {}
+        self._tasks: Dict[int, object] = {}
+        self._state: Dict[int, str] = {}
+        self._generation: Dict[int, int] = {}
+        self._running: Dict[int, tuple] = {}  # worker -> (task ID, future, start)
+        self._task_ids = iter(range(1, 1 << 62))
+        self._to_start: List[int] = []  # Workers not spawned yet
+        self._start_crashes: Dict[int, int] = {}  # worker -> crashes since it was last ready
+        self._restart_at: Dict[int, float] = {}  # worker -> when a backed-off restart is due
+        self._closing = False
+        self._lock = threading.Lock()
+        self._state_changed = threading.Condition(self._lock)
+
+    def start(self, model):
+        """Share the loaded model's weights and spawn the workers"""
+        import torch.multiprocessing as torch_mp
+        self._context = torch_mp.get_context('spawn')
+        self._results = self._context.Queue()
+        self._shared_weights = {}
+        for name, module in vars(model).items():
+            if isinstance(module, torch.nn.Module):
+                module.share_memory()
+                self._shared_weights[name] = module.state_dict()
+        self._to_start = list(range(1, self.workers))
+        self._spawn(0)
+        threading.Thread(target=self._dispatch, name="tts-dispatch", daemon=True).start()
+        threading.Thread(target=self._supervise, name="tts-supervisor", daemon=True).start()
+        log(f"🧵 TTS pool: {self.workers} worker process(es) x {self.threads_per_worker} thread(s)")
+
+    def _spawn(self, worker_id: int):
+        tasks = self._context.Queue()
+        process = self._context.Process(
+            target=_tts_worker_main,
+            args=(worker_id, self._shared_weights, self.threads_per_worker, TTS_WARMUP, tasks, self._results),
+            name=f"tts-worker-{worker_id}",
+            daemon=True
+        )
+        process.start()
+        with self._lock:
+            self._processes[worker_id] = process
+            self._tasks[worker_id] = tasks
+            self._state[worker_id] = 'starting'
+            self._generation[worker_id] = self._generation.get(worker_id, -1) + 1
+
+    def _usable(self) -> bool:
+        """Whether any worker is running or still to start (call with the lock held)"""
+        return bool(self._to_start) or any(state != 'failed' for state in self._state.values())
+
+    def wait_ready(self, timeout: float) -> bool:
+        """Block until a worker is ready; False if all failed to load or the timeout passed"""
+        with self._state_changed:
+            self._state_changed.wait_for(
+                lambda: 'ready' in self._state.values() or 'busy' in self._state.values() or not self._usable(),
+                timeout=timeout
+            )
+            return 'ready' in self._state.values() or 'busy' in self._state.values()
+
+    def submit(self, text: str, voice_key: Optional[str], conds) -> Future:
+        """Queue text for synthesis; the future resolves to the waveform tensor"""
+        future: Future = Future()
+        with self._lock:
+            self.stats['requests'] += 1
+            if not self._usable():
+                future.set_exception(RuntimeError("No TTS worker is available"))
+                return future
+        try:
+            # The default voice is already loaded in every worker
+            self._pending.put((text, conds if voice_key else None, future), timeout=TTS_QUEUE_TIMEOUT_SECONDS)
+        except queue.Full:
+            with self._lock:
+                self.stats['rejected'] += 1
+            future.set_exception(TTSOverloadedError(f"TTS queue full ({self._pending.maxsize} waiting)"))
+        return future
+
+    def queue_depth(self) -> int:
+        return self._pending.qsize()
+
+    def _dispatch(self):
+        """Hand queued requests to idle workers, one task per worker at a time"""
+        while True:
+            text, conds, future = self._pending.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            while True:
+                try:
+                    worker_id, generation = self._idle.get(timeout=1.0)
+                except queue.Empty:
+                    with self._lock:
+                        usable = self._usable()
+                    if usable:
+                        continue
+                    future.set_exception(RuntimeError("No TTS worker is available"))
+                    break
+                with self._lock:
+                    if self._generation[worker_id] != generation or self._state[worker_id] != 'ready':
+                        continue  # The worker was restarted since it became idle
+                    task_id = next(self._task_ids)
+                    self._state[worker_id] = 'busy'
+                    self._running[worker_id] = (task_id, future, time.perf_counter())
+                    tasks = self._tasks[worker_id]
+                tasks.put((task_id, text, conds))
+                break
+
+    def _finish(self, worker_id: int, task_id: int, outcome, failed: bool):
+        with self._lock:
+            running = self._running.get(worker_id)
+            if running is None or running[0] != task_id:
+                return
+            del self._running[worker_id]
+            self._state[worker_id] = 'ready'
+            self.stats['errors' if failed else 'completed'] += 1
+            self._idle.put((worker_id, self._generation[worker_id]))
+        if failed:
+            running[1].set_exception(RuntimeError(outcome))
+        else:
+            running[1].set_result(torch.from_numpy(outcome))
+
+    def _start_next(self):
+        """Spawn the next worker that has not started yet; workers load one at a time"""
+        with self._lock:
+            if not self._to_start or self._closing:
+                return
+            worker_id = self._to_start.pop(0)
+        self._spawn(worker_id)
+
+    def _mark_failed(self, worker_id: int, reason: str):
+        with self._lock:
+            self._state[worker_id] = 'failed'
+            self._restart_at.pop(worker_id, None)
+            usable = self._usable()
+            self._state_changed.notify_all()
+        log(f"❌ TTS worker {worker_id} failed to start: {reason}")
+        errors_total.inc(stage='tts_worker')
+        if not usable and model_status['tts']['state'] == 'ready':
+            # Replies fall back to text instead of queueing for workers that do not exist
+            model_status['tts'] = {'state': 'failed', 'error': 'All TTS workers failed to start'}
+        self._start_next()
+
+    def _supervise(self):
+        while True:
+            try:
+                kind, worker_id, task_id, payload = self._results.get(timeout=1.0)
+            except queue.Empty:
+                kind = None
+            if kind == 'ready':
+                with self._lock:
+                    self._state[worker_id] = 'ready'
+                    self._start_crashes.pop(worker_id, None)
+                    self._idle.put((worker_id, self._generation[worker_id]))
+                    self._state_changed.notify_all()
+                log(f"✅ TTS worker {worker_id} ready (pid {payload})")
+                self._start_next()
+            elif kind == 'failed':
+                self._mark_failed(worker_id, payload)
+            elif kind in ('done', 'error'):
+                self._finish(worker_id, task_id, payload, failed=kind == 'error')
+            self._check_workers()
+
+    def _check_workers(self):
+        """Restart workers that exited or are stuck past the task timeout (not those that failed to load)"""
+        now = time.perf_counter()
+        for worker_id, process in list(self._processes.items()):
+            with self._lock:
+                running = self._running.get(worker_id)
+                state = self._state[worker_id]
+                restart_at = self._restart_at.get(worker_id)
+            if self._closing or state == 'failed':
+                continue
+            if state == 'backoff':
+                if now >= restart_at:
+                    with self._lock:
+                        del self._restart_at[worker_id]
+                    log(f"♻️ Restarting TTS worker {worker_id}")
+                    self._spawn(worker_id)
+                continue
+            overran = running is not None and now - running[2] > TTS_TASK_TIMEOUT_SECONDS
+            if process.is_alive() and not overran:
+                continue
+            if overran:
+                with self._lock:
+                    self.stats['timeouts'] += 1
+                process.terminate()
+            process.join(timeout=5)
+            with self._lock:
+                running = self._running.pop(worker_id, None)
+                self.stats['restarts'] += 1
+            if running is not None:
+                running[1].set_exception(RuntimeError(f"TTS worker {worker_id} stopped mid-synthesis"))
+            errors_total.inc(stage='tts_worker')
+            if state != 'starting':
+                log(f"♻️ Restarting TTS worker {worker_id} (exit code {process.exitcode})")
+                self._spawn(worker_id)
+                continue
+            
+            # Crashed while loading: back off, and give up after repeated crashes
+            with self._lock:
+                crashes = self._start_crashes.get(worker_id, 0) + 1
+                self._start_crashes[worker_id] = crashes
+            if crashes >= TTS_WORKER_START_ATTEMPTS:
+                self._mark_failed(worker_id, f"crashed {crashes} time(s) while loading (exit code {process.exitcode})")
+                continue
+            delay = min(TTS_RESTART_BACKOFF_MAX_SECONDS, TTS_RESTART_BACKOFF_SECONDS * 2 ** (crashes - 1))
+            with self._lock:
+                self._state[worker_id] = 'backoff'
+                self._restart_at[worker_id] = now + delay
+            log(f"⚠️ TTS worker {worker_id} crashed while loading (exit code {process.exitcode}), "
+                f"restarting in {delay:.1f}s ({crashes}/{TTS_WORKER_START_ATTEMPTS})")
+
+    def worker_states(self) -> Dict[str, str]:
+        """State of each worker slot, for /ready"""
+        with self._lock:
+            return {str(worker_id): state for worker_id, state in sorted(self._state.items())}
+
+    def close(self, timeout: float = 10.0):
+        """Stop the workers once they finish their current task"""
+        self._closing = True
+        for tasks in self._tasks.values():
+            tasks.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self._processes.values():
+            process.join(timeout=max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+
+    def snapshot(self) -> Dict:
+        """Worker states and counters for the stats endpoint"""
+        with self._lock:
+            return {
+                **self.stats,
+                'queue_depth': self.queue_depth(),
+                'queue_size': self._pending.maxsize,
+                'threads_per_worker': self.threads_per_worker,
+                'workers': [
+                    {'id': worker_id, 'pid': process.pid, 'state': self._state[worker_id]}
+                    for worker_id, process in self._processes.items()
+                ]
+            }
+
+# Asynchronous chat job settings
+JOB_WORKERS = int(os.getenv('LUNA_JOB_WORKERS', '4'))
+JOB_RETENTION_SECONDS = int(os.getenv('LUNA_JOB_RETENTION_SECONDS', '600'))
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="chat-job")
+
+@dataclass
+class ChatJob:
+    """Progress of a chat turn whose voice reply is synthesized in the background"""
+    job_id: str
+    stage: str = 'queued'
+    stages: Dict[str, float] = field(default_factory=dict)
+    audio_id: Optional[str] = None
+    error: Optional[str] = None
+    created: float = field(default_factory=time.time)
+
+    @property
+    def finished(self) -> bool:
+        return self.stage in ('done', 'failed')
+
+    def to_dict(self) -> Dict:
+        data = {
+            'job_id': self.job_id,
+            'stage': self.stage,
+            'stages': self.stages,
+            'audio_available': bool(self.audio_id)
+        }
+        if self.audio_id:
+            data['audio_url'] = f'/audio/{self.audio_id}'
+        if self.error:
+            data['error'] = self.error
+        return data
+
+class JobStore:
+    """Tracks chat jobs and wakes up SSE listeners when a job changes stage"""
+
+    def __init__(self, retention_seconds: int):
+        self.retention_seconds = retention_seconds
+        self._jobs: Dict[str, ChatJob] = {}
+        self._changed = threading.Condition()
+
+    def create(self) -> ChatJob:
+        job = ChatJob(job_id=uuid.uuid4().hex)
+        job.stages['queued'] = job.created
+        with self._changed:
+            self._expire()
+            self._jobs[job.job_id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[ChatJob]:
+        with self._changed:
+            return self._jobs.get(job_id)
+
+    def update(self, job: ChatJob, stage: str, **changes):
+        """Move a job to a new stage and notify listeners"""
+        with self._changed:
+            job.stage = stage
+            job.stages[stage] = time.time()
+            for name, value in changes.items():
+                setattr(job, name, value)
+            self._changed.notify_all()
+
+    def wait(self, job: ChatJob, stage: str, timeout: float) -> str:
+        """Block until the job leaves the given stage (or the timeout passes) and return its stage"""
+        with self._changed:
+            self._changed.wait_for(lambda: job.stage != stage, timeout=timeout)
+            return job.stage
+
+    def wait_idle(self, timeout: float) -> bool:
+        """Block until every tracked job has finished; False if the timeout passed first"""
+        with self._changed:
+            return self._changed.wait_for(lambda: all(job.finished for job in self._jobs.values()), timeout=timeout)
+
+    def _expire(self):
+        cutoff = time.time() - self.retention_seconds
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished and job.created < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def snapshot(self) -> Dict:
+        with self._changed:
+            stages: Dict[str, int] = {}
+            for job in self._jobs.values():
+                stages[job.stage] = stages.get(job.stage, 0) + 1
+            return {'tracked': len(self._jobs), 'stages': stages, 'workers': JOB_WORKERS}
+
+job_store = JobStore(JOB_RETENTION_SECONDS)
+
+# Speech-to-text and LLM backend selection: groq, fake (offline stand-in) or local (CPU models)
+STT_BACKEND = os.getenv('LUNA_STT_BACKEND', 'groq')
+LLM_BACKEND = os.getenv('LUNA_LLM_BACKEND', 'groq')
+FAKE_LATENCY_SECONDS = float(os.getenv('LUNA_FAKE_LATENCY_MS', '200')) / 1000
+FAKE_TOKEN_LATENCY_SECONDS = float(os.getenv('LUNA_FAKE_TOKEN_LATENCY_MS', '20')) / 1000
+FAKE_TRANSCRIPT = os.getenv('LUNA_FAKE_TRANSCRIPT', "I've had a really long day and I'm feeling a bit overwhelmed.")
+LOCAL_WHISPER_MODEL = os.getenv('LUNA_LOCAL_WHISPER_MODEL', 'base')
+LOCAL_LLM_MODEL = os.getenv('LUNA_LOCAL_LLM_MODEL', 'Qwen/Qwen2.5-0.5B-Instruct')
+LLM_MAX_TOKENS = 150
+
+# Backend call policy: connection pooling, timeouts, retries, hedging and a circuit breaker
+HTTP_MAX_CONNECTIONS = int(os.getenv('LUNA_HTTP_MAX_CONNECTIONS', '32'))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv('LUNA_HTTP_KEEPALIVE_SECONDS', '60'))
+STT_TIMEOUT_SECONDS = float(os.getenv('LUNA_STT_TIMEOUT_SECONDS', '30'))
+LLM_TIMEOUT_SECONDS = float(os.getenv('LUNA_LLM_TIMEOUT_SECONDS', '20'))
+BACKEND_ATTEMPTS = int(os.getenv('LUNA_BACKEND_ATTEMPTS', '3'))
+BACKOFF_BASE_SECONDS = float(os.getenv('LUNA_BACKOFF_BASE_MS', '200')) / 1000
+BACKOFF_MAX_SECONDS = 2.0
+BACKEND_HEDGE = os.getenv('LUNA_BACKEND_HEDGE', '0') == '1'  # Send a second request when the first is slower than p95
+HEDGE_MIN_SAMPLES = 20
+BREAKER_FAILURES = int(os.getenv('LUNA_BREAKER_FAILURES', '5'))  # Consecutive failed calls that open the circuit
+BREAKER_RESET_SECONDS = float(os.getenv('LUNA_BREAKER_RESET_SECONDS', '30'))
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+backend_calls = Counter('luna_backend_calls_total', 'STT/LLM backend calls by outcome', ['backend', 'outcome'])
+backend_seconds = Histogram('luna_backend_attempt_duration_seconds', 'Successful backend attempt latency', ['backend'])
+# Hedged calls run both requests here; sized so every pooled connection can be in use
+hedge_executor = ThreadPoolExecutor(max_workers=2 * HTTP_MAX_CONNECTIONS, thread_name_prefix="backend-hedge")
+_http_client = None
+_http_client_lock = threading.Lock()
+
+def shared_http_client():
+    """One keep-alive connection pool shared by every Groq client"""
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            import httpx
+            _http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                    keepalive_expiry=HTTP_KEEPALIVE_SECONDS
+                )
+            )
+        return _http_client
+
+class CircuitOpenError(RuntimeError):
+    """The backend failed repeatedly and calls are being short-circuited"""
+
+def is_retryable(error: Exception) -> bool:
+    """Timeouts, connection failures, rate limits and server errors are worth another attempt"""
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    name = type(error).__name__
+    return isinstance(error, (TimeoutError, ConnectionError)) or 'Timeout' in name or 'Connection' in name
+
+class CircuitBreaker:
+    """Opens after consecutive failures and lets a single trial call through once the reset time has passed"""
+
+    def __init__(self, failures: int, reset_seconds: float):
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self.state = 'half_open'
+                return True
+            return self.state == 'closed'
+
+    def record(self, success: bool):
+        with self._lock:
+            if success:
+                self.state = 'closed'
+                self._consecutive = 0
+                return
+            self._consecutive += 1
+            if self.state == 'half_open' or self._consecutive >= self.failures:
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+
+    def abandon(self):
+        """The caller gave up on a call without an outcome; a pending trial goes back to the open state.
+
+        The reset time has already passed, so the next call becomes the new trial.
+        """
+        with self._lock:
+            if self.state == 'half_open':
+                self.state = 'open'
+
+class BackendCaller:
+    """Runs calls to one backend with jittered retries, optional hedging and a circuit breaker.
+
+    Only transient errors are retried. With hedging on, an attempt still running
+    after the backend's recent p95 latency gets a duplicate request and the first
+    success wins; an attempt fails only once both requests have. Hedging is only
+    used for idempotent calls. Streams are retried only if they fail before the
+    first piece arrives.
+    """
+
+    def __init__(self, name: str, attempts: int, hedge: bool):
+        self.name = name
+        self.attempts = max(1, attempts)
+        self.hedge = hedge
+        self.breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET_SECONDS)
+        self._latencies: deque = deque(maxlen=200)
+
+    def _count(self, outcome: str):
+        backend_calls.inc(backend=self.name, outcome=outcome)
+
+    def _observe(self, seconds: float):
+        self._latencies.append(seconds)
+        backend_seconds.observe(seconds, backend=self.name)
+
+    def _hedge_delay(self) -> Optional[float]:
+        if not self.hedge or len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return percentile(sorted(self._latencies), 0.95)
+
+    def _backoff(self, attempt: int):
+        self._count('retry')
+        time.sleep(random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)))
+
+    def _check_circuit(self):
+        if not self.breaker.allow():
+            self._count('circuit_open')
+            raise CircuitOpenError(f"{self.name} backend is unavailable (circuit open)")
+
+    def _finish(self, error: Optional[Exception]):
+        # Client errors say nothing about the backend's health
+        self.breaker.record(error is None or not is_retryable(error))
+        self._count('success' if error is None else 'error')
+
+    def _attempt(self, function, args):
+        start = time.perf_counter()
+        delay = self._hedge_delay()
+        if delay is None:
+            result = function(*args)
+            self._observe(time.perf_counter() - start)
+            return result
+
+        # Each attempt gets its own copy of the context; one context cannot run on two threads at once
+        primary = hedge_executor.submit(in_context(function), *args)
+        pending = {primary}
+        done, _ = wait(pending, timeout=delay)
+        if not done:
+            self._count('hedge')
+            pending.add(hedge_executor.submit(in_context(function), *args))
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not primary:
+                        self._count('hedge_won')
+                    self._observe(time.perf_counter() - start)
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def call(self, function, *args):
+        """Call function(*args) under the retry policy"""
+        self._check_circuit()
+        error = None
+        for attempt in range(self.attempts):
+            if attempt:
+                self._backoff(attempt)
+            try:
+                result = self._attempt(function, args)
+            except Exception as e:
+                error = e
+                if not is_retryable(e):
+                    break
+                continue
+            self._finish(None)
+            return result
+        self._finish(error)
+        raise error
+
+    def stream(self, function, *args):
+        """Yield from function(*args), retrying if it fails before producing anything"""
+        self._check_circuit()
+        error = None
+        started = False
+        recorded = False
+        try:
+            for attempt in range(self.attempts):
+                if attempt:
+                    self._backoff(attempt)
+                start = time.perf_counter()
+                try:
+                    for piece in function(*args):
+                        if not started:
+                            self._observe(time.perf_counter() - start)
+                            started = True
+                        yield piece
+                except Exception as e:
+                    error = e
+                    if started or not is_retryable(e):
+                        break
+                    continue
+                recorded = True
+                self._finish(None)
+                return
+            recorded = True
+            self._finish(error)
+            raise error
+        finally:
+            if not recorded:
+                # The consumer stopped iterating (the client disconnected) or the call was
+                # interrupted; either way a half-open trial must not be left pending
+                if started:
+                    self._finish(None)
+                else:
+                    self.breaker.abandon()
+
+    def snapshot(self) -> Dict:
+        latencies = sorted(self._latencies)
+        return {
+            'circuit': self.breaker.state,
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'hedging': self.hedge
+        }
+
+stt_caller = BackendCaller('stt', BACKEND_ATTEMPTS, BACKEND_HEDGE)
+llm_caller = BackendCaller('llm', BACKEND_ATTEMPTS, BACKEND_HEDGE)
+
+class STTBackend:
+    """Speech-to-text backend interface"""
+
+    name = "base"
+
+    def transcribe(self, audio_bytes: bytes, filename: str) -> str:
+        raise NotImplementedError
+
+class LLMBackend:
+    """Chat LLM backend interface; messages are dicts with `role` and `content`"""
+
+    name = "base"
+
+    def invoke(self, messages: List[Dict]) -> str:
+        raise NotImplementedError
+
+    def stream(self, messages: List[Dict]):
+        """Yield the reply in pieces; backends without streaming yield it whole"""
+        yield self.invoke(messages)
+
+def require_groq_api_key() -> str:
+    groq_api_key = os.getenv('GROQ_API_KEY')
+    if not groq_api_key:
+        log("⚠️ GROQ_API_KEY not found in environment variables")
+        log("Please set your Groq API key: export GROQ_API_KEY='your_key_here'")
+        raise RuntimeError("GROQ_API_KEY is not set")
+    return groq_api_key
+
+class GroqSTT(STTBackend):
+    """Groq Whisper transcription"""
+
+    name = "groq"
+
+    def __init__(self):
+        from groq import Groq
+        self.client = Groq(
+            api_key=require_groq_api_key(),
+            http_client=shared_http_client(),
+            timeout=STT_TIMEOUT_SECONDS,
+            max_retries=0  # Retries are handled by stt_caller
+        )
+
+    def transcribe(self, audio_bytes: bytes, filename: str) -> str:
+        return self.client.audio.transcriptions.create(
+            file=(filename, audio_bytes),
+            model="whisper-large-v3-turbo",
+            response_format="text"
+        )
+
+class GroqLLM(LLMBackend):
+    """Groq-hosted Llama through LangChain's ChatGroq"""
+
+    name = "groq"
+
+    def __init__(self):
+        from langchain.schema import AIMessage, HumanMessage, SystemMessage
+        from langchain_groq import ChatGroq
+        self.message_types = {'system': SystemMessage, 'user': HumanMessage, 'assistant': AIMessage}
+        self.client = ChatGroq(
+            groq_api_key=require_groq_api_key(),
+            model_name="llama-3.3-70b-versatile",  # Updated model name
+            temperature=0.7,
+            max_tokens=LLM_MAX_TOKENS,
+            http_client=shared_http_client(),
+            request_timeout=LLM_TIMEOUT_SECONDS,
+            max_retries=0  # Retries are handled by llm_caller
+        )
+
+    def _convert(self, messages: List[Dict]) -> List:
+        return [self.message_types[message['role']](content=message['content']) for message in messages]
+
+    def invoke(self, messages: List[Dict]) -> str:
+        return self.client.invoke(self._convert(messages)).content
+
+    def stream(self, messages: List[Dict]):
+        for chunk in self.client.stream(self._convert(messages)):
+            if chunk.content:
+                yield chunk.content
+
+class FakeSTT(STTBackend):
+    """Deterministic offline stand-in: a fixed transcript after a fixed latency"""
+
+    name = "fake"
+
+    def transcribe(self, audio_bytes: bytes, filename: str) -> str:
+        time.sleep(FAKE_LATENCY_SECONDS)
+        return FAKE_TRANSCRIPT
+
+class FakeLLM(LLMBackend):
+    """Deterministic offline stand-in that echoes the user's last message.
+
+    The reply arrives after a fixed latency and streams word by word with a fixed
+    per-token delay, so load tests are reproducible without network access.
+    """
+
+    name = "fake"
+
+    def _reply(self, messages: List[Dict]) -> str:
+        last_user = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), "")
+        echo = " ".join(last_user.split()[:30])
+        return f"I hear you. You said: {echo} Thank you for sharing that with me. How are you feeling about it now?"
+
+    def invoke(self, messages: List[Dict]) -> str:
+        time.sleep(FAKE_LATENCY_SECONDS)
+        return self._reply(messages)
+
+    def stream(self, messages: List[Dict]):
+        time.sleep(FAKE_LATENCY_SECONDS)
+        words = self._reply(messages).split(" ")
+        for index, word in enumerate(words):
+            time.sleep(FAKE_TOKEN_LATENCY_SECONDS)
+            yield word if index == 0 else f" {word}"
+
+class LocalWhisperSTT(STTBackend):
+    """On-prem transcription with faster-whisper on the CPU (optional dependency)"""
+
+    name = "local"
+
+    def __init__(self):
+        from faster_whisper import WhisperModel
+        self.model = WhisperModel(LOCAL_WHISPER_MODEL, device="cpu", compute_type="int8")
+
+    def transcribe(self, audio_bytes: bytes, filename: str) -> str:
+        segments, _ = self.model.transcribe(io.BytesIO(audio_bytes))
+        return " ".join(segment.text.strip() for segment in segments)
+
+class LocalLLM(LLMBackend):
+    """On-prem chat model through Hugging Face transformers on the CPU (optional dependency).
+
+    Decoding is greedy, so replies are deterministic for a given prompt.
+    """
+
+    name = "local"
+
+    def __init__(self):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(LOCAL_LLM_MODEL)
+        self.model = AutoModelForCausalLM.from_pretrained(LOCAL_LLM_MODEL, torch_dtype=torch.float32)
+        self._lock = threading.Lock()
+
+    def _generate(self, input_ids, streamer):
+        with self._lock, torch.inference_mode():
+            self.model.generate(input_ids, max_new_tokens=LLM_MAX_TOKENS, do_sample=False, streamer=streamer)
+
+    def stream(self, messages: List[Dict]):
+        from transformers import TextIteratorStreamer
+        input_ids = self.tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        threading.Thread(target=self._generate, args=(input_ids, streamer), daemon=True).start()
+        for text in streamer:
+            if text:
+                yield text
+
+    def invoke(self, messages: List[Dict]) -> str:
+        return "".join(self.stream(messages))
+
+STT_BACKENDS = {'groq': GroqSTT, 'fake': FakeSTT, 'local': LocalWhisperSTT}
+LLM_BACKENDS = {'groq': GroqLLM, 'fake': FakeLLM, 'local': LocalLLM}
+
+def init_stt_backend():
+    """Create the configured speech-to-text backend"""
+    global stt_backend
+    stt_backend = STT_BACKENDS[STT_BACKEND]()
+    log(f"✅ Speech-to-text backend initialized: {stt_backend.name}")
 
-# Load environment variables from .env file
-load_dotenv()
+def init_llm_backend():
+    """Create the configured LLM backend"""
+    global llm_backend
+    llm_backend = LLM_BACKENDS[LLM_BACKEND]()
+    log(f"✅ LLM backend initialized: {llm_backend.name}")
 
-from flask import Flask, render_template, request, jsonify, send_file
-import torch
-import torchaudio
-from chatterbox.tts import ChatterboxTTS
-from groq import Groq
-from langchain_groq import ChatGroq
-from langchain.schema import HumanMessage, SystemMessage
+# TTS backend: chatterbox, or fake for offline benchmarks
+TTS_BACKEND = os.getenv('LUNA_TTS_BACKEND', 'chatterbox')
+FAKE_TTS_RTF = float(os.getenv('LUNA_FAKE_TTS_RTF', '0.1'))  # Synthesis time per second of audio
 
-# Initialize Flask app
-app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
+class FakeTTS:
+    """Offline stand-in for ChatterboxTTS: a quiet tone whose length and synthesis time scale with the text"""
 
-# Global variables for models and state
-groq_client = None
-llm_client = None
-tts_model = None
-chat_history: List[Dict] = []
-reference_audio_path: Optional[str] = None
+    sr = 24000
+    device = "cpu"
+    SECONDS_PER_CHAR = 0.06
 
-# System prompt for the AI assistant
-SYSTEM_PROMPT = """You are Luna, a compassionate wellness coach and empathetic companion. Your role is to provide supportive, understanding, and encouraging responses to users who may be seeking emotional support, guidance, or just someone to talk to.
+    def __init__(self):
+        self.conds = None
 
-Key characteristics:
-- Be warm, empathetic, and genuinely caring
-- Show active listening by referencing what the user has shared
-- Offer practical wellness advice when appropriate
-- Remember context from the conversation (simulate memory)
-- Keep responses conversational and natural (2-3 sentences max)
-- Focus on emotional support and positive reinforcement
-- Ask thoughtful follow-up questions to show engagement
+    def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
+        self.conds = {'reference': str(wav_fpath)}
 
-Remember: Your responses will be converted to speech, so keep them concise but meaningful. Always maintain a supportive and caring tone."""
+    def generate(self, text: str, **kwargs) -> torch.Tensor:
+        duration = max(0.2, len(text) * self.SECONDS_PER_CHAR)
+        time.sleep(duration * FAKE_TTS_RTF)
+        t = torch.arange(int(duration * self.sr)) / self.sr
+        return (0.1 * torch.sin(2 * torch.pi * 220 * t)).unsqueeze(0)
 
-def initialize_models():
-    """Initialize all AI models and clients"""
-    global groq_client, llm_client, tts_model
+# CPU inference tuning for the TTS model
+TTS_QUANTIZE = os.getenv('LUNA_TTS_QUANTIZE', '0') == '1'  # Dynamic int8 quantization of Linear layers
+TTS_COMPILE = [path for path in os.getenv('LUNA_TTS_COMPILE', '').split(',') if path.strip()]  # e.g. t3.tfmr
+TORCH_THREADS = int(os.getenv('LUNA_TORCH_THREADS', '0'))  # 0 keeps torch's default
+TORCH_INTEROP_THREADS = int(os.getenv('LUNA_TORCH_INTEROP_THREADS', '0'))
+
+def configure_torch_threads():
+    """Pin torch's intra-op and inter-op thread pools if configured"""
+    if TORCH_THREADS:
+        torch.set_num_threads(TORCH_THREADS)
+    if TORCH_INTEROP_THREADS:
+        try:
+            torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
+        except RuntimeError as e:
+            # Only allowed before the first inter-op parallel work
+            log(f"⚠️ Could not set inter-op threads: {e}")
+
+def create_tts_model(device: Optional[str] = None):
+    """Load the configured TTS backend without any optimization applied"""
+    if TTS_BACKEND == 'fake':
+        return FakeTTS()
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    log(f"🎯 Using device: {device}")
+    return chatterbox_tts.ChatterboxTTS.from_pretrained(device=device)
+
+def optimize_tts_model(model, quantize: bool = TTS_QUANTIZE, compile_paths: List[str] = TTS_COMPILE) -> List[str]:
+    """Apply the CPU optimizations in place and return what was applied.
+
+    Quantization swaps the Linear layers of each top-level module for dynamic
+    int8 versions (weights int8, activations quantized on the fly); compile
+    wraps the listed submodules, given as dotted paths, with torch.compile.
+    Both are skipped on GPU, where they do not pay off for this model.
+    """
+    if str(model.device) != "cpu":
+        return []
+    applied = []
+    if quantize:
+        for name, module in vars(model).items():
+            if isinstance(module, torch.nn.Module):
+                torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+                applied.append(f"int8:{name}")
+    for path in compile_paths:
+        parent_path, _, name = path.strip().rpartition('.')
+        parent = model
+        for part in filter(None, parent_path.split('.')):
+            parent = getattr(parent, part)
+        setattr(parent, name, torch.compile(getattr(parent, name), dynamic=True))
+        applied.append(f"compile:{path.strip()}")
+    return applied
+
+def init_tts_model():
+    """Load Chatterbox TTS and optionally run a warm-up synthesis"""
+    global tts_model, default_conditionals, tts_scheduler
     
-    print("🔄 Initializing AI models...")
+    configure_torch_threads()
+    tts_model = create_tts_model()
+    default_conditionals = tts_model.conds
+    log(f"✅ {type(tts_model).__name__} initialized")
     
-    # Initialize Groq clients
-    groq_api_key = os.getenv('GROQ_API_KEY')
-    if not groq_api_key:
-        print("⚠️ GROQ_API_KEY not found in environment variables")
-        print("Please set your Groq API key: export GROQ_API_KEY='your_key_here'")
-        return False
+    if TTS_WORKERS > 0 and str(tts_model.device) == "cpu":
+        # Synthesis moves to worker processes, which optimize and warm up their own copy;
+        # the parent model keeps serving voice preparation
+        pool = TTSProcessPool(TTS_WORKERS, TTS_WORKER_THREADS, TTS_QUEUE_SIZE)
+        pool.start(tts_model)
+        if not pool.wait_ready(TTS_WORKER_START_TIMEOUT_SECONDS):
+            pool.close()
+            raise RuntimeError("No TTS worker process became ready")
+        tts_scheduler = pool
+        return
+    
+    applied = optimize_tts_model(tts_model)
+    if applied:
+        model_status['tts']['optimizations'] = applied
+        log(f"⚙️ TTS optimizations: {', '.join(applied)}")
     
+    if TTS_WARMUP:
+        warm_up_tts()
+
+def warm_up_tts():
+    """Pay one-off allocation and kernel selection costs (and compilation) before real traffic arrives"""
+    start = time.perf_counter()
+    with tts_lock, torch.inference_mode():
+        tts_model.conds = default_conditionals
+        tts_model.generate(TTS_WARMUP_TEXT)
+    model_status['tts']['warmup_seconds'] = round(time.perf_counter() - start, 2)
+    log(f"🔥 TTS warm-up finished in {time.perf_counter() - start:.2f}s")
+
+def load_component(name: str, loader) -> bool:
+    """Run a component loader, recording its state and load duration"""
+    model_status[name] = {'state': 'loading'}
+    start = time.perf_counter()
     try:
-        groq_client = Groq(api_key=groq_api_key)
-        llm_client = ChatGroq(
-            groq_api_key=groq_api_key,
-            model_name="llama-3.3-70b-versatile",  # Updated model name
-            temperature=0.7,
-            max_tokens=150
-        )
-        print("✅ Groq clients initialized")
+        loader()
     except Exception as e:
-        print(f"❌ Error initializing Groq: {e}")
+        log(f"❌ Error initializing {name}: {e}")
+        model_status[name] = {'state': 'failed', 'error': str(e), 'seconds': round(time.perf_counter() - start, 2)}
         return False
+    model_status[name].update({'state': 'ready', 'seconds': round(time.perf_counter() - start, 2)})
+    return True
+
+def component_ready(name: str) -> bool:
+    """Whether a model component has finished loading"""
+    return model_status[name]['state'] == 'ready'
+
+def initialize_models():
+    """Initialize all AI models and clients, loading them concurrently"""
+    log("🔄 Initializing AI models...")
+    
+    with ThreadPoolExecutor(max_workers=len(MODEL_LOADERS), thread_name_prefix="model-init") as pool:
+        results = [pool.submit(load_component, name, loader) for name, loader in MODEL_LOADERS.items()]
+        success = all(result.result() for result in results)
     
-    # Initialize Chatterbox TTS
+    if success:
+        log("🚀 All models initialized successfully!")
+    return success
+
+def start_background_initialization() -> threading.Thread:
+    """Initialize models without blocking the server; progress is reported on /health"""
+    thread = threading.Thread(target=initialize_models, name="model-init", daemon=True)
+    thread.start()
+    return thread
+
+MODEL_LOADERS = {'stt': init_stt_backend, 'llm': init_llm_backend, 'tts': init_tts_model}
+
+def enable_text_only():
+    """Serve text replies only: the TTS model, torch and torchaudio are never loaded"""
+    global TEXT_ONLY
+    TEXT_ONLY = True
+    MODEL_LOADERS.pop('tts', None)
+    model_status['tts'] = {'state': 'disabled'}
+
+if TEXT_ONLY:
+    enable_text_only()
+
+# Serving lifecycle hooks, used by serve.py
+draining = threading.Event()
+
+def can_preload_models() -> bool:
+    """Models can be loaded before forking only on CPU and without the TTS process pool"""
+    return TEXT_ONLY or (TTS_WORKERS == 0 and not torch.cuda.is_available())
+
+def preload_models() -> bool:
+    """Load models in the parent of a forking server so workers share the weights copy-on-write.
+
+    Loading runs single-threaded and skips the warm-up, so no OpenMP thread
+    pool exists at fork time; each worker warms up after the fork.
+    """
+    global TTS_WARMUP
+    if TEXT_ONLY:
+        return initialize_models()
+    threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    warmup, TTS_WARMUP = TTS_WARMUP, False
     try:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"🎯 Using device: {device}")
-        tts_model = ChatterboxTTS.from_pretrained(device=device)
-        print("✅ Chatterbox TTS initialized")
-    except Exception as e:
-        print(f"❌ Error initializing Chatterbox TTS: {e}")
-        return False
+        return initialize_models()
+    finally:
+        TTS_WARMUP = warmup
+        torch.set_num_threads(threads)
+
+def start_worker(preloaded: bool):
+    """Per-worker startup: warm up preloaded models, or load them in the background"""
+    if not preloaded:
+        start_background_initialization()
+        return
+    if TTS_WARMUP and component_ready('tts'):
+        # Serve text-only until this worker's TTS is warm
+        model_status['tts']['state'] = 'loading'
+        
+        def warm():
+            try:
+                warm_up_tts()
+            finally:
+                model_status['tts']['state'] = 'ready'
+        
+        threading.Thread(target=warm, name="tts-warmup", daemon=True).start()
+
+def drain(timeout: float, notice: float = 0.0) -> bool:
+    """Report draining on /ready and wait for in-flight requests, background voice jobs and queued synthesis.
+
+    The server keeps accepting requests meanwhile; waiting at least `notice`
+    seconds gives a load balancer polling /ready time to take this instance
+    out of rotation. Returns False if work was still pending when the timeout passed.
+    """
+    draining.set()
+    start = time.monotonic()
+    deadline = start + timeout
+    log("🛑 Draining: /ready returns 503 until shutdown")
+    finished = job_store.wait_idle(timeout)
     
-    print("🚀 All models initialized successfully!")
-    return True
+    def busy() -> bool:
+        return (time.monotonic() - start < notice or bool(tts_scheduler.queue_depth())
+                or http_in_flight.value() > 0)
+    
+    while busy() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    finished = finished and not busy()
+    log("✅ Drained" if finished else "⚠️ Drain timed out with work pending")
+    return finished
+
+def begin_drain(timeout: float, stop: Callable[[], None], notice: float = 0.0):
+    """Start draining from a signal handler and call stop() once drained.
+
+    The wait runs on its own thread so the server's main loop keeps accepting
+    requests (and answering /ready with 503) until stop() closes the listeners.
+    """
+    if draining.is_set():
+        return
+    
+    def run():
+        try:
+            drain(timeout, notice)
+        finally:
+            stop()
+    
+    draining.set()
+    threading.Thread(target=run, name="drain", daemon=True).start()
+
+def shutdown(timeout: float):
+    """Release worker resources once the server has stopped serving"""
+    if isinstance(tts_scheduler, TTSProcessPool):
+        tts_scheduler.close(timeout)
+
+# Input audio normalization: uploads are decoded, downmixed, resampled and trimmed
+# before they reach the STT backend or voice conditioning
+STT_SAMPLE_RATE = 16000
+REFERENCE_SAMPLE_RATE = 24000
+STT_AUDIO_FORMAT = os.getenv('LUNA_STT_AUDIO_FORMAT', 'flac')  # flac or wav
+TRIM_RELATIVE_DB = float(os.getenv('LUNA_TRIM_RELATIVE_DB', '40'))  # Frames this far below the loudest one count as silence
+TRIM_FLOOR_DBFS = -60.0
+TRIM_PADDING_SECONDS = 0.1
+input_audio_stats = {'clips': 0, 'undecodable': 0, 'bytes_in': 0, 'bytes_out': 0, 'trimmed_seconds': 0.0}
+input_audio_stats_lock = threading.Lock()  # Updated from concurrent request threads
+
+def decode_audio(data: bytes):
+    """Decode an upload in any container torchaudio understands (WAV, WebM/Opus, OGG, MP3...)"""
+    return torchaudio.load(io.BytesIO(data))
+
+def trim_silence(wav: torch.Tensor, sample_rate: int) -> torch.Tensor:
+    """Cut leading and trailing silence, judged on 20 ms frame energy relative to the loudest frame"""
+    frame = sample_rate // 50
+    frames = wav.shape[-1] // frame
+    if frames == 0:
+        return wav
+    levels = 10 * torch.log10(wav[0, :frames * frame].reshape(frames, frame).pow(2).mean(dim=1) + 1e-10)
+    threshold = max(levels.max().item() - TRIM_RELATIVE_DB, TRIM_FLOOR_DBFS)
+    voiced = torch.nonzero(levels > threshold).flatten()
+    if voiced.numel() == 0:
+        return wav
+    padding = int(TRIM_PADDING_SECONDS * sample_rate)
+    start = max(0, voiced[0].item() * frame - padding)
+    end = min(wav.shape[-1], (voiced[-1].item() + 1) * frame + padding)
+    return wav[:, start:end]
 
-def transcribe_audio(audio_file_path: str) -> str:
-    """Transcribe audio using Groq Whisper"""
+def normalize_waveform(wav: torch.Tensor, sample_rate: int, target_rate: int) -> torch.Tensor:
+    """Downmix to mono, resample to the target rate and trim silence"""
+    if wav.shape[0] > 1:
+        wav = wav.mean(dim=0, keepdim=True)
+    if sample_rate != target_rate:
+        wav = torchaudio.functional.resample(wav, sample_rate, target_rate)
+    return trim_silence(wav, target_rate)
+
+def encode_speech(wav: torch.Tensor, sample_rate: int = STT_SAMPLE_RATE):
+    """Compact 16-bit encoding for the STT backend; returns (bytes, filename)"""
+    buffer = io.BytesIO()
+    if STT_AUDIO_FORMAT == 'flac':
+        try:
+            torchaudio.save(buffer, wav, sample_rate, format="flac", bits_per_sample=16)
+            return buffer.getvalue(), "speech.flac"
+        except Exception:
+            # No FLAC encoder in this torchaudio build
+            buffer = io.BytesIO()
+    torchaudio.save(buffer, wav, sample_rate, format="wav", encoding="PCM_S", bits_per_sample=16)
+    return buffer.getvalue(), "speech.wav"
+
+def normalize_input_audio(data: bytes, filename: str):
+    """Prepare an uploaded voice message for transcription; returns (bytes, filename).
+
+    If the upload cannot be decoded it is passed through untouched and left to
+    the STT backend.
+    """
+    with timed_stage('normalize'):
+        try:
+            wav, sample_rate = decode_audio(data)
+        except Exception as e:
+            log(f"⚠️ Could not decode {filename}, sending it as-is: {e}")
+            with input_audio_stats_lock:
+                input_audio_stats['undecodable'] += 1
+            return data, filename
+        duration = wav.shape[-1] / sample_rate
+        wav = normalize_waveform(wav, sample_rate, STT_SAMPLE_RATE)
+        encoded, encoded_name = encode_speech(wav)
+    with input_audio_stats_lock:
+        input_audio_stats['clips'] += 1
+        input_audio_stats['bytes_in'] += len(data)
+        input_audio_stats['bytes_out'] += len(encoded)
+        input_audio_stats['trimmed_seconds'] += duration - wav.shape[-1] / STT_SAMPLE_RATE
+    log(f"🎚️ Normalized {filename}: {len(data)} -> {len(encoded)} bytes, {wav.shape[-1] / STT_SAMPLE_RATE:.1f}s of audio")
+    return encoded, encoded_name
+
+def normalize_reference_audio(data: bytes) -> bytes:
+    """Mono, trimmed, peak-normalized WAV of a voice cloning reference"""
+    wav, sample_rate = decode_audio(data)
+    wav = normalize_waveform(wav, sample_rate, REFERENCE_SAMPLE_RATE)
+    peak = wav.abs().max()
+    if peak > 0:
+        wav = wav * (0.9 / peak)
+    buffer = io.BytesIO()
+    torchaudio.save(buffer, wav, REFERENCE_SAMPLE_RATE, format="wav", encoding="PCM_S", bits_per_sample=16)
+    return buffer.getvalue()
+
+def transcribe_audio(audio_bytes: bytes, filename: str = "recording.wav") -> str:
+    """Transcribe audio using the configured speech-to-text backend"""
     try:
-        with open(audio_file_path, "rb") as file:
-            transcription = groq_client.audio.transcriptions.create(
-                file=(audio_file_path, file.read()),
-                model="whisper-large-v3-turbo",
-                response_format="text"
-            )
-        print(f"📝 Transcription: {transcription}")
+        with timed_stage('stt'):
+            transcription = stt_caller.call(stt_backend.transcribe, audio_bytes, filename)
+        log(f"📝 Transcription: {transcription}")
         return transcription.strip()
     except Exception as e:
-        print(f"❌ Transcription error: {e}")
+        log(f"❌ Transcription error: {e}")
+        errors_total.inc(stage='stt')
         return ""
 
-def generate_ai_response(user_input: str) -> str:
-    """Generate AI response using Groq LLM"""
+# Streaming voice input: the browser posts 16 kHz mono PCM16 while the user speaks
+VOICE_STREAM_RATE = 16000
+VAD_FRAME_SAMPLES = VOICE_STREAM_RATE * 30 // 1000  # 30 ms analysis frames
+VAD_MIN_DBFS = float(os.getenv('LUNA_VAD_MIN_DBFS', '-45'))  # Frames quieter than this are never speech
+VAD_MARGIN_DB = float(os.getenv('LUNA_VAD_MARGIN_DB', '10'))  # Speech must be this far above the noise floor
+VAD_SEGMENT_PAUSE_MS = int(os.getenv('LUNA_VAD_SEGMENT_PAUSE_MS', '350'))  # Pause that closes a segment for transcription
+VAD_END_SILENCE_MS = int(os.getenv('LUNA_VAD_END_SILENCE_MS', '900'))  # Silence that ends the utterance
+VAD_PADDING_FRAMES = 5  # Frames (150 ms) kept before speech onset and after its end
+VOICE_STREAM_MAX_SECONDS = int(os.getenv('LUNA_VOICE_STREAM_MAX_SECONDS', '120'))
+VOICE_STREAM_IDLE_SECONDS = 60
+STT_WORKERS = int(os.getenv('LUNA_STT_WORKERS', '2'))
+stt_executor = ThreadPoolExecutor(max_workers=STT_WORKERS, thread_name_prefix="stt")
+
+class VoiceInputStream:
+    """One utterance arriving as PCM chunks, segmented by an energy VAD.
+
+    Each 30 ms frame is classed as speech when its level clears both a fixed
+    floor and an adaptive noise floor. Speech is cut into segments at short
+    pauses, and each finished segment is transcribed in the background while
+    the user keeps talking, so only the last segment is left when they stop.
+    Silence outside the padding is never sent to the STT backend.
+    """
+
+    def __init__(self, stream_id: str, session_id: str):
+        self.stream_id = stream_id
+        self.session_id = session_id
+        self.last_seen = time.time()
+        self.received_bytes = 0
+        self.speech_frames = 0
+        self.end_of_utterance = False
+        self._remainder = b""
+        self._noise_db = VAD_MIN_DBFS - VAD_MARGIN_DB
+        self._padding = deque(maxlen=VAD_PADDING_FRAMES)
+        self._segment: List[bytes] = []
+        self._silence_run = 0
+        self._heard_speech = False
+        self._transcripts: List[Future] = []
+        self._lock = threading.Lock()
+
+    def feed(self, pcm: bytes) -> Dict:
+        """Consume a chunk of PCM16 samples and report the VAD state"""
+        with self._lock:
+            self.last_seen = time.time()
+            self.received_bytes += len(pcm)
+            data = self._remainder + pcm
+            frame_bytes = VAD_FRAME_SAMPLES * 2
+            usable = len(data) - len(data) % frame_bytes
+            self._remainder = data[usable:]
+            if usable:
+                samples = torch.frombuffer(bytearray(data[:usable]), dtype=torch.int16).float() / 32768
+                frames = samples.view(-1, VAD_FRAME_SAMPLES)
+                levels = (10 * torch.log10(frames.pow(2).mean(dim=1) + 1e-10)).tolist()
+                for index, level in enumerate(levels):
+                    self._frame(data[index * frame_bytes:(index + 1) * frame_bytes], level)
+            return {
+                'speech': self._silence_run == 0 and self._heard_speech,
+                'end_of_utterance': self.end_of_utterance,
+                'segments': self.segments
+            }
+
+    @property
+    def segments(self) -> int:
+        return len(self._transcripts)
+
+    def _frame(self, frame: bytes, level: float):
+        speech = level > max(VAD_MIN_DBFS, self._noise_db + VAD_MARGIN_DB)
+        if not speech:
+            # Track the background level with a slow moving average
+            self._noise_db = 0.95 * self._noise_db + 0.05 * level
+        
+        if speech:
+            if not self._segment:
+                self._segment.extend(self._padding)
+                self._padding.clear()
+            self._segment.append(frame)
+            self._silence_run = 0
+            self._heard_speech = True
+            self.speech_frames += 1
+            return
+        
+        self._silence_run += 1
+        if self._segment:
+            self._segment.append(frame)
+            if self._silence_run * 30 >= VAD_SEGMENT_PAUSE_MS:
+                self._close_segment()
+        else:
+            self._padding.append(frame)
+        if self._heard_speech and self._silence_run * 30 >= VAD_END_SILENCE_MS:
+            self.end_of_utterance = True
+
+    def _close_segment(self):
+        """Send the current segment (minus silence beyond the padding) to transcription"""
+        keep = len(self._segment) - max(0, self._silence_run - VAD_PADDING_FRAMES)
+        pcm = b"".join(self._segment[:keep])
+        self._segment = []
+        samples = torch.frombuffer(bytearray(pcm), dtype=torch.int16).float().unsqueeze(0) / 32768
+        self._transcripts.append(
+            stt_executor.submit(in_context(transcribe_audio), *encode_speech(samples, VOICE_STREAM_RATE))
+        )
+
+    def finish(self) -> str:
+        """Transcribe whatever speech is still buffered and return the full transcript"""
+        with self._lock:
+            if self._segment and self._heard_speech:
+                self._close_segment()
+            transcripts = list(self._transcripts)
+        with timed_stage('stt_wait'):
+            texts = [future.result() for future in transcripts]
+        return " ".join(text for text in texts if text)
+
+class VoiceStreamStore:
+    """Open voice input streams, expired after a period without chunks"""
+
+    def __init__(self, idle_seconds: int):
+        self.idle_seconds = idle_seconds
+        self.stats = {'streams': 0, 'segments': 0, 'received_bytes': 0, 'speech_seconds': 0.0}
+        self._streams: Dict[str, VoiceInputStream] = {}
+        self._lock = threading.Lock()
+
+    def create(self, session_id: str) -> VoiceInputStream:
+        stream = VoiceInputStream(uuid.uuid4().hex, session_id)
+        now = time.time()
+        with self._lock:
+            for stream_id in [sid for sid, s in self._streams.items() if now - s.last_seen > self.idle_seconds]:
+                del self._streams[stream_id]
+            self._streams[stream.stream_id] = stream
+            self.stats['streams'] += 1
+        return stream
+
+    def get(self, stream_id: str, session_id: str) -> Optional[VoiceInputStream]:
+        """A stream, if it exists and belongs to this session"""
+        with self._lock:
+            stream = self._streams.get(stream_id)
+        return stream if stream is not None and stream.session_id == session_id else None
+
+    def finish(self, stream: VoiceInputStream) -> str:
+        """Close a stream and return its transcript"""
+        with self._lock:
+            self._streams.pop(stream.stream_id, None)
+        transcript = stream.finish()
+        with self._lock:
+            self.stats['segments'] += stream.segments
+            self.stats['received_bytes'] += stream.received_bytes
+            self.stats['speech_seconds'] += stream.speech_frames * 0.03
+        return transcript
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {**self.stats, 'speech_seconds': round(self.stats['speech_seconds'], 2), 'open': len(self._streams)}
+
+voice_streams = VoiceStreamStore(VOICE_STREAM_IDLE_SECONDS)
+
+summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summarizer")
+
+def build_context(session: Optional[ConversationSession], user_input: str) -> List:
+    """Build the LLM prompt: system prompt, rolling summary, and as much recent history as fits the token budget"""
+    messages = [{'role': 'system', 'content': SYSTEM_PROMPT}]
+    if session is None:
+        messages.append({'role': 'user', 'content': user_input})
+        return messages
+    
+    with session.lock:
+        history = list(session.history)
+        sizes = list(session.token_sizes)
+        first_position = session.appended - len(history)
+        summary = session.summary
+    
+    if summary:
+        messages.append({'role': 'system', 'content': f"Summary of the earlier conversation: {summary}"})
+    
+    # Walk back from the newest message while the budget allows
+    budget = CONTEXT_TOKEN_BUDGET - estimate_tokens(SYSTEM_PROMPT) - estimate_tokens(summary) - estimate_tokens(user_input)
+    start = len(history)
+    while start > 0 and sizes[start - 1] <= budget:
+        budget -= sizes[start - 1]
+        start -= 1
+    
+    for msg in history[start:]:
+        messages.append({'role': 'user' if msg['type'] == 'user' else 'assistant', 'content': msg['content']})
+    messages.append({'role': 'user', 'content': user_input})
+    
+    # Anything older than the window is folded into the summary off the hot path
+    schedule_summary(session, first_position + start)
+    return messages
+
+def schedule_summary(session: ConversationSession, upto: int):
+    """Fold messages before position `upto` into the session summary in the background"""
+    with session.lock:
+        if session.summarizing or upto <= session.summarized:
+            return
+        session.summarizing = True
+    summary_executor.submit(in_context(update_summary), session, upto)
+
+def update_summary(session: ConversationSession, upto: int):
+    """Incrementally extend the rolling summary with newly evicted turns"""
     try:
-        # Create conversation context
-        messages = [SystemMessage(content=SYSTEM_PROMPT)]
+        with session.lock:
+            first_position = session.appended - len(session.history)
+            base = session.summarized
+            pending = [message for position, message in session.overflow if base <= position < upto]
+            pending += [
+                message for offset, message in enumerate(session.history)
+                if base <= first_position + offset < upto
+            ]
+            previous = session.summary
+        if not pending:
+            return
         
-        # Add chat history context (last 6 messages for context)
-        recent_history = chat_history[-6:] if len(chat_history) > 6 else chat_history
-        for msg in recent_history:
-            if msg['type'] == 'user':
-                messages.append(HumanMessage(content=msg['content']))
-            else:
-                messages.append(SystemMessage(content=f"Assistant previously said: {msg['content']}"))
+        transcript = "\n".join(
+            f"{'User' if message['type'] == 'user' else 'Luna'}: {message['content']}" for message in pending
+        )
+        prompt = (
+            f"Update this running summary of a conversation between a user and Luna, a wellness coach. "
+            f"Keep the facts, feelings and goals the user shared. Reply with the summary only, "
+            f"at most {SUMMARY_MAX_WORDS} words.\n\n"
+            f"Current summary: {previous or '(none yet)'}\n\nNew turns:\n{transcript}"
+        )
+        start = time.perf_counter()
+        summary = llm_caller.call(llm_backend.invoke, [{'role': 'user', 'content': prompt}]).strip()
+        
+        with session.lock:
+            # A concurrent clear resets the conversation; drop the stale summary
+            if session.summarized != base:
+                return
+            session.summary = summary
+            session.summarized = upto
+            session.overflow = [(position, message) for position, message in session.overflow if position >= upto]
+        log(f"🧾 Summarized {len(pending)} message(s) in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        log(f"⚠️ Summary update error: {e}")
+        errors_total.inc(stage='summary')
+    finally:
+        with session.lock:
+            session.summarizing = False
+
+# Semantic LLM response cache (opt-in)
+RESPONSE_CACHE_ENABLED = os.getenv('LUNA_RESPONSE_CACHE', '0') == '1'
+RESPONSE_CACHE_ITEMS = int(os.getenv('LUNA_RESPONSE_CACHE_ITEMS', '1000'))
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv('LUNA_RESPONSE_CACHE_TTL_SECONDS', '86400'))
+RESPONSE_CACHE_THRESHOLD = float(os.getenv('LUNA_RESPONSE_CACHE_THRESHOLD', '0.95'))  # Cosine similarity for a near match
+RESPONSE_CACHE_MAX_CHARS = int(os.getenv('LUNA_RESPONSE_CACHE_MAX_CHARS', '120'))  # Longer messages are never cached
+RESPONSE_CACHE_MODEL = os.getenv('LUNA_RESPONSE_CACHE_MODEL')  # sentence-transformers model; unset disables near matches
+NEGATION_WORDS = frozenset({
+    'no', 'not', 'never', 'nothing', 'nobody', 'none', 'nor', 'without', 'cannot',
+    "can't", "don't", "doesn't", "didn't", "won't", "wouldn't", "isn't", "aren't", "wasn't",
+    "weren't", "shouldn't", "couldn't", "haven't", "hasn't", "hadn't", "ain't"
+})
+# Greetings, pleasantries and fillers: swapping one of these does not change what a message asks
+INTERCHANGEABLE_WORDS = frozenset({
+    'hi', 'hello', 'hey', 'hiya', 'howdy', 'yo', 'greetings', 'there', 'again', 'luna',
+    'morning', 'afternoon', 'evening', 'thanks', 'thank', 'cheers', 'please', 'ok', 'okay',
+    'oh', 'um', 'uh', 'well', 'so', 'just', 'a', 'an', 'the'
+})
+response_cache_lookups = Counter('luna_response_cache_lookups_total', 'LLM response cache lookups by outcome', ['result'])
+
+def normalize_message(text: str) -> str:
+    """Case, Unicode form, punctuation and spacing do not change what a message asks"""
+    text = unicodedata.normalize("NFKC", text).casefold().replace("\u2019", "'")
+    return " ".join(re.sub(r"[^\w\s']", " ", text).split())
+
+def context_fingerprint(messages: List[Dict]) -> str:
+    """Hash of the exact prompt before the user's message: system prompt, summary and history window.
+
+    A cached reply is only reused for a prompt the LLM would have seen
+    identically, so one conversation's reply is never served into another.
+    """
+    payload = json.dumps(messages[:-1], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+def meaning_changing_edit(first: str, second: str) -> bool:
+    """Whether two normalized messages differ by a negation, or by one or two words that carry meaning.
+
+    Embeddings score such pairs as near-identical even when the meaning flips
+    ("ending my life" / "ending my job", "I want to" / "I don't want to"), so
+    they are never treated as the same question. Swapped greetings and fillers
+    ("hi" / "hello", "hey there" / "hi there") are left to the similarity score.
+    """
+    remaining = first.split()
+    added = []
+    for word in second.split():
+        if word in remaining:
+            remaining.remove(word)
+        else:
+            added.append(word)
+    changed = remaining + added
+    if any(word in NEGATION_WORDS for word in changed):
+        return True
+    return len(changed) <= 2 and any(word not in INTERCHANGEABLE_WORDS for word in changed)
+
+class SentenceTransformerEmbedder:
+    """Embeddings from a sentence-transformers model (optional dependency)"""
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def __call__(self, text: str):
+        import numpy as np
+        return np.asarray(self.model.encode(text, normalize_embeddings=True), dtype=np.float32)
+
+class ResponseCache:
+    """LLM replies keyed on the normalized user message plus a fingerprint of the prompt context.
+
+    The exact tier is a dict lookup. The similarity tier, enabled by giving it a
+    sentence embedder, does a brute-force cosine search with NumPy over a matrix
+    with one row per entry, restricted to entries with the same context. Near
+    matches that differ from the cached message by a negation or by a one-word
+    edit to a word that carries meaning are rejected. Entries are evicted least-recently-used once the cache is
+    full and expire after the TTL. A repeated reply text also hits the TTS audio
+    cache, so a cached turn skips synthesis as well.
+    """
+
+    def __init__(self, max_items: int, ttl_seconds: int, threshold: float, embedder=None):
+        import numpy as np
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self.embedder = embedder
+        self.stats = {'exact_hits': 0, 'similar_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'expired': 0}
+        self._entries: "OrderedDict[tuple, Dict]" = OrderedDict()  # (fingerprint, message) -> entry
+        self._free_rows = list(range(max_items - 1, -1, -1))
+        self._row_keys: List[Optional[tuple]] = [None] * max_items
+        self._row_contexts = np.full(max_items, -1, dtype=np.int64)  # Context ID per row, -1 when free
+        self._matrix = None  # max_items x dim embeddings, created with the first embedded entry
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _context_id(fingerprint: str) -> int:
+        return int(fingerprint[:15] or '0', 16)
+
+    def _embedder(self):
+        if self.embedder is None and RESPONSE_CACHE_MODEL:
+            self.embedder = SentenceTransformerEmbedder(RESPONSE_CACHE_MODEL)
+        return self.embedder
+
+    def _remove(self, key: tuple):
+        entry = self._entries.pop(key)
+        self._row_keys[entry['row']] = None
+        self._row_contexts[entry['row']] = -1
+        self._free_rows.append(entry['row'])
+
+    def _expired(self, key: tuple, now: float) -> bool:
+        if now - self._entries[key]['created'] <= self.ttl_seconds:
+            return False
+        self._remove(key)
+        self.stats['expired'] += 1
+        return True
+
+    def _miss(self) -> None:
+        self.stats['misses'] += 1
+        response_cache_lookups.inc(result='miss')
+        return None
+
+    def lookup(self, message: str, fingerprint: str) -> Optional[str]:
+        """A cached reply for this message in this context, if there is one close enough"""
+        normalized = normalize_message(message)
+        now = time.time()
+        with self._lock:
+            key = (fingerprint, normalized)
+            if key in self._entries and not self._expired(key, now):
+                self._entries.move_to_end(key)
+                self._entries[key]['hits'] += 1
+                self.stats['exact_hits'] += 1
+                response_cache_lookups.inc(result='exact')
+                return self._entries[key]['response']
+            if self._matrix is None or self._embedder() is None:
+                return self._miss()
         
-        # Add current user input
-        messages.append(HumanMessage(content=user_input))
+        query = self._embedder()(normalized)
+        with self._lock:
+            scores = self._matrix @ query
+            scores[self._row_contexts != self._context_id(fingerprint)] = -1.0
+            row = int(scores.argmax())
+            row_key = self._row_keys[row]
+            if (scores[row] < self.threshold or row_key is None or self._expired(row_key, now)
+                    or meaning_changing_edit(row_key[1], normalized)):
+                return self._miss()
+            self._entries.move_to_end(row_key)
+            self._entries[row_key]['hits'] += 1
+            self.stats['similar_hits'] += 1
+            response_cache_lookups.inc(result='similar')
+            return self._entries[row_key]['response']
+
+    def store(self, message: str, fingerprint: str, response: str):
+        import numpy as np
+        normalized = normalize_message(message)
+        embedder = self._embedder()
+        embedding = embedder(normalized) if embedder is not None else None
+        with self._lock:
+            key = (fingerprint, normalized)
+            if key in self._entries:
+                self._remove(key)
+            if not self._free_rows:
+                self._remove(next(iter(self._entries)))
+                self.stats['evictions'] += 1
+            row = self._free_rows.pop()
+            if embedding is not None:
+                if self._matrix is None:
+                    self._matrix = np.zeros((self.max_items, embedding.shape[0]), dtype=np.float32)
+                self._matrix[row] = embedding
+            self._row_keys[row] = key
+            self._row_contexts[row] = self._context_id(fingerprint)
+            self._entries[key] = {'response': response, 'row': row, 'created': time.time(), 'hits': 0}
+            self.stats['stores'] += 1
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            lookups = self.stats['exact_hits'] + self.stats['similar_hits'] + self.stats['misses']
+            hits = self.stats['exact_hits'] + self.stats['similar_hits']
+            return {
+                **self.stats,
+                'enabled': True,
+                'similarity': bool(self.embedder is not None or RESPONSE_CACHE_MODEL),
+                'entries': len(self._entries),
+                'hit_rate': round(hits / lookups, 3) if lookups else 0.0,
+                'threshold': self.threshold
+            }
+
+response_cache = ResponseCache(RESPONSE_CACHE_ITEMS, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_THRESHOLD) if RESPONSE_CACHE_ENABLED else None
+
+def cached_response(user_input: str, session: Optional[ConversationSession]):
+    """Build the prompt and look up a cached reply for it.
+
+    Returns (reply or None, fingerprint, messages); a None fingerprint means the
+    reply must not be cached.
+    """
+    messages = build_context(session, user_input)
+    if response_cache is None or len(user_input) > RESPONSE_CACHE_MAX_CHARS:
+        return None, None, messages
+    fingerprint = context_fingerprint(messages)
+    with timed_stage('response_cache'):
+        reply = response_cache.lookup(user_input, fingerprint)
+    if reply is not None:
+        log(f"⚡ LLM response cache hit: {reply}")
+    return reply, fingerprint, messages
+
+def stream_ai_response(user_input: str, session: Optional[ConversationSession] = None):
+    """Stream the AI response token by token from the LLM backend"""
+    parts = []
+    try:
+        reply, fingerprint, messages = cached_response(user_input, session)
+        if reply is not None:
+            yield reply
+            return
+        start = time.perf_counter()
+        for token in llm_caller.stream(llm_backend.stream, messages):
+            parts.append(token)
+            yield token
+        record_stage('llm', time.perf_counter() - start)
+        log(f"🤖 AI Response (streamed): {''.join(parts).strip()}")
+        if fingerprint is not None and parts:
+            response_cache.store(user_input, fingerprint, "".join(parts).strip())
+    except Exception as e:
+        log(f"❌ LLM streaming error: {e}")
+        errors_total.inc(stage='llm')
+        if not parts:
+            fallbacks_total.inc(kind='canned_reply')
+            yield FALLBACK_RESPONSE
+
+def generate_ai_response(user_input: str, session: Optional[ConversationSession] = None) -> str:
+    """Generate AI response using the configured LLM backend"""
+    try:
+        # Build the context within the token budget; common turns may be answered from the response cache
+        reply, fingerprint, messages = cached_response(user_input, session)
+        if reply is not None:
+            return reply
         
         # Generate response
-        response = llm_client.invoke(messages)
-        ai_response = response.content.strip()
+        with timed_stage('llm'):
+            ai_response = llm_caller.call(llm_backend.invoke, messages).strip()
         
-        print(f"🤖 AI Response: {ai_response}")
+        log(f"🤖 AI Response: {ai_response}")
+        if fingerprint is not None and ai_response:
+            response_cache.store(user_input, fingerprint, ai_response)
         return ai_response
     except Exception as e:
-        print(f"❌ LLM generation error: {e}")
-        return "I'm sorry, I'm having trouble processing that right now. Could you try again?"
+        log(f"❌ LLM generation error: {e}")
+        errors_total.inc(stage='llm')
+        fallbacks_total.inc(kind='canned_reply')
+        return FALLBACK_RESPONSE
+
+def hash_audio_file(file_path: str) -> str:
+    """Content hash of an audio file, used as the voice cache key"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()[:32]
+
+def voice_cache_file(voice_id: str) -> Optional[Path]:
+    """Location of the persisted conditionals for a voice, if persistence is enabled"""
+    if not VOICE_CACHE_DIR:
+        return None
+    return Path(VOICE_CACHE_DIR) / f"voice_{voice_id}.pt"
+
+def prepare_voice(audio_path: str) -> str:
+    """Compute (or load) the speaker conditioning for a reference clip and return its voice ID"""
+    voice_id = hash_audio_file(audio_path)
+    if get_voice_conditionals(voice_id) is not None:
+        log(f"♻️ Voice conditioning already cached: {voice_id}")
+        return voice_id
+    
+    start = time.perf_counter()
+    with tts_lock, torch.inference_mode():
+        previous = tts_model.conds
+        try:
+            tts_model.prepare_conditionals(audio_path)
+            conds = tts_model.conds
+        finally:
+            tts_model.conds = previous
+    elapsed = time.perf_counter() - start
+    
+    # Persist before caching in memory, so the voice can be reloaded once it is evicted
+    cache_file = voice_cache_file(voice_id)
+    if cache_file:
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            conds.save(cache_file)
+            log(f"💾 Voice conditioning persisted: {cache_file}")
+        except Exception as e:
+            log(f"⚠️ Could not persist voice conditioning: {e}")
+    
+    remember_voice(voice_id, conds, elapsed)
+    with voice_cache_lock:
+        voice_cache_stats['prepared'] += 1
+    log(f"🧬 Voice conditioning prepared in {elapsed:.2f}s: {voice_id}")
+    return voice_id
+
+def remember_voice(voice_id: str, conds, prepare_seconds: Optional[float] = None):
+    """Keep conditionals in the in-memory LRU, evicting the least recently used voices past the cap"""
+    with voice_cache_lock:
+        voice_conditionals[voice_id] = conds
+        voice_conditionals.move_to_end(voice_id)
+        if prepare_seconds is not None:
+            voice_prepare_seconds[voice_id] = prepare_seconds
+        while len(voice_conditionals) > max(1, VOICE_CACHE_ITEMS):
+            evicted, _ = voice_conditionals.popitem(last=False)
+            voice_prepare_seconds.pop(evicted, None)
+            voice_cache_stats['evictions'] += 1
+            log(f"♻️ Voice conditioning evicted from memory: {evicted}")
+
+def get_voice_conditionals(voice_id: Optional[str]):
+    """Look up cached conditionals for a voice, falling back to the on-disk copy"""
+    if not voice_id:
+        return None
+    with voice_cache_lock:
+        conds = voice_conditionals.get(voice_id)
+        if conds is not None:
+            voice_conditionals.move_to_end(voice_id)
+            return conds
+    cache_file = voice_cache_file(voice_id)
+    if cache_file and cache_file.exists():
+        conds = chatterbox_tts.Conditionals.load(cache_file, map_location=tts_model.device).to(tts_model.device)
+        remember_voice(voice_id, conds)
+        with voice_cache_lock:
+            voice_cache_stats['disk_loads'] += 1
+        log(f"📂 Voice conditioning loaded from disk: {voice_id}")
+    return conds
+
+def audio_id_for(cache_key: str, audio_format: str) -> str:
+    """Audio ID of a clip in the given format"""
+    return f"{cache_key}.{AUDIO_FORMATS[audio_format]['extension']}"
 
-def generate_voice_response(text: str, audio_prompt_path: Optional[str] = None) -> str:
-    """Generate voice using Chatterbox TTS"""
+def audio_format_for(audio_id: str) -> str:
+    """Format of an audio ID, judged by its extension"""
+    extension = audio_id.split('.', 1)[1] if '.' in audio_id else ''
+    for audio_format, spec in AUDIO_FORMATS.items():
+        if spec['extension'] == extension:
+            return audio_format
+    return 'wav'
+
+def negotiate_audio_format(default: str = DEFAULT_AUDIO_FORMAT) -> str:
+    """Pick an output format from the `format` request field or the Accept header"""
+    requested = (request.values.get('format') or '').lower()
+    if requested in AUDIO_FORMATS:
+        return requested
+    
+    def format_for(mimetype: str) -> str:
+        # A default that shares the type (wav16k for audio/wav) is kept
+        audio_format = ACCEPT_AUDIO_TYPES[mimetype]
+        return default if AUDIO_FORMATS[audio_format]['mimetype'] == AUDIO_FORMATS[default]['mimetype'] else audio_format
+    
+    # Types served by the default come first, so wildcards and equal q-values keep it
+    candidates = sorted(ACCEPT_AUDIO_TYPES, key=lambda mimetype: format_for(mimetype) != default)
+    best = request.accept_mimetypes.best_match(candidates)
+    return format_for(best) if best else default
+
+def encode_audio(wav: torch.Tensor, sample_rate: int, audio_format: str) -> bytes:
+    """Encode a waveform into the requested output format"""
+    with timed_stage('encode'):
+        return _encode_audio(wav, sample_rate, audio_format)
+
+def _encode_audio(wav: torch.Tensor, sample_rate: int, audio_format: str) -> bytes:
+    target_rate = AUDIO_FORMATS[audio_format]['sample_rate']
+    if target_rate and target_rate != sample_rate:
+        wav = torchaudio.functional.resample(wav, sample_rate, target_rate)
+        sample_rate = target_rate
+    
+    buffer = io.BytesIO()
+    if audio_format == 'opus':
+        # StreamWriter needs torchaudio's FFmpeg integration, only load it when Opus is used
+        from torchaudio.io import StreamWriter
+        writer = StreamWriter(buffer, format="ogg")
+        writer.add_audio_stream(
+            sample_rate=sample_rate,
+            num_channels=wav.shape[0],
+            encoder="libopus",
+            encoder_option={"b": OPUS_BITRATE}
+        )
+        with writer.open():
+            writer.write_audio_chunk(0, wav.t().contiguous().float())
+    else:
+        torchaudio.save(buffer, wav, sample_rate, format="wav", encoding="PCM_S", bits_per_sample=16)
+    return buffer.getvalue()
+
+def transcode_audio(data: bytes, audio_format: str) -> bytes:
+    """Re-encode a canonical WAV clip into another format"""
+    wav, sample_rate = torchaudio.load(io.BytesIO(data), format="wav")
+    return encode_audio(wav, sample_rate, audio_format)
+
+def load_audio_variant(cache_key: str, audio_format: str, record: bool = False) -> Optional[bytes]:
+    """Fetch a clip in a given format, transcoding from the canonical WAV if needed"""
+    audio_id = audio_id_for(cache_key, audio_format)
+    data = audio_cache.get(audio_id, record=record)
+    if data is None and audio_format != 'wav':
+        canonical = audio_cache.get(audio_id_for(cache_key, 'wav'), record=False)
+        if canonical is not None:
+            data = encode_executor.submit(in_context(transcode_audio), canonical, audio_format).result()
+            audio_cache.put(audio_id, data)
+            log(f"🔁 Transcoded cached clip to {audio_format}: {audio_id}")
+    return data
+
+def send_audio(audio_id: str, audio_format: str) -> Optional[Response]:
+    """Conditional, range-capable response for a cached clip.
+
+    Disk-tier clips are sent from the file itself, which lets the WSGI server
+    use sendfile instead of copying the clip through Python.
+    """
+    located = audio_cache.locate(audio_id)
+    if located is None:
+        return None
+    data, path, digest = located
+    try:
+        response = send_file(
+            io.BytesIO(data) if path is None else path,
+            mimetype=AUDIO_FORMATS[audio_format]['mimetype'],
+            download_name=audio_id,
+            conditional=True,
+            etag=f"{audio_id}-{digest}"
+        )
+    except OSError:
+        # The file was removed between locate() and opening it
+        return None
+    response.headers['Cache-Control'] = f"public, max-age={AUDIO_MAX_AGE_SECONDS}, immutable"
+    return response
+
+def generate_voice_response(text: str, voice_id: Optional[str] = None, audio_format: str = 'wav') -> str:
+    """Generate voice using Chatterbox TTS and return the clip's audio ID"""
     try:
-        # Generate unique filename
-        output_filename = f"response_{uuid.uuid4().hex}.wav"
-        output_path = os.path.join(tempfile.gettempdir(), output_filename)
+        # Serve repeated replies straight from the cache
+        cache_key = AudioCache.make_key(text, voice_id, tts_model.sr)
+        audio_id = audio_id_for(cache_key, audio_format)
+        if load_audio_variant(cache_key, audio_format, record=True) is not None:
+            log(f"⚡ TTS cache hit: {audio_id}")
+            return audio_id
         
-        # Generate audio
-        if audio_prompt_path and os.path.exists(audio_prompt_path):
-            print(f"🎵 Generating with voice cloning from: {audio_prompt_path}")
-            wav = tts_model.generate(text, audio_prompt_path=audio_prompt_path)
+        # Resolve the voice before taking the model lock
+        conds = get_voice_conditionals(voice_id)
+        if conds is not None:
+            with voice_cache_lock:
+                saved = voice_prepare_seconds.get(voice_id, 0.0)
+                voice_cache_stats['hits'] += 1
+                voice_cache_stats['seconds_saved'] += saved
+            log(f"🎵 Generating with cached voice {voice_id} (saved {saved:.2f}s of conditioning)")
         else:
-            print("🎵 Generating with default voice")
-            wav = tts_model.generate(text)
+            if voice_id:
+                log(f"⚠️ Voice {voice_id} not cached, using default voice")
+                fallbacks_total.inc(kind='default_voice')
+            log("🎵 Generating with default voice")
+            conds = default_conditionals
+        
+        # Key the clip on the voice actually used, so a default-voice fallback is
+        # never cached under the cloned voice's ID
+        voice_key = voice_id if conds is not default_conditionals else None
+        if voice_key != voice_id:
+            cache_key = AudioCache.make_key(text, voice_key, tts_model.sr)
+            audio_id = audio_id_for(cache_key, audio_format)
+            if load_audio_variant(cache_key, audio_format, record=True) is not None:
+                log(f"⚡ TTS cache hit: {audio_id}")
+                return audio_id
+        
+        # Generate audio on the shared synthesis worker
+        with timed_stage('tts'):
+            future = tts_scheduler.submit(text, voice_key, conds)
+            try:
+                wav = future.result(timeout=TTS_RESULT_TIMEOUT_SECONDS)
+            except FutureTimeoutError:
+                future.cancel()
+                raise RuntimeError(f"No audio after {TTS_RESULT_TIMEOUT_SECONDS:.0f}s")
         
-        # Save audio file
-        torchaudio.save(output_path, wav, tts_model.sr)
-        print(f"💾 Voice response saved: {output_path}")
-        return output_path
+        # Encode off the request thread, keeping the canonical WAV for other formats
+        encodings = {
+            fmt: encode_executor.submit(in_context(encode_audio), wav, tts_model.sr, fmt)
+            for fmt in {'wav', audio_format}
+        }
+        for fmt, encoded in encodings.items():
+            audio_cache.put(audio_id_for(cache_key, fmt), encoded.result())
+        log(f"💾 Voice response cached: {audio_id}")
+        return audio_id
+    except TTSOverloadedError as e:
+        log(f"⚠️ {e}, replying without audio")
+        fallbacks_total.inc(kind='tts_overloaded')
+        return ""
     except Exception as e:
-        print(f"❌ TTS generation error: {e}")
+        log(f"❌ TTS generation error: {e}")
+        errors_total.inc(stage='tts')
         return ""
 
+class SentenceBuffer:
+    """Accumulates streamed text and releases sentence-sized chunks as they complete"""
+
+    def __init__(self):
+        self._pending = ""
+
+    def feed(self, text: str) -> List[str]:
+        """Add text and return any chunks that are now complete"""
+        self._pending += text
+        chunks = []
+        start = 0
+        for boundary in SENTENCE_BOUNDARY.finditer(self._pending):
+            candidate = self._pending[start:boundary.start()].strip()
+            # Shorter fragments are merged with the next sentence
+            if len(candidate) >= MIN_SENTENCE_CHARS:
+                chunks.append(candidate)
+                start = boundary.end()
+        self._pending = self._pending[start:]
+        return chunks
+
+    def flush(self) -> List[str]:
+        """Return whatever is left once the text is complete"""
+        remaining = self._pending.strip()
+        self._pending = ""
+        return [remaining] if remaining else []
+
+class SpeechPipeline:
+    """Producer/consumer pipeline that synthesizes sentences while a reply is still arriving.
+
+    Sentences are queued with put() as soon as they are complete and a worker
+    thread synthesizes them in order. Finished chunks are collected without
+    blocking via ready(), or with drain() after close().
+    """
+
+    _done = object()
+
+    def __init__(self, voice_id: Optional[str] = None, audio_format: str = 'wav'):
+        self.voice_id = voice_id
+        self.audio_format = audio_format
+        self._sentences: queue.Queue = queue.Queue()
+        self._chunks: queue.Queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self._cancelled = threading.Event()
+        self._count = 0
+        self._finished = False
+        self._worker = threading.Thread(target=in_context(self._run), name="tts-stream", daemon=True)
+        self._worker.start()
+
+    def put(self, sentence: str):
+        self._sentences.put((self._count, sentence))
+        self._count += 1
+
+    def close(self):
+        """No more sentences will follow"""
+        self._sentences.put(self._done)
+
+    def _run(self):
+        try:
+            while not self._cancelled.is_set():
+                item = self._sentences.get()
+                if item is self._done:
+                    break
+                index, sentence = item
+                audio_id = generate_voice_response(sentence, self.voice_id, self.audio_format)
+                self._chunks.put((index, sentence, audio_id))
+        finally:
+            self._chunks.put(self._done)
+
+    def _take(self, block: bool):
+        while not self._finished:
+            try:
+                item = self._chunks.get(block=block)
+            except queue.Empty:
+                return
+            if item is self._done:
+                self._finished = True
+                return
+            yield item
+
+    def ready(self):
+        """Yield (index, text, audio_id) for chunks that are already synthesized"""
+        return self._take(block=False)
+
+    def drain(self):
+        """Yield the remaining chunks as they finish"""
+        return self._take(block=True)
+
+    def cancel(self):
+        """Stop synthesizing (e.g. the client went away) and let the worker exit"""
+        self._cancelled.set()
+        self._sentences.put(self._done)
+        while self._worker.is_alive():
+            try:
+                self._chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+def sse_event(event: str, data: Dict) -> str:
+    """Format a server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def current_session() -> ConversationSession:
+    """Conversation session for the current request, keyed by the session cookie"""
+    if 'conversation' not in g:
+        g.conversation = session_store.get(request.cookies.get(SESSION_COOKIE))
+    return g.conversation
+
+@app.before_request
+def start_request():
+    """Assign the request ID and count the request as in flight"""
+    incoming = request.headers.get(REQUEST_ID_HEADER, '')
+    g.request_id = incoming if REQUEST_ID_PATTERN.match(incoming) else uuid.uuid4().hex[:16]
+    g.request_start = time.perf_counter()
+    request_id_var.set(g.request_id)
+    http_in_flight.inc()
+    if not request.path.startswith('/debug/'):
+        g.memory_snapshot = memory_profiler.begin()
+
+@app.after_request
+def finish_request(response):
+    """Echo the request ID and record the request in the HTTP metrics"""
+    endpoint = request.endpoint or 'unmatched'
+    response.headers[REQUEST_ID_HEADER] = g.request_id
+    http_requests_total.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    http_request_seconds.observe(time.perf_counter() - g.request_start, endpoint=endpoint)
+    return response
+
+@app.teardown_request
+def end_request(error=None):
+    """Runs once the response (including a streamed body) is finished"""
+    if 'request_start' in g:
+        http_in_flight.dec()
+    if g.get('memory_snapshot') is not None:
+        memory_profiler.end(g.memory_snapshot, request.endpoint or 'unmatched')
+    request_id_var.set(None)
+
+@app.after_request
+def set_session_cookie(response):
+    """Issue the session cookie to new browsers"""
+    conversation = g.get('conversation')
+    if conversation and request.cookies.get(SESSION_COOKIE) != conversation.session_id:
+        response.set_cookie(SESSION_COOKIE, conversation.session_id, httponly=True, samesite='Lax')
+    return response
+
 def cleanup_temp_file(file_path: str):
     """Safely delete temporary file"""
     try:
         if file_path and os.path.exists(file_path):
             os.unlink(file_path)
-            print(f"🗑️ Cleaned up: {file_path}")
+            log(f"🗑️ Cleaned up: {file_path}")
     except Exception as e:
-        print(f"⚠️ Cleanup error: {e}")
+        log(f"⚠️ Cleanup error: {e}")
 
 @app.route('/')
 def index():
@@ -168,7 +3232,7 @@ def index():
 @app.route('/upload_reference', methods=['POST'])
 def upload_reference():
     """Upload reference audio for voice cloning"""
-    global reference_audio_path
+    conversation = current_session()
     
     if 'audio' not in request.files:
         return jsonify({'error': 'No audio file provided'}), 400
@@ -177,141 +3241,514 @@ def upload_reference():
     if file.filename == '':
         return jsonify({'error': 'No file selected'}), 400
     
+    if TEXT_ONLY:
+        return jsonify({'error': 'Voice cloning is disabled in text-only mode'}), 503
+    if not component_ready('tts'):
+        return jsonify({'error': 'TTS model is not loaded yet'}), 503
+    
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    sweep_stale_uploads()
+    reference_path = str(UPLOAD_DIR / f"reference_{uuid.uuid4().hex}.wav")
     try:
-        # Clean up previous reference audio
-        if reference_audio_path:
-            cleanup_temp_file(reference_audio_path)
+        # Save the normalized reference just long enough to compute its conditioning
+        try:
+            with timed_stage('normalize'):
+                reference = normalize_reference_audio(file.read())
+        except Exception as e:
+            log(f"⚠️ Could not decode reference audio: {e}")
+            return jsonify({'error': 'Could not read the reference audio file'}), 400
+        Path(reference_path).write_bytes(reference)
+        log(f"📁 Reference audio saved: {reference_path}")
         
-        # Save new reference audio
-        filename = f"reference_{uuid.uuid4().hex}.wav"
-        reference_audio_path = os.path.join(tempfile.gettempdir(), filename)
-        file.save(reference_audio_path)
-        
-        print(f"📁 Reference audio saved: {reference_audio_path}")
-        return jsonify({'message': 'Reference audio uploaded successfully'})
+        voice_id = prepare_voice(reference_path)
+        session_store.set_voice(conversation, voice_id)
+        return jsonify({
+            'message': 'Reference audio uploaded successfully',
+            'voice_id': voice_id,
+            'prepare_seconds': round(voice_prepare_seconds.get(voice_id, 0.0), 3)
+        })
     except Exception as e:
-        print(f"❌ Upload error: {e}")
+        log(f"❌ Upload error: {e}")
+        errors_total.inc(stage='upload_reference')
         return jsonify({'error': str(e)}), 500
+    finally:
+        cleanup_temp_file(reference_path)
+
+def read_user_input():
+    """Extract the user's message from the request, transcribing voice input.
+
+    Returns (user_input, None) on success or (None, error_response) otherwise.
+    """
+    input_type = request.form.get('type', 'text')
+    if not component_ready('llm') or (input_type in ('voice', 'stream') and not component_ready('stt')):
+        return None, (jsonify({'error': 'Luna is still starting up, please try again shortly'}), 503)
+    
+    # Process input based on type
+    if input_type == 'stream':
+        stream = voice_streams.get(request.form.get('stream_id', ''), current_session().session_id)
+        if stream is None:
+            return None, (jsonify({'error': 'Unknown or expired voice stream'}), 404)
+        
+        # Earlier segments were transcribed while the user was still speaking
+        user_input = voice_streams.finish(stream)
+        if not user_input:
+            return None, (jsonify({'error': 'Could not transcribe audio'}), 400)
+    
+    elif input_type == 'voice':
+        if 'audio' not in request.files:
+            return None, (jsonify({'error': 'No audio file provided'}), 400)
+        
+        audio_file = request.files['audio']
+        if audio_file.filename == '':
+            return None, (jsonify({'error': 'No file selected'}), 400)
+        
+        # Transcribe the upload straight from memory
+        with timed_stage('upload'):
+            audio_bytes = audio_file.read()
+        filename = audio_file.filename
+        if not TEXT_ONLY:
+            audio_bytes, filename = normalize_input_audio(audio_bytes, filename)
+        user_input = transcribe_audio(audio_bytes, filename)
+        if not user_input:
+            return None, (jsonify({'error': 'Could not transcribe audio'}), 400)
+            
+    else:  # text input
+        user_input = request.form.get('message', '').strip()
+        if not user_input:
+            return None, (jsonify({'error': 'No message provided'}), 400)
+    
+    log(f"👤 User input ({input_type}): {user_input}")
+    return user_input, None
+
+@app.route('/voice/start', methods=['POST'])
+def voice_start():
+    """Open a streaming voice input; chunks go to /voice/<stream_id>/chunk"""
+    if TEXT_ONLY:
+        # Server-side VAD needs torch; the client falls back to uploading whole recordings
+        return jsonify({'error': 'Streaming voice input is disabled in text-only mode'}), 503
+    if not component_ready('stt'):
+        return jsonify({'error': 'Speech recognition is not loaded yet'}), 503
+    stream = voice_streams.create(current_session().session_id)
+    return jsonify({
+        'stream_id': stream.stream_id,
+        'sample_rate': VOICE_STREAM_RATE,
+        'encoding': 'pcm_s16le',
+        'max_seconds': VOICE_STREAM_MAX_SECONDS
+    })
+
+@app.route('/voice/<stream_id>/chunk', methods=['POST'])
+def voice_chunk(stream_id):
+    """Append raw mono PCM16 audio to a voice stream and report voice activity.
+
+    Once `end_of_utterance` is true the client should stop recording and send
+    the stream to /chat or /chat/stream with type=stream and the stream ID.
+    """
+    stream = voice_streams.get(stream_id, current_session().session_id)
+    if stream is None:
+        return jsonify({'error': 'Unknown or expired voice stream'}), 404
+    
+    with timed_stage('upload'):
+        pcm = request.get_data(cache=False)
+    if stream.received_bytes + len(pcm) > VOICE_STREAM_MAX_SECONDS * VOICE_STREAM_RATE * 2:
+        return jsonify({'error': 'Voice message is too long'}), 413
+    return jsonify(stream.feed(pcm))
 
 @app.route('/chat', methods=['POST'])
 def chat():
     """Process chat input (voice or text)"""
-    temp_files = []
-    
     try:
-        user_input = ""
-        input_type = request.form.get('type', 'text')
+        user_input, error = read_user_input()
+        if error:
+            return error
         
-        # Process input based on type
-        if input_type == 'voice':
-            if 'audio' not in request.files:
-                return jsonify({'error': 'No audio file provided'}), 400
-            
-            audio_file = request.files['audio']
-            if audio_file.filename == '':
-                return jsonify({'error': 'No file selected'}), 400
-            
-            # Save and transcribe audio
-            temp_audio_path = os.path.join(tempfile.gettempdir(), f"input_{uuid.uuid4().hex}.wav")
-            audio_file.save(temp_audio_path)
-            temp_files.append(temp_audio_path)
-            
-            user_input = transcribe_audio(temp_audio_path)
-            if not user_input:
-                return jsonify({'error': 'Could not transcribe audio'}), 400
-                
-        else:  # text input
-            user_input = request.form.get('message', '').strip()
-            if not user_input:
-                return jsonify({'error': 'No message provided'}), 400
-        
-        print(f"👤 User input ({input_type}): {user_input}")
+        conversation = current_session()
+        audio_format = negotiate_audio_format()
         
         # Generate AI response
-        ai_response = generate_ai_response(user_input)
+        ai_response = generate_ai_response(user_input, conversation)
+        
+        # Until the TTS model is warm, reply with text only
+        voice_ready = component_ready('tts')
+        if not voice_ready and not TEXT_ONLY:
+            fallbacks_total.inc(kind='text_only')
+        if voice_ready and request.form.get('async') in ('1', 'true'):
+            return submit_voice_job(conversation, user_input, ai_response, audio_format)
         
         # Generate voice response
-        voice_file_path = generate_voice_response(ai_response, reference_audio_path)
-        if voice_file_path:
-            temp_files.append(voice_file_path)
+        audio_id = generate_voice_response(ai_response, conversation.voice_id, audio_format) if voice_ready else ""
         
         # Add to chat history
-        chat_history.extend([
-            {
-                'type': 'user',
-                'content': user_input,
-                'timestamp': datetime.now().isoformat()
-            },
-            {
-                'type': 'assistant',
-                'content': ai_response,
-                'timestamp': datetime.now().isoformat(),
-                'audio_file': voice_file_path if voice_file_path else None
-            }
-        ])
+        session_store.add_turn(conversation, user_input, ai_response, audio_id)
         
         # Prepare response
         response_data = {
             'user_message': user_input,
             'ai_response': ai_response,
-            'audio_available': bool(voice_file_path)
+            'audio_available': bool(audio_id)
         }
         
-        if voice_file_path:
-            response_data['audio_url'] = f'/audio/{os.path.basename(voice_file_path)}'
+        if audio_id:
+            response_data['audio_url'] = f'/audio/{audio_id}'
         
         return jsonify(response_data)
         
     except Exception as e:
-        print(f"❌ Chat processing error: {e}")
+        log(f"❌ Chat processing error: {e}")
+        errors_total.inc(stage='chat')
         return jsonify({'error': str(e)}), 500
-    finally:
-        # Clean up input audio file (but keep response audio for playback)
-        for temp_file in temp_files[:-1]:  # Keep the last file (response audio)
-            cleanup_temp_file(temp_file)
+
+def submit_voice_job(conversation: ConversationSession, user_input: str, ai_response: str, audio_format: str):
+    """Record the turn, synthesize its voice reply on the job pool and answer with the job ID"""
+    message = session_store.add_turn(conversation, user_input, ai_response)
+    job = job_store.create()
+    
+    def run():
+        job_store.update(job, 'synthesizing')
+        audio_id = generate_voice_response(ai_response, conversation.voice_id, audio_format)
+        if audio_id:
+            session_store.attach_audio(conversation, message, audio_id)
+            job_store.update(job, 'done', audio_id=audio_id)
+        else:
+            job_store.update(job, 'failed', error='Voice generation failed')
+    
+    job_executor.submit(in_context(run))
+    return jsonify({
+        'user_message': user_input,
+        'ai_response': ai_response,
+        'job_id': job.job_id,
+        'status_url': f'/jobs/{job.job_id}'
+    }), 202
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Report the progress of an asynchronous chat job"""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Stream stage changes of an asynchronous chat job as server-sent events"""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    def generate():
+        stage = None
+        while True:
+            if job.stage != stage:
+                stage = job.stage
+                yield sse_event('progress', job.to_dict())
+                if job.finished:
+                    return
+            elif job_store.wait(job, stage, timeout=15) == stage:
+                yield ": keep-alive\n\n"
+    
+    return Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Process chat input and stream the reply as server-sent events.
+
+    Emits a `token` event per LLM token, an `audio` event for each sentence as
+    soon as it is synthesized (sentences go to TTS while the LLM is still
+    writing), a `text` event with the full reply, then `done`.
+    """
+    user_input, error = read_user_input()
+    if error:
+        return error
+    
+    conversation = current_session()
+    audio_format = negotiate_audio_format()
+    
+    def generate():
+        # Until the TTS model is warm, stream text only
+        pipeline = SpeechPipeline(conversation.voice_id, audio_format) if component_ready('tts') else None
+        if pipeline is None and not TEXT_ONLY:
+            fallbacks_total.inc(kind='text_only')
+        sentences = SentenceBuffer()
+        audio_files = []
+        
+        def audio_events(chunks):
+            for index, sentence, audio_id in chunks:
+                if audio_id:
+                    audio_files.append(audio_id)
+                    yield sse_event('audio', {
+                        'index': index,
+                        'text': sentence,
+                        'audio_url': f'/audio/{audio_id}'
+                    })
+        
+        try:
+            parts = []
+            for token in stream_ai_response(user_input, conversation):
+                parts.append(token)
+                yield sse_event('token', {'text': token})
+                if pipeline:
+                    for sentence in sentences.feed(token):
+                        pipeline.put(sentence)
+                    yield from audio_events(pipeline.ready())
+            
+            ai_response = "".join(parts).strip()
+            yield sse_event('text', {'user_message': user_input, 'ai_response': ai_response})
+            
+            if pipeline:
+                for sentence in sentences.flush():
+                    pipeline.put(sentence)
+                pipeline.close()
+                yield from audio_events(pipeline.drain())
+            
+            session_store.add_turn(
+                conversation, user_input, ai_response,
+                audio_files[0] if audio_files else None, audio_files
+            )
+            yield sse_event('done', {'audio_available': bool(audio_files), 'chunks': len(audio_files)})
+        except Exception as e:
+            log(f"❌ Chat streaming error: {e}")
+            errors_total.inc(stage='chat_stream')
+            yield sse_event('error', {'error': str(e)})
+        finally:
+            if pipeline:
+                pipeline.cancel()
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 @app.route('/audio/<filename>')
 def serve_audio(filename):
-    """Serve generated audio files"""
+    """Serve generated audio files.
+
+    A `format` query parameter (or, for a bare ID, the Accept header) selects
+    another encoding of the same clip. Clips never change under their ID, so
+    responses carry a strong ETag and an immutable Cache-Control header and
+    honour If-None-Match and Range requests.
+    """
     try:
-        file_path = os.path.join(tempfile.gettempdir(), filename)
-        if not os.path.exists(file_path):
-            return "Audio file not found", 404
-        
-        return send_file(file_path, mimetype='audio/wav')
+        with timed_stage('audio_serve'):
+            cache_key = filename.split('.', 1)[0]
+            negotiated = '.' not in filename and not request.args.get('format')
+            if '.' not in filename or request.args.get('format'):
+                audio_format = negotiate_audio_format(default=audio_format_for(filename))
+            else:
+                audio_format = audio_format_for(filename)
+            
+            audio_id = audio_id_for(cache_key, audio_format)
+            response = send_audio(audio_id, audio_format)
+            if response is None:
+                # Not cached in this format yet: transcode from the canonical clip
+                if load_audio_variant(cache_key, audio_format) is None:
+                    return "Audio file not found", 404
+                response = send_audio(audio_id, audio_format)
+            if response is None:
+                return "Audio file not found", 404
+            if negotiated:
+                response.vary.add('Accept')
+            kind = {206: 'partial', 304: 'not_modified'}.get(response.status_code, 'full')
+            audio_responses.inc(kind=kind)
+            audio_sent_bytes.inc(response.content_length or 0)
+            return response
     except Exception as e:
-        print(f"❌ Audio serving error: {e}")
+        log(f"❌ Audio serving error: {e}")
+        errors_total.inc(stage='audio_serve')
         return str(e), 500
 
+@app.route('/stats')
+def get_stats():
+    """Cache and performance counters"""
+    with input_audio_stats_lock:
+        input_audio = {**input_audio_stats, 'trimmed_seconds': round(input_audio_stats['trimmed_seconds'], 2)}
+    return jsonify({
+        'voice_cache': {
+            **voice_cache_stats,
+            'seconds_saved': round(voice_cache_stats['seconds_saved'], 3),
+            'voices': len(voice_conditionals)
+        },
+        'audio_cache': audio_cache.snapshot(),
+        'sessions': session_store.snapshot(),
+        'tts_scheduler': tts_scheduler.snapshot(),
+        'jobs': job_store.snapshot(),
+        'voice_streams': voice_streams.snapshot(),
+        'backends': {'stt': stt_caller.snapshot(), 'llm': llm_caller.snapshot()},
+        'startup': startup_report(),
+        'response_cache': response_cache.snapshot() if response_cache else {'enabled': False},
+        'input_audio': input_audio,
+        'stages': stage_summary()
+    })
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def admin_error():
+    """None if the request carries the admin token, otherwise the error response"""
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Not found'}), 404
+    supplied = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(supplied.encode(), f"Bearer {ADMIN_TOKEN}".encode()):
+        return jsonify({'error': 'Admin token required'}), 401
+    return None
+
+def bounded_int(name: str, default: int, maximum: int) -> int:
+    """Integer request parameter clamped to 1..maximum; raises ValueError if malformed"""
+    return max(1, min(maximum, int(request.values.get(name, default))))
+
+@app.route('/debug/profile/cpu', methods=['POST'])
+def profile_cpu():
+    """Sample all threads for `seconds` and return collapsed stacks"""
+    error = admin_error()
+    if error:
+        return error
+    try:
+        seconds = bounded_int('seconds', 10, PROFILE_MAX_SECONDS)
+        interval = bounded_int('interval_ms', 10, 1000) / 1000
+    except ValueError:
+        return jsonify({'error': 'seconds and interval_ms must be integers'}), 400
+    if not stack_sampler_lock.acquire(blocking=False):
+        return jsonify({'error': 'A CPU profile is already running'}), 409
+    try:
+        log(f"🔬 Sampling stacks for {seconds}s")
+        stacks = sample_stacks(seconds, interval)
+    finally:
+        stack_sampler_lock.release()
+    return Response(stacks, content_type='text/plain; charset=utf-8')
+
+@app.route('/debug/profile/torch', methods=['GET', 'POST'])
+def profile_torch():
+    """POST arms a torch profiler capture of the next `calls` voice generations; GET lists the traces"""
+    error = admin_error()
+    if error:
+        return error
+    if request.method == 'POST':
+        if TEXT_ONLY:
+            return jsonify({'error': 'Voice generation is disabled in text-only mode'}), 503
+        if isinstance(tts_scheduler, TTSProcessPool):
+            return jsonify({'error': 'Synthesis runs in TTS worker processes, which the profiler cannot see'}), 503
+        try:
+            calls = bounded_int('calls', 3, PROFILE_MAX_CAPTURES)
+        except ValueError:
+            return jsonify({'error': 'calls must be an integer'}), 400
+        torch_trace.arm(calls)
+        log(f"🔬 Torch profiler armed for the next {calls} voice generation(s)")
+    return jsonify(torch_trace.snapshot())
+
+@app.route('/debug/profile/torch/<trace_id>')
+def profile_torch_trace(trace_id):
+    """Chrome trace JSON of one capture (open in Perfetto or chrome://tracing)"""
+    error = admin_error()
+    if error:
+        return error
+    path = torch_trace.trace_path(trace_id)
+    if path is None or not path.exists():
+        return jsonify({'error': 'Unknown trace'}), 404
+    return send_file(path, mimetype='application/json', download_name=f"luna_trace_{trace_id}.json")
+
+@app.route('/debug/profile/memory', methods=['GET', 'POST'])
+def profile_memory():
+    """POST arms allocation snapshots for the next `requests` requests; GET returns them"""
+    error = admin_error()
+    if error:
+        return error
+    if request.method == 'POST':
+        try:
+            requests_to_capture = bounded_int('requests', 5, PROFILE_MAX_CAPTURES)
+        except ValueError:
+            return jsonify({'error': 'requests must be an integer'}), 400
+        memory_profiler.arm(requests_to_capture)
+        log(f"🔬 Memory snapshots armed for the next {requests_to_capture} request(s)")
+    return jsonify(memory_profiler.snapshot())
+
+@app.route('/health')
+def health():
+    """Per-component model status and load durations; 503 if a component failed to load"""
+    failed = any(status['state'] == 'failed' for status in model_status.values())
+    return jsonify({'status': 'unhealthy' if failed else 'ok', 'components': model_status}), 503 if failed else 200
+
+@app.route('/ready')
+def ready():
+    """Ready once chat can be served; voice replies follow when the TTS model is warm"""
+    chat_ready = component_ready('llm') and not draining.is_set()
+    payload = {
+        'ready': chat_ready,
+        'draining': draining.is_set(),
+        'voice_ready': component_ready('tts'),
+        'components': {name: status['state'] for name, status in model_status.items()}
+    }
+    if isinstance(tts_scheduler, TTSProcessPool):
+        payload['tts_workers'] = tts_scheduler.worker_states()
+    return jsonify(payload), 200 if chat_ready else 503
+
 @app.route('/history')
 def get_history():
     """Get chat history"""
-    return jsonify(chat_history)
+    return jsonify(list(current_session().history))
 
 @app.route('/clear_history', methods=['POST'])
 def clear_history():
     """Clear chat history"""
-    global chat_history
-    chat_history = []
+    session_store.clear(current_session())
     return jsonify({'message': 'Chat history cleared'})
 
+APP_IMPORT_SECONDS = time.perf_counter() - APP_IMPORT_STARTED
+
+def startup_report() -> Dict:
+    """Import and model load times with resident memory, for the stats endpoint and --profile-startup"""
+    return {
+        'text_only': TEXT_ONLY,
+        'app_import_seconds': round(APP_IMPORT_SECONDS, 3),
+        'imports': dict(startup_imports),
+        'models': {name: status.get('seconds') for name, status in model_status.items()},
+        'rss_bytes': process_memory_bytes()
+    }
+
+def profile_startup() -> int:
+    """Load every model in the foreground and print where startup time and memory went"""
+    success = initialize_models()
+    report = startup_report()
+    log(f"⏱️ app imported in {report['app_import_seconds']:.2f}s")
+    for name, entry in report['imports'].items():
+        log(f"   {name}: {entry['seconds']:.2f}s, +{entry['rss_added_bytes'] / 2**20:.0f} MB")
+    for name, seconds in report['models'].items():
+        log(f"   {name} model: {'-' if seconds is None else f'{seconds:.2f}s'}")
+    log(f"📊 Resident memory: {(report['rss_bytes'] or 0) / 2**20:.0f} MB")
+    return 0 if success else 1
+
 if __name__ == '__main__':
-    print("🎤 Voice Chat Application Starting...")
+    import argparse
+    parser = argparse.ArgumentParser(description="Luna development server")
+    parser.add_argument('--text-only', action='store_true', help='serve text replies without loading torch or the TTS model')
+    parser.add_argument('--profile-startup', action='store_true', help='load the models, report import/load times and memory, then exit')
+    args = parser.parse_args()
+    if args.text_only:
+        enable_text_only()
+    
+    log("🎤 Voice Chat Application Starting...")
     
     # Check for required environment variables
-    if not os.getenv('GROQ_API_KEY'):
-        print("❌ GROQ_API_KEY environment variable is required")
-        print("Please set it with: set GROQ_API_KEY=your_api_key_here")
+    if 'groq' in (STT_BACKEND, LLM_BACKEND) and not os.getenv('GROQ_API_KEY'):
+        log("❌ GROQ_API_KEY environment variable is required")
+        log("Please set it with: set GROQ_API_KEY=your_api_key_here")
         exit(1)
     
-    # Initialize models
-    if not initialize_models():
-        print("❌ Failed to initialize models. Exiting...")
-        exit(1)
+    if args.profile_startup:
+        PROFILE_STARTUP = True
+        exit(profile_startup())
+    
+    # Load models in the background; chat is served text-only until TTS is warm
+    start_background_initialization()
     
     # Create templates directory if it doesn't exist
     os.makedirs('templates', exist_ok=True)
     os.makedirs('static', exist_ok=True)
     
-    print("🌟 Starting Flask server...")
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    # Development server; use serve.py for production
+    log("🌟 Starting Flask development server (run serve.py for production)...")
+    app.run(debug=os.getenv('LUNA_DEBUG', '0') == '1', host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+End-to-end latency benchmark for the Voice Chat Application
+Drives /chat with a configurable concurrency and text/voice mix, using the
+offline STT/LLM stand-ins by default, and emits per-stage p50/p95/p99,
+throughput and peak RSS as JSON so runs can be compared.
+
+With --tts-ab it instead compares the TTS model with and without the CPU
+optimizations (int8 quantization, optional torch.compile): real-time factor
+per variant and how close the optimized output sounds to the baseline
+"""
+
+import argparse
+import io
+import json
+import math
+import os
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+TEXT_MESSAGES = [
+    "Hi Luna, how are you today?",
+    "I feel stressed about work and I can't switch off in the evenings.",
+    "Thank you, that really helps.",
+    "I haven't been sleeping well this week.",
+    "Can you suggest a quick breathing exercise?",
+]
+
+def log(message: str):
+    """Progress output goes to stderr so stdout stays valid JSON"""
+    print(message, file=sys.stderr)
+
+def make_voice_clip(seconds: float = 1.5, sample_rate: int = 16000) -> bytes:
+    """A short 16-bit mono WAV tone standing in for a recorded voice message"""
+    frames = int(seconds * sample_rate)
+    samples = (int(8000 * math.sin(2 * math.pi * 220 * n / sample_rate)) for n in range(frames))
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as clip:
+        clip.setnchannels(1)
+        clip.setsampwidth(2)
+        clip.setframerate(sample_rate)
+        clip.writeframes(b''.join(struct.pack('<h', sample) for sample in samples))
+    return buffer.getvalue()
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, if the platform exposes it"""
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            return round(psutil.Process().memory_info().peak_wset / (1024 * 1024), 1)
+        except (ImportError, AttributeError):
+            return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return round(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024, 1)
+
+def summarize(values):
+    """Latency percentiles in milliseconds"""
+    ordered = sorted(values)
+    if not ordered:
+        return {'count': 0}
+
+    def pct(fraction):
+        index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+        return round(ordered[index] * 1000, 2)
+
+    return {
+        'count': len(ordered),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 2),
+        'p50_ms': pct(0.50),
+        'p95_ms': pct(0.95),
+        'p99_ms': pct(0.99),
+        'max_ms': round(ordered[-1] * 1000, 2)
+    }
+
+class InProcessClient:
+    """Talks to the Flask app through its test client (one cookie jar per worker thread)"""
+
+    def __init__(self, flask_app):
+        self.client = flask_app.test_client()
+
+    def chat(self, fields, clip=None):
+        data = dict(fields)
+        if clip is not None:
+            data['audio'] = (io.BytesIO(clip), 'recording.wav')
+        response = self.client.post('/chat', data=data, content_type='multipart/form-data')
+        return response.status_code, response.get_json(silent=True) or {}
+
+    def fetch(self, url):
+        response = self.client.get(url)
+        return response.status_code, response.data
+
+    def stats(self):
+        return self.client.get('/stats').get_json()
+
+class HttpClient:
+    """Talks to a running server over HTTP"""
+
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+
+    def chat(self, fields, clip=None):
+        files = {'audio': ('recording.wav', clip, 'audio/wav')} if clip is not None else None
+        response = self.session.post(f'{self.base_url}/chat', data=fields, files=files)
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        return response.status_code, body
+
+    def fetch(self, url):
+        response = self.session.get(f'{self.base_url}{url}')
+        return response.status_code, response.content
+
+    def stats(self):
+        return self.session.get(f'{self.base_url}/stats').json()
+
+def run_request(client, index: int, args, clip: bytes, rng: random.Random):
+    """Send one chat turn, fetch its audio and time both"""
+    voice = rng.random() < args.voice_ratio
+    fields = {'type': 'voice' if voice else 'text', 'format': args.format}
+    if not voice:
+        message = rng.choice(TEXT_MESSAGES)
+        fields['message'] = f"{message} (request {index})" if args.unique else message
+
+    start = time.perf_counter()
+    status, body = client.chat(fields, clip if voice else None)
+    chat_seconds = time.perf_counter() - start
+
+    result = {'kind': fields['type'], 'ok': status == 200, 'chat_seconds': chat_seconds, 'audio_bytes': 0}
+    if status == 200 and body.get('audio_url'):
+        fetch_start = time.perf_counter()
+        audio_status, audio = client.fetch(body['audio_url'])
+        result['audio_seconds'] = time.perf_counter() - fetch_start
+        result['audio_bytes'] = len(audio)
+        result['ok'] = audio_status == 200
+    result['total_seconds'] = time.perf_counter() - start
+    return result
+
+def run_benchmark(make_client, args, after_warmup=None):
+    """Run warm-up turns, then the measured workload; returns per-request results and wall time"""
+    clip = make_voice_clip()
+    local = threading.local()
+
+    def worker(index):
+        if not hasattr(local, 'client'):
+            local.client = make_client()
+        return run_request(local.client, index, args, clip, random.Random(args.seed * 100003 + index))
+
+    for index in range(args.warmup):
+        worker(-1 - index)
+    if after_warmup:
+        after_warmup()
+
+    log(f"🏁 Running {args.requests} request(s) at concurrency {args.concurrency}...")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(worker, range(args.requests)))
+    return results, time.perf_counter() - start
+
+def spectral_similarity(a, b, sample_rate: int) -> float:
+    """Cosine similarity of the average log-mel spectra of two clips.
+
+    Sampling makes the two variants produce different waveforms for the same
+    text, so this compares the overall timbre rather than samples.
+    """
+    import torch
+    import torchaudio
+    mel = torchaudio.transforms.MelSpectrogram(sample_rate=sample_rate, n_mels=80)
+    profiles = [torch.log(mel(clip.float()) + 1e-6).mean(dim=-1).flatten() for clip in (a, b)]
+    return round(torch.nn.functional.cosine_similarity(profiles[0], profiles[1], dim=0).item(), 4)
+
+def run_tts_ab(args):
+    """Synthesize the same sentences with the baseline and the optimized model"""
+    import torch
+    os.environ['LUNA_TTS_BACKEND'] = args.tts
+    import app
+    app.configure_torch_threads()
+
+    sentences = TEXT_MESSAGES[:args.ab_sentences]
+    variants = {}
+    clips = {}
+    for variant in ('baseline', 'optimized'):
+        log(f"🔄 Loading {variant} model...")
+        model = app.create_tts_model(device="cpu")
+        applied = []
+        if variant == 'optimized':
+            applied = app.optimize_tts_model(model, quantize=True, compile_paths=args.ab_compile)
+        with torch.inference_mode():
+            model.generate(app.TTS_WARMUP_TEXT)
+            factors = []
+            clips[variant] = []
+            for index, sentence in enumerate(sentences):
+                torch.manual_seed(args.seed + index)
+                start = time.perf_counter()
+                wav = model.generate(sentence)
+                elapsed = time.perf_counter() - start
+                factors.append(elapsed / (wav.shape[-1] / model.sr))
+                clips[variant].append(wav)
+        variants[variant] = {
+            'optimizations': applied,
+            'mean_rtf': round(sum(factors) / len(factors), 4),
+            'max_rtf': round(max(factors), 4)
+        }
+        log(f"⏱️ {variant}: mean RTF {variants[variant]['mean_rtf']}")
+        sample_rate = model.sr
+        del model
+
+    similarity = [spectral_similarity(a, b, sample_rate) for a, b in zip(clips['baseline'], clips['optimized'])]
+    durations = [b.shape[-1] / a.shape[-1] for a, b in zip(clips['baseline'], clips['optimized'])]
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'config': {'tts': args.tts, 'sentences': len(sentences), 'torch_threads': torch.get_num_threads()},
+        'variants': variants,
+        'speedup': round(variants['baseline']['mean_rtf'] / variants['optimized']['mean_rtf'], 3),
+        'similarity': {'mean': round(sum(similarity) / len(similarity), 4), 'min': min(similarity)},
+        'duration_ratio': round(sum(durations) / len(durations), 3),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def compare(report, baseline_path: str, threshold: float) -> bool:
+    """Print p95 deltas against a previous report; returns False if anything regressed"""
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+
+    ok = True
+    sections = [('end_to_end', report['end_to_end'], baseline.get('end_to_end', {}))]
+    sections += [
+        (f"stage:{stage}", stats, baseline.get('stages', {}).get(stage, {}))
+        for stage, stats in report['stages'].items()
+    ]
+    for name, current, previous in sections:
+        if not previous.get('p95_ms') or not current.get('p95_ms'):
+            continue
+        change = (current['p95_ms'] - previous['p95_ms']) / previous['p95_ms']
+        regressed = change > threshold
+        ok = ok and not regressed
+        log(f"{'❌' if regressed else '✅'} {name}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms ({change:+.1%})")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=50, help='measured chat turns')
+    parser.add_argument('--concurrency', type=int, default=4, help='simultaneous clients')
+    parser.add_argument('--voice-ratio', type=float, default=0.3, help='fraction of turns sent as voice')
+    parser.add_argument('--warmup', type=int, default=2, help='unmeasured turns before the run')
+    parser.add_argument('--format', default='wav', help='reply audio format (wav, wav16k, opus)')
+    parser.add_argument('--repeat', dest='unique', action='store_false',
+                        help='reuse identical messages so the TTS cache is exercised')
+    parser.add_argument('--tts', default='fake', choices=['fake', 'chatterbox'], help='TTS backend for in-process runs')
+    parser.add_argument('--real-backends', action='store_true', help='use Groq instead of the offline STT/LLM stand-ins')
+    parser.add_argument('--url', help='benchmark a running server instead of the in-process app')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report to this file')
+    parser.add_argument('--baseline', help='previous JSON report to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed p95 regression (fraction)')
+    parser.add_argument('--tts-ab', action='store_true', help='compare the TTS model with and without CPU optimizations')
+    parser.add_argument('--ab-sentences', type=int, default=len(TEXT_MESSAGES), help='sentences synthesized per variant')
+    parser.add_argument('--ab-compile', nargs='*', default=[], metavar='MODULE',
+                        help='also torch.compile these submodules (dotted paths, e.g. t3.tfmr)')
+    args = parser.parse_args()
+
+    if args.tts_ab:
+        output = json.dumps(run_tts_ab(args), indent=2)
+        if args.output:
+            with open(args.output, 'w') as file:
+                file.write(output)
+        print(output)
+        return 0
+
+    if args.url:
+        make_client = lambda: HttpClient(args.url)
+    else:
+        # Configure the app before importing it; settings are read at import time
+        if not args.real_backends:
+            os.environ['LUNA_STT_BACKEND'] = 'fake'
+            os.environ['LUNA_LLM_BACKEND'] = 'fake'
+        os.environ['LUNA_TTS_BACKEND'] = args.tts
+        os.environ.setdefault('LUNA_AUDIO_CACHE_DIR', tempfile.mkdtemp(prefix='luna_bench_'))
+
+        log("🔄 Loading application...")
+        import app
+        if not app.initialize_models():
+            log("❌ Failed to initialize models")
+            return 1
+        make_client = lambda: InProcessClient(app.app)
+
+    results, wall_seconds = run_benchmark(make_client, args, None if args.url else app.reset_stage_samples)
+    if args.url:
+        # A remote server reports cumulative stage timings since it started
+        stages = make_client().stats().get('stages', {})
+    else:
+        stages = app.stage_summary()
+
+    succeeded = [result for result in results if result['ok']]
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'config': {
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'voice_ratio': args.voice_ratio,
+            'format': args.format,
+            'unique_messages': args.unique,
+            'tts': None if args.url else args.tts,
+            'backends': 'groq' if args.real_backends else 'fake',
+            'target': args.url or 'in-process'
+        },
+        'errors': len(results) - len(succeeded),
+        'wall_seconds': round(wall_seconds, 3),
+        'throughput_rps': round(len(succeeded) / wall_seconds, 3) if wall_seconds else 0.0,
+        'end_to_end': summarize([result['total_seconds'] for result in succeeded]),
+        'chat': summarize([result['chat_seconds'] for result in succeeded]),
+        'audio_fetch': summarize([result['audio_seconds'] for result in succeeded if 'audio_seconds' in result]),
+        'by_kind': {
+            kind: summarize([result['total_seconds'] for result in succeeded if result['kind'] == kind])
+            for kind in ('text', 'voice')
+        },
+        'stages': stages,
+        'mean_audio_bytes': round(sum(r['audio_bytes'] for r in succeeded) / len(succeeded)) if succeeded else 0,
+        'peak_rss_mb': None if args.url else peak_rss_mb()
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+        log(f"💾 Report written to {args.output}")
+    print(output)
+
+    if args.baseline and not compare(report, args.baseline, args.threshold):
+        log("❌ Performance regression detected")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
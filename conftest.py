@@ -0,0 +1,14 @@
+"""Configure app.py for offline tests before it is imported"""
+
+import os
+import tempfile
+
+_scratch = tempfile.mkdtemp(prefix="luna_tests_")
+os.environ.update({
+    'LUNA_TEXT_ONLY': '1',
+    'LUNA_STT_BACKEND': 'fake',
+    'LUNA_LLM_BACKEND': 'fake',
+    'LUNA_AUDIO_CACHE_DIR': os.path.join(_scratch, 'audio'),
+    'LUNA_UPLOAD_DIR': os.path.join(_scratch, 'uploads'),
+    'LUNA_AUDIO_SWEEP_SECONDS': '0',
+})
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Production server for the Voice Chat Application
+Runs the app under gunicorn (threaded workers, models preloaded and shared
+copy-on-write) on Linux/macOS, or waitress on Windows, with keep-alive and
+request timeouts and a graceful shutdown that drains background voice jobs
+"""
+
+import _thread
+import argparse
+import os
+import signal
+import sys
+
+def log(message: str):
+    print(message, flush=True)
+
+def env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+def configure_multiprocess(workers: int):
+    """Settings that must be in place before the app is imported when several processes serve it"""
+    if workers <= 1:
+        return
+    # Clips may be generated by one worker and fetched from another
+    os.environ.setdefault('LUNA_AUDIO_CACHE_SHARED', '1')
+    os.environ.setdefault('LUNA_AUDIO_SPILL_KB', '0')
+    if not os.getenv('LUNA_SESSION_DB'):
+        log("⚠️ Several workers keep separate in-memory sessions: set LUNA_SESSION_DB")
+    if os.getenv('LUNA_VOICE_CACHE_DIR') == '':
+        log("⚠️ Voice persistence is off, so a cloned voice is only known to the worker that prepared it")
+    log("⚠️ Async jobs and streaming voice input need sticky routing across workers; "
+        "prefer one worker with threads and LUNA_TTS_WORKERS for CPU scaling")
+
+def drain_on_sigterm(luna, timeout: float, notice: float, stop):
+    """On SIGTERM, report draining on /ready while still serving, and only call stop() once drained"""
+    def handle(signum, frame):
+        luna.begin_drain(timeout, lambda: stop(signum, frame), notice)
+    signal.signal(signal.SIGTERM, handle)
+
+def check_environment(luna) -> bool:
+    if 'groq' in (luna.STT_BACKEND, luna.LLM_BACKEND) and not os.getenv('GROQ_API_KEY'):
+        log("❌ GROQ_API_KEY environment variable is required")
+        return False
+    return True
+
+def serve_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+    import app as luna
+
+    if not check_environment(luna):
+        return 1
+    preload = args.preload and luna.can_preload_models()
+
+    class LunaApplication(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': f"{args.host}:{args.port}",
+                'workers': args.workers,
+                'threads': args.threads,
+                'worker_class': 'gthread',
+                'timeout': args.timeout,
+                'keepalive': args.keep_alive,
+                # The drain happens inside this budget, before the worker stops accepting
+                'graceful_timeout': args.graceful_timeout,
+                'preload_app': True,
+                'post_fork': lambda server, worker: luna.start_worker(preload),
+                # Replaces the worker's SIGTERM handler, which would close the listeners right away
+                'post_worker_init': lambda worker: drain_on_sigterm(luna, args.drain_timeout, args.drain_notice, worker.handle_exit),
+                'worker_exit': lambda server, worker: luna.shutdown(5.0),
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return luna.app
+
+    if preload:
+        log("🔄 Preloading models before starting workers...")
+        if not luna.preload_models():
+            log("⚠️ Some models failed to load; see /health")
+    log(f"🌟 gunicorn on {args.host}:{args.port}: {args.workers} worker(s) x {args.threads} thread(s)")
+    LunaApplication().run()
+    return 0
+
+def serve_waitress(args):
+    from waitress import serve
+    import app as luna
+
+    if not check_environment(luna):
+        return 1
+
+    # serve() returns when its main loop is interrupted
+    drain_on_sigterm(luna, args.drain_timeout, args.drain_notice, lambda signum, frame: _thread.interrupt_main())
+    luna.start_worker(preloaded=False)
+    log(f"🌟 waitress on {args.host}:{args.port}: {args.threads} thread(s)")
+    try:
+        serve(luna.app, host=args.host, port=args.port, threads=args.threads, channel_timeout=args.timeout)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        luna.shutdown(5.0)
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', default='auto', choices=['auto', 'gunicorn', 'waitress'])
+    parser.add_argument('--host', default=os.getenv('LUNA_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=env_int('LUNA_PORT', 5000))
+    parser.add_argument('--workers', type=int, default=env_int('LUNA_WEB_WORKERS', 1),
+                        help='server processes (gunicorn only)')
+    parser.add_argument('--threads', type=int, default=env_int('LUNA_WEB_THREADS', 16),
+                        help='request threads per process; each open stream holds one')
+    parser.add_argument('--timeout', type=int, default=120, help='worker/connection timeout in seconds')
+    parser.add_argument('--keep-alive', type=int, default=5, help='seconds to hold idle keep-alive connections')
+    parser.add_argument('--graceful-timeout', type=int, default=60, help='seconds from SIGTERM until the worker is killed')
+    parser.add_argument('--drain-timeout', type=int, default=30,
+                        help='seconds of the graceful timeout spent reporting draining on /ready while requests, '
+                             'background voice jobs and queued synthesis finish')
+    parser.add_argument('--drain-notice', type=int, default=5,
+                        help='minimum seconds to keep serving while /ready reports draining, for load balancer health checks')
+    parser.add_argument('--no-preload', dest='preload', action='store_false',
+                        help='load models in each worker instead of once before forking')
+    parser.add_argument('--text-only', action='store_true',
+                        help='serve text replies only; torch and the TTS model are never loaded')
+    args = parser.parse_args()
+
+    server = args.server
+    if server == 'auto':
+        try:
+            import gunicorn  # noqa: F401
+            server = 'waitress' if os.name == 'nt' else 'gunicorn'
+        except ImportError:
+            server = 'waitress'
+    if server == 'waitress' and args.workers > 1:
+        log("⚠️ waitress runs a single process; ignoring --workers")
+        args.workers = 1
+
+    if args.drain_timeout >= args.graceful_timeout:
+        log("⚠️ --drain-timeout must leave part of --graceful-timeout for shutting down; shortening it")
+        args.drain_timeout = max(0, args.graceful_timeout - 5)
+
+    if args.text_only:
+        os.environ['LUNA_TEXT_ONLY'] = '1'
+    configure_multiprocess(args.workers)
+    try:
+        return serve_gunicorn(args) if server == 'gunicorn' else serve_waitress(args)
+    except ImportError as e:
+        log(f"❌ {e.name} is not installed: pip install {e.name}")
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,9 +3,11 @@ class VoiceChatApp {
     constructor() {
         this.mediaRecorder = null;
         this.audioChunks = [];
+        this.voiceStream = null; // Streaming capture: PCM chunks are uploaded while the user speaks
         this.isRecording = false;
         this.isProcessing = false;
         this.aiProcessingMessageElement = null; // To keep track of the AI processing message element
+        this.audioFormat = this.detectAudioFormat(); // Compressed replies when the browser can play them
         
         this.init();
     }
@@ -16,6 +18,11 @@ class VoiceChatApp {
         console.log('🚀 Voice Chat App initialized');
     }
 
+    detectAudioFormat() {
+        const probe = document.createElement('audio');
+        return probe.canPlayType('audio/ogg; codecs="opus"') ? 'opus' : 'wav';
+    }
+
     setupEventListeners() {
         // Voice recording
         const voiceBtn = document.getElementById('voiceBtn');
@@ -106,6 +113,14 @@ class VoiceChatApp {
             console.log('🎤 Starting recording...');
             const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
             
+            if (window.AudioContext && await this.startVoiceStream(stream)) {
+                this.isRecording = true;
+                document.getElementById('voiceBtn').classList.add('recording');
+                document.getElementById('recordingIndicator').classList.add('show');
+                return;
+            }
+            
+            // Fall back to recording the whole clip and uploading it afterwards
             this.mediaRecorder = new MediaRecorder(stream);
             this.audioChunks = [];
             
@@ -134,8 +149,12 @@ class VoiceChatApp {
         if (!this.isRecording) return;
         
         console.log('⏹️ Stopping recording...');
-        this.mediaRecorder.stop();
-        this.mediaRecorder.stream.getTracks().forEach(track => track.stop());
+        if (this.voiceStream) {
+            this.finishVoiceStream();
+        } else {
+            this.mediaRecorder.stop();
+            this.mediaRecorder.stream.getTracks().forEach(track => track.stop());
+        }
         this.isRecording = false;
         
         // Update UI
@@ -143,6 +162,141 @@ class VoiceChatApp {
         document.getElementById('recordingIndicator').classList.remove('show');
     }
 
+    async startVoiceStream(mediaStream) {
+        try {
+            const response = await fetch('/voice/start', { method: 'POST' });
+            if (!response.ok) return false;
+            const { stream_id, sample_rate } = await response.json();
+            
+            const context = new AudioContext();
+            const source = context.createMediaStreamSource(mediaStream);
+            const processor = context.createScriptProcessor(4096, 1, 1);
+            const voice = {
+                id: stream_id,
+                rate: sample_rate,
+                mediaStream, context, source, processor,
+                samples: [],        // Everything captured, for the local playback bubble
+                pending: [],        // Captured but not yet uploaded
+                pendingLength: 0,
+                sending: Promise.resolve()
+            };
+            processor.onaudioprocess = (event) => {
+                const pcm = this.downsampleToPcm16(event.inputBuffer.getChannelData(0), context.sampleRate, voice.rate);
+                voice.samples.push(pcm);
+                this.sendVoiceChunk(voice, pcm, false);
+            };
+            source.connect(processor);
+            processor.connect(context.destination);
+            this.voiceStream = voice;
+            return true;
+        } catch (error) {
+            console.warn('⚠️ Streaming capture unavailable, recording the whole clip instead:', error);
+            return false;
+        }
+    }
+
+    downsampleToPcm16(input, fromRate, toRate) {
+        const ratio = fromRate / toRate;
+        const output = new Int16Array(Math.floor(input.length / ratio));
+        for (let i = 0; i < output.length; i++) {
+            // Average the source samples that fall into each output sample
+            const start = Math.floor(i * ratio);
+            const end = Math.min(input.length, Math.floor((i + 1) * ratio));
+            let sum = 0;
+            for (let j = start; j < end; j++) sum += input[j];
+            const sample = Math.max(-1, Math.min(1, sum / Math.max(1, end - start)));
+            output[i] = sample < 0 ? sample * 0x8000 : sample * 0x7fff;
+        }
+        return output;
+    }
+
+    concatPcm(chunks) {
+        const output = new Int16Array(chunks.reduce((total, chunk) => total + chunk.length, 0));
+        let offset = 0;
+        chunks.forEach(chunk => {
+            output.set(chunk, offset);
+            offset += chunk.length;
+        });
+        return output;
+    }
+
+    sendVoiceChunk(voice, pcm, flush) {
+        if (pcm) {
+            voice.pending.push(pcm);
+            voice.pendingLength += pcm.length;
+        }
+        // Upload roughly every quarter second, in order
+        if (voice.pendingLength === 0 || (!flush && voice.pendingLength < voice.rate / 4)) return;
+        const body = this.concatPcm(voice.pending);
+        voice.pending = [];
+        voice.pendingLength = 0;
+        voice.sending = voice.sending
+            .then(() => fetch(`/voice/${voice.id}/chunk`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/octet-stream' },
+                body: body.buffer
+            }))
+            .then(response => response.json())
+            .then(state => {
+                // The server heard the end of the utterance: stop without waiting for the button
+                if (state.end_of_utterance && this.voiceStream === voice) this.stopRecording();
+            })
+            .catch(error => console.error('❌ Error uploading audio chunk:', error));
+    }
+
+    async finishVoiceStream() {
+        const voice = this.voiceStream;
+        this.voiceStream = null;
+        voice.processor.disconnect();
+        voice.source.disconnect();
+        voice.context.close();
+        voice.mediaStream.getTracks().forEach(track => track.stop());
+        
+        this.sendVoiceChunk(voice, null, true);
+        await voice.sending;
+        
+        try {
+            const audioUrl = URL.createObjectURL(this.encodeWav(voice.samples, voice.rate));
+            this.addMessageToChat('Voice message', 'user', audioUrl, true);
+            this.aiProcessingMessageElement = this.addProcessingMessage();
+            
+            const formData = new FormData();
+            formData.append('type', 'stream');
+            formData.append('stream_id', voice.id);
+            
+            console.log('📤 Finishing voice stream...');
+            await this.streamChat(formData);
+        } catch (error) {
+            console.error('❌ Error processing voice stream:', error);
+            this.showToast('Failed to process voice message. Please try again.', 'error');
+            if (this.aiProcessingMessageElement) {
+                this.aiProcessingMessageElement.remove();
+                this.aiProcessingMessageElement = null;
+            }
+        }
+    }
+
+    encodeWav(chunks, sampleRate) {
+        const pcm = this.concatPcm(chunks);
+        const view = new DataView(new ArrayBuffer(44 + pcm.length * 2));
+        const writeString = (offset, text) => [...text].forEach((char, i) => view.setUint8(offset + i, char.charCodeAt(0)));
+        writeString(0, 'RIFF');
+        view.setUint32(4, 36 + pcm.length * 2, true);
+        writeString(8, 'WAVE');
+        writeString(12, 'fmt ');
+        view.setUint32(16, 16, true);
+        view.setUint16(20, 1, true);               // PCM
+        view.setUint16(22, 1, true);               // Mono
+        view.setUint32(24, sampleRate, true);
+        view.setUint32(28, sampleRate * 2, true);  // Byte rate
+        view.setUint16(32, 2, true);               // Block align
+        view.setUint16(34, 16, true);              // Bits per sample
+        writeString(36, 'data');
+        view.setUint32(40, pcm.length * 2, true);
+        pcm.forEach((sample, i) => view.setInt16(44 + i * 2, sample, true));
+        return new Blob([view], { type: 'audio/wav' });
+    }
+
     async processRecording() {
         if (this.audioChunks.length === 0) return;
         
@@ -161,17 +315,7 @@ class VoiceChatApp {
             formData.append('type', 'voice');
             
             console.log('📤 Sending voice message...');
-            const response = await fetch('/chat', {
-                method: 'POST',
-                body: formData
-            });
-            
-            if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
-            }
-            
-            const data = await response.json();
-            this.handleChatResponse(data);
+            await this.streamChat(formData);
             
         } catch (error) {
             console.error('❌ Error processing recording:', error);
@@ -203,17 +347,7 @@ class VoiceChatApp {
             formData.append('type', 'text');
             
             console.log('📤 Sending text message:', message);
-            const response = await fetch('/chat', {
-                method: 'POST',
-                body: formData
-            });
-            
-            if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
-            }
-            
-            const data = await response.json();
-            this.handleChatResponse(data);
+            await this.streamChat(formData);
             
         } catch (error) {
             console.error('❌ Error sending message:', error);
@@ -226,6 +360,182 @@ class VoiceChatApp {
         }
     }
 
+    async streamChat(formData) {
+        formData.append('format', this.audioFormat);
+        const response = await fetch('/chat/stream', {
+            method: 'POST',
+            body: formData
+        });
+        
+        if (!response.ok) {
+            // Validation errors come back as plain JSON before streaming starts
+            const data = await response.json().catch(() => null);
+            if (data && data.error) {
+                this.handleChatResponse(data);
+                return;
+            }
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        const stream = { player: null, aiResponse: '' };
+        let buffer = '';
+        
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                const event = this.parseServerEvent(rawEvent);
+                if (event) this.handleStreamEvent(event, stream);
+            }
+        }
+    }
+
+    parseServerEvent(rawEvent) {
+        let name = 'message';
+        const dataLines = [];
+        rawEvent.split('\n').forEach(line => {
+            if (line.startsWith('event:')) name = line.slice(6).trim();
+            else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+        });
+        if (dataLines.length === 0) return null;
+        return { name, data: JSON.parse(dataLines.join('\n')) };
+    }
+
+    handleStreamEvent(event, stream) {
+        const { name, data } = event;
+        
+        // The reply bubble appears with the first token
+        if ((name === 'token' || name === 'text') && !stream.player) {
+            if (this.aiProcessingMessageElement) {
+                this.aiProcessingMessageElement.remove();
+                this.aiProcessingMessageElement = null;
+            }
+            stream.player = this.addStreamingAudioMessage();
+        }
+        
+        if (name === 'token') {
+            stream.aiResponse += data.text;
+            stream.player.setText(stream.aiResponse);
+        } else if (name === 'text') {
+            console.log('✅ Received text response:', data);
+            stream.aiResponse = data.ai_response;
+            stream.player.setText(stream.aiResponse);
+        } else if (name === 'audio') {
+            console.log(`🔊 Audio chunk ${data.index} ready`);
+            stream.player.enqueue(data.audio_url);
+        } else if (name === 'done') {
+            if (data.audio_available) {
+                stream.player.finish();
+                this.showToast('Voice response generated successfully!', 'success');
+            } else {
+                // No audio could be synthesized, keep just the text
+                stream.player.removeAudio();
+                this.showToast('Text response only (audio generation failed)', 'warning');
+            }
+        } else if (name === 'error') {
+            this.handleChatResponse(data);
+        }
+    }
+
+    addStreamingAudioMessage() {
+        const chatHistory = document.getElementById('chatHistory');
+        const messageDiv = document.createElement('div');
+        messageDiv.className = 'message assistant';
+        messageDiv.innerHTML = `
+            <div class="avatar assistant-avatar"><i class="fas fa-robot"></i></div>
+            <div class="message-content">
+                <div class="wa-audio-bubble assistant">
+                    <button class="wa-audio-play" aria-label="Play/Pause" tabindex="0"></button>
+                    <audio class="wa-audio-player" preload="auto"></audio>
+                    <div class="wa-audio-time"></div>
+                </div>
+                <p class="audio-transcript"></p>
+            </div>
+        `;
+        chatHistory.appendChild(messageDiv);
+        chatHistory.scrollTop = chatHistory.scrollHeight;
+        
+        const audioPlayer = messageDiv.querySelector('.wa-audio-player');
+        const playButton = messageDiv.querySelector('.wa-audio-play');
+        const timeDisplay = messageDiv.querySelector('.wa-audio-time');
+        const transcript = messageDiv.querySelector('.audio-transcript');
+        
+        // Chunks play back-to-back as they arrive; the first one starts automatically
+        const player = {
+            element: messageDiv,
+            urls: [],
+            current: -1,
+            finished: false,
+            waiting: true,
+            enqueue(url) {
+                this.urls.push(url);
+                timeDisplay.textContent = `${this.urls.length} part${this.urls.length > 1 ? 's' : ''}`;
+                if (this.waiting) this.playNext();
+            },
+            playNext() {
+                if (this.current + 1 >= this.urls.length) {
+                    this.waiting = !this.finished;
+                    if (this.finished) this.reset();
+                    return;
+                }
+                this.waiting = false;
+                this.current += 1;
+                audioPlayer.src = this.urls[this.current];
+                audioPlayer.play()
+                    .then(() => playButton.classList.add('playing'))
+                    .catch(() => playButton.classList.remove('playing'));
+            },
+            finish() {
+                this.finished = true;
+                if (this.waiting) this.reset();
+            },
+            setText(text) {
+                transcript.textContent = text;
+                chatHistory.scrollTop = chatHistory.scrollHeight;
+            },
+            removeAudio() {
+                messageDiv.querySelector('.wa-audio-bubble').remove();
+            },
+            reset() {
+                this.current = -1;
+                this.waiting = false;
+                playButton.classList.remove('playing');
+                playButton.style.background = '';
+            }
+        };
+        
+        playButton.addEventListener('click', () => {
+            if (!audioPlayer.paused) {
+                audioPlayer.pause();
+                playButton.classList.remove('playing');
+            } else if (player.current === -1) {
+                player.playNext();
+            } else {
+                audioPlayer.play();
+                playButton.classList.add('playing');
+            }
+        });
+        
+        audioPlayer.addEventListener('timeupdate', () => {
+            const duration = audioPlayer.duration;
+            if (duration && player.urls.length) {
+                const progress = ((player.current + audioPlayer.currentTime / duration) / player.urls.length) * 100;
+                playButton.style.background = `conic-gradient(var(--success) ${progress}%, transparent ${progress}%)`;
+            }
+        });
+        
+        audioPlayer.addEventListener('ended', () => player.playNext());
+        
+        return player;
+    }
+
     handleChatResponse(data) {
         if (data.error) {
             this.showToast(data.error, 'error');
@@ -0,0 +1,91 @@
+import time
+
+import pytest
+
+app = pytest.importorskip("app")
+
+def make_cache(tmp_path, **options):
+    settings = dict(
+        max_memory_items=2, max_disk_bytes=1000, max_memory_bytes=10_000,
+        spill_bytes=500, ttl_seconds=60, sweep_seconds=0, shared=False
+    )
+    settings.update(options)
+    return app.AudioCache(str(tmp_path), **settings)
+
+def test_memory_overflow_spills_to_disk(tmp_path):
+    cache = make_cache(tmp_path)
+    for name in ("a.wav", "b.wav", "c.wav"):
+        cache.put(name, name.encode())
+    assert (tmp_path / "a.wav").read_bytes() == b"a.wav"
+    assert not (tmp_path / "c.wav").exists()
+    assert cache.get("a.wav") == b"a.wav"
+    assert cache.snapshot()['disk_hits'] == 1
+
+def test_large_clips_go_straight_to_disk(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put("big.wav", b"x" * 600)
+    assert (tmp_path / "big.wav").exists()
+    assert cache.snapshot()['memory_items'] == 0
+
+def test_disk_cap_evicts_oldest_clips(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put("old.wav", b"o" * 600)
+    cache.put("new.wav", b"n" * 600)
+    assert not (tmp_path / "old.wav").exists()
+    assert cache.get("new.wav") is not None
+    assert cache.snapshot()['disk_bytes'] <= 1000
+
+def test_disk_cap_evicts_unpinned_clips_first(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.retain(["pinned.mp3"])
+    cache.put("pinned.wav", b"p" * 600)
+    cache.put("loose.wav", b"l" * 600)
+    cache.put("new.wav", b"n" * 300)
+    assert cache.get("pinned.wav") is not None
+    assert cache.get("loose.wav") is None
+    assert cache.snapshot()['disk_evictions'] == 1
+
+def test_pinned_clips_are_evicted_only_when_the_cap_requires_it(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.retain(["first.wav", "second.wav"])
+    cache.put("first.wav", b"1" * 600)
+    cache.put("second.wav", b"2" * 600)
+    assert not (tmp_path / "first.wav").exists()
+    assert cache.snapshot()['pinned_evictions'] == 1
+    assert cache.snapshot()['disk_bytes'] <= 1000
+
+def test_sweep_skips_pinned_clips(tmp_path):
+    cache = make_cache(tmp_path, ttl_seconds=0)
+    cache.put("kept.wav", b"kept")
+    cache.put("gone.wav", b"gone")
+    cache.retain(["kept.mp3"])
+    time.sleep(0.01)
+    assert cache.sweep() == 1
+    assert cache.get("kept.wav") == b"kept"
+    assert cache.get("gone.wav") is None
+
+def test_release_unpins_after_the_last_reference(tmp_path):
+    cache = make_cache(tmp_path, ttl_seconds=0)
+    cache.put("clip.wav", b"clip")
+    cache.retain(["clip.wav"])
+    cache.retain(["clip.wav"])
+    cache.release(["clip.wav"])
+    time.sleep(0.01)
+    assert cache.sweep() == 0
+    cache.release(["clip.wav"])
+    assert cache.sweep() == 1
+
+def test_locate_drops_a_clip_removed_by_another_process(tmp_path):
+    cache = make_cache(tmp_path, spill_bytes=0, shared=True)
+    cache.put("gone.wav", b"gone")
+    (tmp_path / "gone.wav").unlink()
+    assert cache.locate("gone.wav") is None
+    assert cache.snapshot()['disk_items'] == 0
+
+def test_missing_clip_file_is_a_404(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, spill_bytes=0, shared=True)
+    monkeypatch.setattr(app, 'audio_cache', cache)
+    key = app.AudioCache.make_key("hello", None, 24000)
+    cache.put(f"{key}.wav", b"RIFF")
+    (tmp_path / f"{key}.wav").unlink()
+    assert app.app.test_client().get(f"/audio/{key}.wav").status_code == 404
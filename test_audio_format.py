@@ -0,0 +1,29 @@
+import pytest
+
+app = pytest.importorskip("app")
+
+def negotiate(accept=None, default='wav', **values):
+    headers = {'Accept': accept} if accept else {}
+    with app.app.test_request_context('/', headers=headers, query_string=values):
+        return app.negotiate_audio_format(default=default)
+
+@pytest.mark.parametrize("accept, expected", [
+    ("audio/wav, audio/ogg;q=0.1", 'wav'),
+    ("audio/ogg, audio/wav;q=0.5", 'opus'),
+    ("audio/ogg;q=0, audio/*", 'wav'),
+    ("audio/wav;q=0, audio/ogg;q=0.2", 'opus'),
+    ("*/*", 'wav'),
+    ("text/html", 'wav'),
+])
+def test_accept_header_preferences_are_respected(accept, expected):
+    assert negotiate(accept) == expected
+
+def test_missing_accept_header_uses_the_default():
+    assert negotiate(default='opus') == 'opus'
+
+def test_wildcard_keeps_a_default_of_the_same_type():
+    assert negotiate("audio/*", default='wav16k') == 'wav16k'
+    assert negotiate("audio/wav", default='wav16k') == 'wav16k'
+
+def test_format_parameter_wins_over_accept():
+    assert negotiate("audio/ogg", format='wav16k') == 'wav16k'
@@ -0,0 +1,152 @@
+import time
+
+import pytest
+
+app = pytest.importorskip("app")
+
+class Unavailable(Exception):
+    status_code = 503
+
+class BadRequest(Exception):
+    status_code = 400
+
+def make_caller(monkeypatch, failures=2, reset_seconds=60.0, attempts=1):
+    monkeypatch.setattr(app, 'BREAKER_FAILURES', failures)
+    monkeypatch.setattr(app, 'BREAKER_RESET_SECONDS', reset_seconds)
+    monkeypatch.setattr(app, 'BACKOFF_BASE_SECONDS', 0.0)
+    return app.BackendCaller("test", attempts=attempts, hedge=False)
+
+def fail(error):
+    def function():
+        raise error
+    return function
+
+def expire(breaker):
+    breaker._opened_at = time.monotonic() - breaker.reset_seconds
+
+def test_consecutive_failures_open_the_circuit(monkeypatch):
+    caller = make_caller(monkeypatch)
+    for _ in range(2):
+        with pytest.raises(Unavailable):
+            caller.call(fail(Unavailable()))
+    assert caller.breaker.state == 'open'
+    with pytest.raises(app.CircuitOpenError):
+        caller.call(lambda: "ok")
+
+def test_client_errors_do_not_count_against_the_backend(monkeypatch):
+    caller = make_caller(monkeypatch)
+    for _ in range(3):
+        with pytest.raises(BadRequest):
+            caller.call(fail(BadRequest()))
+    assert caller.breaker.state == 'closed'
+
+def test_successful_trial_closes_the_circuit(monkeypatch):
+    caller = make_caller(monkeypatch, failures=1)
+    with pytest.raises(Unavailable):
+        caller.call(fail(Unavailable()))
+    expire(caller.breaker)
+    assert caller.call(lambda: "ok") == "ok"
+    assert caller.breaker.state == 'closed'
+
+def test_failed_trial_reopens_the_circuit(monkeypatch):
+    caller = make_caller(monkeypatch, failures=1)
+    with pytest.raises(Unavailable):
+        caller.call(fail(Unavailable()))
+    expire(caller.breaker)
+    with pytest.raises(Unavailable):
+        caller.call(fail(Unavailable()))
+    assert caller.breaker.state == 'open'
+    assert not caller.breaker.allow()
+
+def test_only_one_trial_while_half_open():
+    breaker = app.CircuitBreaker(failures=1, reset_seconds=60.0)
+    breaker.record(False)
+    expire(breaker)
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    assert not breaker.allow()
+
+def test_abandoned_trial_stream_does_not_wedge_the_breaker(monkeypatch):
+    caller = make_caller(monkeypatch, failures=1)
+    with pytest.raises(Unavailable):
+        caller.call(fail(Unavailable()))
+    expire(caller.breaker)
+    stream = caller.stream(lambda: iter(["one", "two"]))
+    assert next(stream) == "one"
+    assert caller.breaker.state == 'half_open'
+    stream.close()  # The client disconnected mid-reply
+    assert caller.breaker.state == 'closed'
+
+def test_interrupted_trial_before_first_piece_allows_a_new_trial(monkeypatch):
+    caller = make_caller(monkeypatch, failures=1)
+    with pytest.raises(Unavailable):
+        caller.call(fail(Unavailable()))
+    expire(caller.breaker)
+
+    def interrupted():
+        raise KeyboardInterrupt
+        yield
+
+    with pytest.raises(KeyboardInterrupt):
+        list(caller.stream(interrupted))
+    assert caller.breaker.state == 'open'
+    assert list(caller.stream(lambda: iter(["hello"]))) == ["hello"]
+    assert caller.breaker.state == 'closed'
+
+def test_stream_retries_before_the_first_piece(monkeypatch):
+    caller = make_caller(monkeypatch, attempts=2)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) == 1:
+            raise Unavailable()
+        yield "hi"
+
+    assert list(caller.stream(flaky)) == ["hi"]
+    assert len(calls) == 2
+
+def test_hedge_answers_when_the_primary_fails(monkeypatch):
+    caller = make_caller(monkeypatch)
+    monkeypatch.setattr(caller, '_hedge_delay', lambda: 0.01)
+    calls = []
+
+    def slow_then_fail():
+        calls.append(1)
+        if len(calls) == 1:
+            time.sleep(0.2)
+            raise Unavailable()
+        return "hedged"
+
+    assert caller.call(slow_then_fail) == "hedged"
+    assert len(calls) == 2
+
+def test_fast_hedge_beats_a_slow_primary(monkeypatch):
+    caller = make_caller(monkeypatch)
+    monkeypatch.setattr(caller, '_hedge_delay', lambda: 0.05)
+    calls = []
+
+    def slow_then_fast():
+        calls.append(1)
+        if len(calls) == 1:
+            time.sleep(1.0)
+            return "primary"
+        return "hedged"
+
+    start = time.perf_counter()
+    assert caller.call(slow_then_fast) == "hedged"
+    assert time.perf_counter() - start < 0.5
+
+def test_hedged_attempt_fails_only_when_both_requests_fail(monkeypatch):
+    caller = make_caller(monkeypatch)
+    monkeypatch.setattr(caller, '_hedge_delay', lambda: 0.01)
+    calls = []
+
+    def always_fails():
+        calls.append(1)
+        time.sleep(0.05)
+        raise Unavailable()
+
+    with pytest.raises(Unavailable):
+        caller.call(always_fails)
+    assert len(calls) == 2
@@ -0,0 +1,35 @@
+import os
+import signal
+import threading
+
+import pytest
+
+app = pytest.importorskip("app")
+serve = pytest.importorskip("serve")
+
+@pytest.fixture
+def sigterm():
+    """Route SIGTERM through serve.py's drain hook and restore everything afterwards"""
+    stopped = threading.Event()
+    previous = signal.getsignal(signal.SIGTERM)
+    serve.drain_on_sigterm(app, 5.0, 0.0, lambda signum, frame: stopped.set())
+    yield stopped
+    signal.signal(signal.SIGTERM, previous)
+    app.draining.clear()
+
+def test_ready_returns_503_once_draining_starts(sigterm):
+    client = app.app.test_client()
+    os.kill(os.getpid(), signal.SIGTERM)
+    response = client.get('/ready')
+    assert response.status_code == 503
+    assert response.get_json()['draining'] is True
+    assert sigterm.wait(5)
+
+def test_server_stops_only_after_in_flight_requests_finish(sigterm):
+    app.http_in_flight.inc()
+    try:
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert not sigterm.wait(0.5)
+    finally:
+        app.http_in_flight.dec()
+    assert sigterm.wait(5)
@@ -0,0 +1,105 @@
+import pytest
+
+app = pytest.importorskip("app")
+np = pytest.importorskip("numpy")
+
+CONTEXT = "0123456789abcdef"
+OTHER_CONTEXT = "fedcba9876543210"
+
+def constant_embedder(text):
+    """Worst case for the similarity tier: every message embeds identically"""
+    return np.full(8, 8 ** -0.5, dtype=np.float32)
+
+def make_cache(embedder=constant_embedder):
+    return app.ResponseCache(max_items=4, ttl_seconds=60, threshold=0.9, embedder=embedder)
+
+def session_with(*contents):
+    session = app.ConversationSession(session_id="s")
+    session.append_messages([
+        {'type': 'user' if index % 2 == 0 else 'assistant', 'content': content}
+        for index, content in enumerate(contents)
+    ])
+    return session
+
+def test_exact_hit_ignores_case_and_punctuation():
+    cache = make_cache(embedder=None)
+    cache.store("How are you?", CONTEXT, "Doing well")
+    assert cache.lookup("how are you", CONTEXT) == "Doing well"
+    assert cache.snapshot()['exact_hits'] == 1
+
+def test_reply_is_scoped_to_its_context():
+    cache = make_cache(embedder=None)
+    cache.store("How are you?", CONTEXT, "Doing well")
+    assert cache.lookup("How are you?", OTHER_CONTEXT) is None
+
+def test_fingerprint_covers_the_whole_history_window():
+    fallback = app.FALLBACK_RESPONSE
+    first = session_with("my sister is in hospital", fallback)
+    second = session_with("I lost my job today", fallback)
+    fingerprints = [
+        app.context_fingerprint(app.build_context(session, "thanks"))
+        for session in (first, second)
+    ]
+    assert fingerprints[0] != fingerprints[1]
+
+def test_fingerprint_covers_the_summary():
+    first, second = session_with("hello"), session_with("hello")
+    second.summary = "The user talked about their divorce."
+    assert (app.context_fingerprint(app.build_context(first, "hi"))
+            != app.context_fingerprint(app.build_context(second, "hi")))
+
+def test_without_a_model_near_matches_miss():
+    cache = make_cache(embedder=None)
+    cache.store("I feel a bit tired today", CONTEXT, "Rest well")
+    assert cache.lookup("I feel a bit tired this evening", CONTEXT) is None
+
+def test_one_word_change_is_not_a_near_match():
+    cache = make_cache()
+    cache.store("I have been thinking about ending my life lately and I do not know what to do", CONTEXT, "reply")
+    assert cache.lookup("I have been thinking about ending my job lately and I do not know what to do", CONTEXT) is None
+
+def test_short_message_with_one_word_changed_is_not_a_near_match():
+    cache = make_cache()
+    cache.store("thinking about ending my life", CONTEXT, "reply")
+    assert cache.lookup("thinking about ending my job", CONTEXT) is None
+
+def test_inserted_word_is_not_a_near_match():
+    cache = make_cache()
+    cache.store("I feel safe at home", CONTEXT, "reply")
+    assert cache.lookup("I feel unsafe safe at home", CONTEXT) is None
+
+@pytest.mark.parametrize("stored, asked", [
+    ("I want to keep going", "I don't want to keep going"),
+    ("I want to keep going", "I do not want to keep going anymore"),
+    ("I can sleep at night", "I can never sleep at night"),
+    ("I have someone to talk to", "I have no one to talk to"),
+])
+def test_negation_is_not_a_near_match(stored, asked):
+    cache = make_cache()
+    cache.store(stored, CONTEXT, "reply")
+    assert cache.lookup(asked, CONTEXT) is None
+
+@pytest.mark.parametrize("stored, asked", [
+    ("hi", "hello"),
+    ("hey there", "hi there"),
+    ("hello luna", "hi luna"),
+    ("good morning", "good morning there"),
+])
+def test_greeting_paraphrase_is_a_near_match(stored, asked):
+    cache = make_cache()
+    cache.store(stored, CONTEXT, "Hi! How are you feeling today?")
+    assert cache.lookup(asked, CONTEXT) == "Hi! How are you feeling today?"
+
+def test_paraphrase_is_a_near_match():
+    cache = make_cache()
+    cache.store("what are some good ways to relax", CONTEXT, "Try breathing")
+    assert cache.lookup("could you suggest ways i might unwind", CONTEXT) == "Try breathing"
+    assert cache.snapshot()['similar_hits'] == 1
+
+def test_least_recently_used_entry_is_evicted():
+    cache = make_cache(embedder=None)
+    for index in range(5):
+        cache.store(f"message {index}", CONTEXT, str(index))
+    assert cache.lookup("message 0", CONTEXT) is None
+    assert cache.lookup("message 4", CONTEXT) == "4"
+    assert cache.snapshot()['evictions'] == 1
@@ -0,0 +1,30 @@
+import pytest
+
+app = pytest.importorskip("app")
+
+def test_complete_sentences_are_released():
+    buffer = app.SentenceBuffer()
+    assert buffer.feed("This sentence is long enough. And this one is") == ["This sentence is long enough."]
+    assert buffer.flush() == ["And this one is"]
+
+def test_short_fragments_merge_with_the_next_sentence():
+    buffer = app.SentenceBuffer()
+    assert buffer.feed("Hi! Oh. ") == []
+    assert buffer.feed("It is lovely to hear from you. ") == ["Hi! Oh. It is lovely to hear from you."]
+
+def test_text_split_across_tokens():
+    buffer = app.SentenceBuffer()
+    chunks = []
+    for token in ["I am really", " glad you", " asked that."]:
+        chunks += buffer.feed(token)
+    assert chunks == []  # A boundary needs the whitespace that follows it
+    assert buffer.feed(" Tell me more") == ["I am really glad you asked that."]
+    assert buffer.flush() == ["Tell me more"]
+
+def test_flush_empties_the_buffer():
+    buffer = app.SentenceBuffer()
+    buffer.feed("   ")
+    assert buffer.flush() == []
+    buffer.feed("leftover")
+    assert buffer.flush() == ["leftover"]
+    assert buffer.flush() == []
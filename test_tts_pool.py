@@ -0,0 +1,55 @@
+import pytest
+
+app = pytest.importorskip("app")
+
+class DeadProcess:
+    pid = 1234
+    exitcode = -9
+
+    def is_alive(self):
+        return False
+
+    def join(self, timeout=None):
+        pass
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(app, 'TTS_WORKER_START_ATTEMPTS', 3)
+    monkeypatch.setattr(app, 'TTS_RESTART_BACKOFF_SECONDS', 0.0)
+    monkeypatch.setitem(app.model_status, 'tts', {'state': 'ready'})
+    pool = app.TTSProcessPool(workers=1, threads_per_worker=1, queue_size=4)
+    pool.spawned = []
+
+    def spawn(worker_id):
+        pool.spawned.append(worker_id)
+        pool._processes[worker_id] = DeadProcess()
+        pool._state[worker_id] = 'starting'
+        pool._generation[worker_id] = pool._generation.get(worker_id, -1) + 1
+
+    monkeypatch.setattr(pool, '_spawn', spawn)
+    spawn(0)
+    return pool
+
+def test_startup_crashes_back_off_before_restarting(pool):
+    pool._check_workers()
+    assert pool.worker_states() == {'0': 'backoff'}
+    pool._check_workers()
+    assert pool.spawned == [0, 0]
+    assert pool.worker_states() == {'0': 'starting'}
+
+def test_repeated_startup_crashes_mark_the_worker_failed(pool):
+    for _ in range(10):
+        pool._check_workers()
+    assert pool.worker_states() == {'0': 'failed'}
+    assert pool.spawned == [0, 0, 0]
+    assert app.model_status['tts']['state'] == 'failed'
+    assert pool.submit("hello", None, None).exception() is not None
+
+def test_ready_worker_resets_the_crash_count(pool):
+    pool._check_workers()
+    pool._check_workers()
+    pool._start_crashes.pop(0)  # What a 'ready' message from the worker does
+    pool._state[0] = 'ready'
+    pool._check_workers()  # A crash after serving restarts right away
+    assert pool.spawned == [0, 0, 0]
+    assert pool._start_crashes == {}
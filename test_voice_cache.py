@@ -0,0 +1,57 @@
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+app = pytest.importorskip("app")
+
+class FakeConditionals:
+    def __init__(self, name):
+        self.name = name
+
+    def save(self, path):
+        path.write_text(self.name)
+
+    @classmethod
+    def load(cls, path, map_location=None):
+        return cls(path.read_text())
+
+    def to(self, device):
+        return self
+
+@pytest.fixture
+def voices(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'VOICE_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(app, 'VOICE_CACHE_ITEMS', 2)
+    monkeypatch.setattr(app, 'voice_conditionals', OrderedDict())
+    monkeypatch.setattr(app, 'voice_prepare_seconds', {})
+    monkeypatch.setattr(app, 'chatterbox_tts', SimpleNamespace(Conditionals=FakeConditionals))
+    monkeypatch.setattr(app, 'tts_model', SimpleNamespace(device='cpu'))
+    return tmp_path
+
+def persist(name):
+    FakeConditionals(name).save(app.voice_cache_file(name))
+    app.remember_voice(name, FakeConditionals(name), 1.0)
+
+def test_memory_holds_only_the_most_recent_voices(voices):
+    for name in ("a", "b", "c"):
+        persist(name)
+    assert list(app.voice_conditionals) == ["b", "c"]
+    assert "a" not in app.voice_prepare_seconds
+
+def test_lookups_refresh_recency(voices):
+    persist("a")
+    persist("b")
+    app.get_voice_conditionals("a")
+    persist("c")
+    assert list(app.voice_conditionals) == ["a", "c"]
+
+def test_evicted_voice_reloads_from_disk(voices):
+    for name in ("a", "b", "c"):
+        persist(name)
+    conds = app.get_voice_conditionals("a")
+    assert conds.name == "a"
+    assert list(app.voice_conditionals) == ["c", "a"]
+
+def test_unknown_voice_is_a_miss(voices):
+    assert app.get_voice_conditionals("missing") is None